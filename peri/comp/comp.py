@@ -3,11 +3,214 @@ import inspect
 from operator import add
 from collections import OrderedDict, defaultdict
 
+import numpy as np
+
 from peri import util
 
 class NotAParameterError(Exception):
     pass
 
+#=============================================================================
+# An index of the parameters of a group of components
+#=============================================================================
+class ParameterRegistry(object):
+    def __init__(self, blocks=()):
+        """
+        Index of the parameters of several blocks (components) as slots of a
+        single contiguous float array of their values, :attr:`values`.
+        Parameter names are hashed to their slot and each block keeps the
+        array of slots of its own parameters, in its own order, so values can
+        be gathered and scattered with integer index arrays instead of names.
+        A parameter shared by several blocks has one slot, at its first
+        appearance.
+
+        The registry only indexes the values; the owner of the blocks is
+        responsible for writing them to :attr:`values` whenever they change
+        (new slots start at zero).
+
+        Parameters can be inserted into and removed from a block without
+        rebuilding the index. The slots stay dense: new parameters take new
+        slots at the end, and when slots are freed the last slots are moved
+        into the holes, as are the last parameters of a block whose
+        parameters are removed. The work is proportional to the number of
+        parameters inserted or removed plus the number after the insertion
+        point, so adding or removing parameters at the end of a block is
+        O(1) per parameter, amortized over the growth of the arrays.
+
+        Parameters
+        ----------
+        blocks : list of lists of strings
+            The parameter names of each block
+        """
+        self.names = []  # the parameter in each slot
+        self.slot = {}
+        self.blocks = []  # views of the first sizes[i] entries of _buffers
+        self._refs = []  # the number of block entries of each slot
+        self._buffers = []
+        self._sizes = []
+        self._inverse = []  # the position of each slot in each block, or -1
+        self._values = np.zeros(0)
+        for names in blocks:
+            self.add_block(names)
+
+    @staticmethod
+    def _grow(arr, n, fill=0):
+        """`arr` if it holds `n` entries, else a copy with doubled capacity"""
+        if arr.shape[0] >= n:
+            return arr
+        new = fill*np.ones(max(n, 2*arr.shape[0], 16), dtype=arr.dtype)
+        new[:arr.shape[0]] = arr
+        return new
+
+    def _take_slots(self, names):
+        """Slots of `names`, creating new ones at the end for new names"""
+        slots = np.zeros(len(names), dtype='int')
+        for i, p in enumerate(names):
+            s = self.slot.get(p)
+            if s is None:
+                s = len(self.names)
+                self.names.append(p)
+                self._refs.append(0)
+                self.slot[p] = s
+            self._refs[s] += 1
+            slots[i] = s
+        for k in xrange(len(self._inverse)):
+            self._inverse[k] = self._grow(self._inverse[k], len(self.names), -1)
+        n = self._values.shape[0]
+        self._values = self._grow(self._values, len(self.names))
+        self._values[n:] = 0
+        return slots
+
+    def _set_block(self, block, buf, size):
+        self._buffers[block] = buf
+        self._sizes[block] = size
+        self.blocks[block] = buf[:size]
+
+    def add_block(self, names):
+        """Adds a block with parameters `names`, returning its index"""
+        self._buffers.append(None)
+        self._sizes.append(0)
+        self.blocks.append(None)
+        self._inverse.append(-np.ones(0, dtype='int'))
+        block = len(self.blocks) - 1
+
+        slots = self._take_slots(names)
+        self._set_block(block, slots, slots.size)
+        self._inverse[block][slots] = np.arange(slots.size)
+        return block
+
+    def insert(self, block, at, names):
+        """
+        Inserts `names` at position `at` of the parameters of `block`,
+        returning the names which were given new slots (at the end).
+        """
+        nslots = len(self.names)
+        slots = self._take_slots(names)
+        new = [self.names[s] for s in xrange(nslots, len(self.names))]
+
+        buf, size, k = self._buffers[block], self._sizes[block], slots.size
+        buf = self._grow(buf, size + k)
+        buf[at+k:size+k] = buf[at:size].copy()
+        buf[at:at+k] = slots
+        self._set_block(block, buf, size + k)
+        self._inverse[block][buf[at:size+k]] = np.arange(at, size+k)
+        return new
+
+    def remove(self, block, inds):
+        """
+        Removes the parameters at positions `inds` of `block`, moving the
+        last parameters of the block into their places. Returns the names
+        removed and the slots freed, which no other block used; the last
+        slots are moved into the freed ones in the same way.
+        """
+        buf, size = self._buffers[block], self._sizes[block]
+        inv = self._inverse[block]
+
+        inds = np.unique(np.asarray(inds, dtype='int'))
+        gone = buf[inds].copy()
+        names = [self.names[s] for s in gone]
+        inv[gone] = -1
+        self._compact(buf, inv, inds, size)
+        self._set_block(block, buf, size - inds.size)
+
+        freed = []
+        for s in gone:
+            self._refs[s] -= 1
+            if self._refs[s] == 0:
+                freed.append(s)
+        freed = np.unique(np.array(freed, dtype='int'))
+        self._free(freed)
+        return names, freed
+
+    @staticmethod
+    def _compact(buf, inv, inds, size):
+        """
+        Moves the entries of `buf` past the new end ``size - len(inds)``
+        which are not removed into the removed positions `inds` (sorted),
+        updating the inverse map `inv` of the moved entries.
+        """
+        end = size - inds.size
+        holes = inds[inds < end]
+        tail = np.setdiff1d(np.arange(end, size), inds)
+        buf[holes] = buf[tail]
+        inv[buf[holes]] = holes
+
+    def _free(self, freed):
+        """Frees the (sorted) slots `freed`, moving the last slots into them"""
+        if freed.size == 0:
+            return
+        for s in freed:
+            del self.slot[self.names[s]]
+
+        n = len(self.names)
+        end = n - freed.size
+        holes = freed[freed < end]
+        tail = np.setdiff1d(np.arange(end, n), freed)
+        self._values[holes] = self._values[tail]
+        for h, t in zip(holes, tail):
+            self.names[h] = self.names[t]
+            self._refs[h] = self._refs[t]
+            self.slot[self.names[h]] = h
+            for buf, inv in zip(self._buffers, self._inverse):
+                p = inv[t]
+                if p >= 0:
+                    buf[p] = h
+                    inv[h], inv[t] = p, -1
+        del self.names[end:], self._refs[end:]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, param):
+        return param in self.slot
+
+    def live_names(self):
+        """The parameter names, in slot order"""
+        return list(self.names)
+
+    @property
+    def values(self):
+        """The parameter values, in slot order (a view)"""
+        return self._values[:len(self.names)]
+
+    def slots(self, params):
+        """
+        The slots of a list of parameter names, as an int array. Raises a
+        KeyError for names which are not in the registry.
+        """
+        return np.array([self.slot[p] for p in util.listify(params)],
+                dtype='int')
+
+    def local(self, block, slots=None):
+        """
+        The positions of `slots` among the parameters of block `block`, or -1
+        where the block does not have that parameter.
+        """
+        inv = self._inverse[block][:len(self.names)]
+        if slots is None:
+            return inv
+        return inv[slots]
+
 #=============================================================================
 # A base class for parameter groups (components and priors)
 #=============================================================================
@@ -270,6 +473,42 @@ class Component(ParameterGroup, util.CompatibilityPatch):
         """ Perform its routine, whatever that may be """
         pass
 
+    def snapshot(self, params, tile):
+        """
+        Copy the internal fields which would be modified by an update of
+        `params` within `tile`, so that the update may be undone by
+        :func:`~peri.comp.comp.Component.restore` after the parameter values
+        themselves are set back. By default a component cannot be restored
+        this way and None is returned, in which case the update must be
+        reverted with another update.
+
+        Parameters
+        -----------
+        params : single param, list of params
+            The parameters which are about to be updated
+
+        tile : :class:`~peri.util.Tile`
+            The region of the image which the update will modify
+
+        Returns
+        -------
+        snap : list of tuples or None
+            A list of (attribute name, slicer, copy of the attribute). If the
+            slicer is None, the entire attribute is replaced on restore.
+        """
+        return None
+
+    def restore(self, snap):
+        """
+        Restore the internal fields stored by
+        :func:`~peri.comp.comp.Component.snapshot`.
+        """
+        for name, slicer, arr in snap:
+            if slicer is None:
+                setattr(self, name, arr)
+            else:
+                getattr(self, name)[slicer] = arr
+
     def get(self):
         """
         Return the `natural` part of the model. In the case of most elements it
@@ -277,6 +516,43 @@ class Component(ParameterGroup, util.CompatibilityPatch):
         """
         pass
 
+    def linear_basis(self, param):
+        """
+        The derivative of the field returned by `get` wrt `param` over the
+        entire shape of the component, if the field is linear in `param`.
+        By default the component is not linear and None is returned.
+        """
+        return None
+
+    def linear_deps(self, param):
+        """
+        The parameters on whose values the
+        :func:`~peri.comp.comp.Component.linear_basis` of `param` depends.
+        """
+        return []
+
+    def get_values_at(self, inds=None):
+        """
+        Values of the parameters at positions `inds` of `params` (all of
+        them if None), as a float array.
+        """
+        params = self.params
+        if inds is not None:
+            params = [params[i] for i in inds]
+        return np.array(util.listify(self.get_values(params)), dtype='float')
+
+    def set_values_at(self, inds, values):
+        """
+        Directly set the values of the parameters at positions `inds` of
+        `params`, as :func:`~peri.comp.comp.ParameterGroup.set_values`.
+        """
+        params = self.params
+        self.set_values([params[i] for i in inds], np.ravel(values).tolist())
+
+    def set_values(self, params, values):
+        super(Component, self).set_values(params, values)
+        self.trigger_values_change(params=params)
+
     # functions that allow better handling of component collections
     def exports(self):
         """ Which methods a class wants to expose to parent classes """
@@ -295,6 +571,31 @@ class Component(ParameterGroup, util.CompatibilityPatch):
         if self._parent:
             self._parent.trigger_parameter_change()
 
+    def trigger_parameter_insert(self, at, params):
+        """
+        Notify parents that `params` were inserted at position `at` of
+        `self.params`, with no other parameter changing.
+        """
+        if self._parent:
+            self._parent.insert_params(self, at, params)
+
+    def trigger_parameter_remove(self, inds):
+        """
+        Notify parents that the parameters at positions `inds` of the old
+        `self.params` were removed and the last parameters moved into their
+        places, with no other parameter changing.
+        """
+        if self._parent:
+            self._parent.remove_params(self, inds)
+
+    def trigger_values_change(self, params=None, inds=None):
+        """
+        Notify parents that the values of `params`, or of the parameters at
+        positions `inds` of `self.params`, were set.
+        """
+        if getattr(self, '_parent', None):
+            self._parent.values_changed(self, params=params, inds=inds)
+
     def trigger_update(self, params, values):
         """ Notify parent of a parameter change """
         if self._parent:
@@ -321,9 +622,15 @@ class GlobalScalar(Component):
     def get(self):
         return self.values[0]
 
+    def linear_basis(self, param):
+        return 1.0
+
     def get_update_tile(self, params, values):
         return self.shape
 
+    def snapshot(self, params, tile):
+        return []
+
 #=============================================================================
 # Component class == model components for an image
 #=============================================================================
@@ -391,19 +698,72 @@ class ComponentCollection(Component):
     def setup_params(self):
         pmap = defaultdict(set)
         lmap = defaultdict(list)
+        registry = ParameterRegistry()
 
         for c in self.comps:
             c.register(self)
 
             if not isinstance(c, (Component, ComponentCollection)):
                 raise AttributeError("%r is not a valid Component or ComponentCollection" % c)
-            for p in c.params:
-                pmap[p].update([c])
-                lmap[p].extend([c])
+            params = c.params
+            registry.add_block(params)
+            for p in params:
+                pmap[p].add(c)
+                lmap[p].append(c)
 
         self.pmap = pmap
         self.lmap = lmap
+        self.registry = registry
         self.sync_params()
+        self._pull_values()
+
+    def _pull_values(self, slots=None):
+        """
+        Copies the values of the parameters at `slots` (all if None) from the
+        components into the registry, each from the first component which
+        has it.
+        """
+        values = self.registry.values
+        for i in reversed(xrange(len(self.comps))):
+            local = self.registry.local(i)
+            if slots is None:
+                m = np.nonzero(local >= 0)[0]
+            else:
+                m = slots[local[slots] >= 0]
+            if m.size > 0:
+                values[m] = self.comps[i].get_values_at(local[m])
+
+    def param_slots(self, params):
+        """
+        The slots of `params` in :attr:`registry`, for use with
+        :func:`~peri.comp.comp.ComponentCollection.get_values_at` and
+        :func:`~peri.comp.comp.ComponentCollection.set_values_at`.
+        """
+        try:
+            return self.registry.slots(params)
+        except KeyError as e:
+            raise NotAParameterError("%r does not belong to %r" % (e.args[0],
+                    self))
+
+    def get_values_at(self, inds=None):
+        """
+        Values of the parameters at slots `inds` as a float array, gathered
+        from the registry's value array. If `inds` is None, the values of
+        all parameters, in the order of `params`.
+        """
+        if inds is None:
+            return self.registry.values.copy()
+        return self.registry.values[np.asarray(inds, dtype='int')]
+
+    def set_values_at(self, inds, values):
+        """Directly set the values of the parameters at slots `inds`"""
+        inds = np.asarray(inds, dtype='int')
+        values = np.ravel(values)
+        for i, c in enumerate(self.comps):
+            local = self.registry.local(i, inds)
+            m = local >= 0
+            if m.any():
+                c.set_values_at(local[m], values[m])
 
     def split_params(self, params, values=None):
         """
@@ -418,21 +778,16 @@ class ComponentCollection(Component):
         pc, vc = [], []
 
         returnvalues = values is not None
+        params = util.listify(params)
         if values is None:
-            values = [0]*len(util.listify(params))
-
-        for c in self.comps:
-            tp, tv = [], []
-            for p,v in zip(util.listify(params), util.listify(values)):
-                if not p in self.lmap:
-                    raise NotAParameterError("%r does not belong to %r" % (p, self))
-
-                if c in self.pmap[p]:
-                    tp.append(p)
-                    tv.append(v)
+            values = [0]*len(params)
+        values = util.listify(values)
+        slots = self.param_slots(params)
 
-            pc.append(tp)
-            vc.append(tv)
+        for i in xrange(len(self.comps)):
+            which = np.nonzero(self.registry.local(i, slots) >= 0)[0]
+            pc.append([params[j] for j in which])
+            vc.append([values[j] for j in which])
 
         if returnvalues:
             return pc, vc
@@ -451,36 +806,76 @@ class ComponentCollection(Component):
         for c, p, v in zip(self.comps, plist, vlist):
             if len(p) > 0:
                 c.update(p, v)
+        # components may adjust the values they are given, e.g. by clipping
+        self._pull_values(self.param_slots(params))
         return True
 
     def get_values(self, params):
-        vals = []
-        for p in util.listify(params):
-            if not p in self.lmap:
-                raise NotAParameterError("%r does not belong to %r" % (p, self))
-            vals.append(self.lmap[p][0].get_values(p))
-        return util.delistify(vals, params)
+        vals = self.get_values_at(self.param_slots(params))
+        return util.delistify(vals.tolist(), params)
 
     def set_values(self, params, values):
         plist, vlist = self.split_params(params, values)
         for c, p, v in zip(self.comps, plist, vlist):
-            c.set_values(p, v)
+            if len(p) > 0:
+                c.set_values(p, v)
+
+    def values_changed(self, comp, params=None, inds=None):
+        """
+        Copies the values of `params`, or of the parameters at positions
+        `inds` of ``comp.params``, which `comp` has set into the registry,
+        and passes the change on to the parent.
+        """
+        if inds is None:
+            slots = self.param_slots(params)
+        else:
+            block = self.registry.blocks[self._comp_index(comp)]
+            slots = block[np.asarray(inds, dtype='int')]
+        self._pull_values(slots)
+        self.trigger_values_change(inds=slots)
+
+    def insert_params(self, comp, at, params):
+        """
+        Registers new parameters `params` of `comp`, inserted at position
+        `at` of ``comp.params``, without rebuilding the registry. Parameters
+        new to this collection are appended to `params` and passed on to the
+        parent in the same way.
+        """
+        new = self.registry.insert(self._comp_index(comp), at, params)
+        for p in params:
+            self.pmap[p].add(comp)
+            self.lmap[p].append(comp)
+        if len(new) > 0:
+            at = len(self.registry) - len(new)
+            self._pull_values(np.arange(at, len(self.registry)))
+            self.trigger_parameter_insert(at, new)
+
+    def remove_params(self, comp, inds):
+        """
+        Unregisters the parameters at positions `inds` of ``comp.params``,
+        into which its last parameters were moved, without rebuilding the
+        registry. Parameters no longer in this collection are removed from
+        `params` in the same way and passed on to the parent.
+        """
+        names, freed = self.registry.remove(self._comp_index(comp), inds)
+        for p in names:
+            self.pmap[p].discard(comp)
+            self.lmap[p].remove(comp)
+            if len(self.lmap[p]) == 0:
+                del self.pmap[p], self.lmap[p]
+        if freed.size > 0:
+            self.trigger_parameter_remove(freed)
+
+    def _comp_index(self, comp):
+        return [i for i, c in enumerate(self.comps) if c is comp][0]
 
     @property
     def params(self):
-        pv = OrderedDict()
-        for c in self.comps:
-            for p,v in zip(c.params, c.values):
-                pv[p] = v
-        return pv.keys()
+        return self.registry.live_names()
 
     @property
     def values(self):
-        pv = OrderedDict()
-        for c in self.comps:
-            for p,v in zip(c.params, c.values):
-                pv[p] = v
-        return pv.values()
+        return self.get_values_at().tolist()
 
     def get_update_tile(self, params, values):
         sizes = []
@@ -529,6 +924,21 @@ class ComponentCollection(Component):
         for c in self.comps:
             c.set_shape(shape, inner)
 
+    def snapshot(self, params, tile):
+        """ Snapshot of all components affected by `params` """
+        snaps = []
+        for c, p in zip(self.comps, self.split_params(params)):
+            if len(p) > 0:
+                snap = c.snapshot(p, tile)
+                if snap is None:
+                    return None
+                snaps.extend([((c, n), sl, a) for n, sl, a in snap])
+        return snaps
+
+    def restore(self, snap):
+        for (c, name), slicer, arr in snap:
+            c.restore([(name, slicer, arr)])
+
     def sync_params(self):
         """ Ensure that shared parameters are the same value everywhere """
         def _normalize(comps, param):
@@ -561,10 +971,12 @@ class ComponentCollection(Component):
         self._nopickle = []
 
         for c in self.comps:
-            # take all member functions that start with 'param_'
+            # take all member functions that start with 'param_', except
+            # the ones a collection has itself (such as `param_slots`)
             funcs = inspect.getmembers(c, predicate=inspect.ismethod)
             for func in funcs:
-                if func[0].startswith('param_'):
+                if (func[0].startswith('param_') and
+                        not hasattr(ComponentCollection, func[0])):
                     setattr(self, func[0], func[1])
                     self._nopickle.append(func[0])
 
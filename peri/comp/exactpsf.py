@@ -8,6 +8,9 @@ from peri import util, interpolation
 from peri.comp import psfs, psfcalc
 from peri.fft import fft, fftkwargs
 
+# bytes of k-space planes ExactPSF.execute multiplies together at once
+EXECUTE_CHUNK = 2**26
+
 def moment(p, v, order=1):
     """ Calculates the moments of the probability distribution p with vector v """
     if order == 1:
@@ -366,13 +369,13 @@ class ExactPSF(psfs.PSF):
         self.update_values(params, values)
         self.characterize_psf()
 
-        self.slices = []
-        for i in xrange(self.zrange[0], self.zrange[1]+1):
-            zdrift = self.drift(i)
-            psf, vec = self.psf_slice(i, size=self.support, zoffset=zdrift)
-            self.slices.append(psf)
-
-        self.slices = np.array(self.slices)
+        # the slices are independent, so they are computed in parallel
+        slc = lambda i: self.psf_slice(i, size=self.support,
+                zoffset=self.drift(i))[0]
+        self.slices = np.array(util.parallel_map(slc,
+                xrange(self.zrange[0], self.zrange[1]+1),
+                workers=psfcalc.PSF_WORKERS))
+        self.get_kernel_cache().invalidate()
         return True
 
     def update_values(self, params, values):
@@ -428,39 +431,76 @@ class ExactPSF(psfs.PSF):
             kpsf /= kpsf[0,0,0]
         return kpsf
 
-    def execute(self, field):
-        if any(field.shape != self.tile.shape):
-            raise AttributeError("Field passed to PSF incorrect shape")
+    def _kpad2d(self, field, finalshape):
+        """
+        fftshift and pad each z-plane of the field with zeros in x and y
+        until it has size finalshape [2], normalized to unit sum. returns the
+        2d fourier transforms of the planes
+        """
+        currshape = np.array(field.shape[1:])
 
-        outfield = np.zeros_like(field, dtype='float')
-        zc,yc,xc = self.tile.coords(form='flat')
+        if any(finalshape < currshape):
+            raise IndexError("PSF tile size is less than minimum support size")
 
-        # here's the plan. we are going to rotate the field so that the current
-        # plane of interest is in the center. we then crop the image to the
-        # size of the support so that we are only convolving a small region.
-        # finally, take the mid plane back out as the solution.
-        for i,z in enumerate(zc):
-            # pad the psf slice for the convolution
-            fs = np.array(self.tile.shape)
-            fs[0] = self.support[0]
+        d = finalshape - currshape
 
-            if z < self.zrange[0] or z > self.zrange[1]:
-                continue
+        # fix off-by-one issues when going odd to even tile sizes
+        o = d % 2
+        d /= 2
 
-            zslice = int(np.clip(z, *self.zrange) - self.zrange[0])
-            middle = field.shape[0]/2
+        pad = ((0,0),) + tuple((d[i]+o[i],d[i]) for i in [0,1])
+        rpsf = np.pad(field, pad, mode='constant', constant_values=0)
+        rpsf = np.fft.ifftshift(rpsf, axes=(1,2))
+        return fft.rfft2(rpsf, **fftkwargs) / field.sum()
+
+    def _slice_kernel(self, zslice, finalshape):
+        """The padded k-space planes of psf slice `zslice`, from the cache"""
+        return self.get_kernel_cache().get(
+            ('slice', tuple(finalshape), zslice),
+            lambda: self._kpad2d(self.slices[zslice], finalshape)
+        )
 
-            subpsf = self._kpad(self.slices[zslice], fs, norm=True)
-            subfield = np.roll(field, middle - i, axis=0)
-            subfield = subfield[middle-fs[0]/2:middle+fs[0]/2+1]
+    def execute(self, field):
+        if any(field.shape != self.tile.shape):
+            raise AttributeError("Field passed to PSF incorrect shape")
 
-            kshape = subfield.shape
-            kfield = fft.rfftn(subfield, **fftkwargs)
+        outfield = np.zeros_like(field, dtype='float')
+        zc,yc,xc = self.tile.coords(form='flat')
 
-            outfield[i] = np.real(fft.irfftn(kfield * subpsf, s=kshape, **fftkwargs))[self.support[0]/2]
+        # each z-plane i of the output is its own psf slice convolved with
+        # the support[0] planes of the field centered on it (wrapping around
+        # the tile), which is the sum over the planes m of the slice of the
+        # 2d convolution of plane m with field plane i + support[0]/2 - m.
+        # so we transform every plane of the field once, multiply by the
+        # 2d transforms of the slices and transform all planes back at once
+        # instead of doing a 3d transform per plane.
+        nz = field.shape[0]
+        planes = np.arange(nz)[(zc >= self.zrange[0]) & (zc <= self.zrange[1])]
+        if planes.size == 0:
+            return outfield
+
+        shape = np.array(self.tile.shape[1:])
+        kfield = fft.rfft2(field, **fftkwargs)
+        offsets = self.support[0]/2 - np.arange(self.support[0])
+
+        chunk = max(EXECUTE_CHUNK / (self.support[0]*kfield[0].nbytes), 1)
+        for j in xrange(0, planes.size, chunk):
+            inds = planes[j:j+chunk]
+            kpsf = np.array([
+                self._slice_kernel(int(zc[i] - self.zrange[0]), shape)
+                for i in inds
+            ])
+            kplanes = kfield[(inds[:,None] + offsets[None,:]) % nz]
+            outfield[inds] = fft.irfft2((kpsf * kplanes).sum(axis=1),
+                    s=tuple(shape), **fftkwargs)
 
         return outfield
 
+    def execute_many(self, fields):
+        # each field needs its own product with the stack of slice kernels,
+        # which execute already does for all planes at once
+        return np.array([self.execute(f) for f in fields])
+
     def nopickle(self):
         return super(ExactPSF, self).nopickle() + [
             '_rx', '_ry', '_rz', '_rlen',
@@ -854,13 +894,24 @@ class ChebyshevPSF(ExactPSF):
 
         self.cheb = interpolation.ChebyshevInterpolation1D(self.psf, window=self.zrange,
                         degree=self.cheb_degree, evalpts=self.cheb_evals)
+        self.get_kernel_cache().invalidate()
         return True
 
+    def _cheb_kernel(self, k):
+        """
+        The k-space kernel of Chebyshev coefficient `k` padded to the
+        current tile, from the cache
+        """
+        return self.get_kernel_cache().get(
+            ('cheb', tuple(self.tile.shape), k),
+            lambda: self._kpad(self.cheb.coefficients[k],
+                    finalshape=self.tile.shape, zpad=True, norm=False)
+        )
+
     def psf(self, z):
-        psf = []
-        for i in z:
-            p, _ = self.psf_slice(i, size=self.support, zoffset=self.drift(i))
-            psf.append(p)
+        slc = lambda i: self.psf_slice(i, size=self.support,
+                zoffset=self.drift(i))[0]
+        psf = util.parallel_map(slc, z, workers=psfcalc.PSF_WORKERS)
         return np.rollaxis(np.array(psf), 0, 4)
 
     def execute(self, field):
@@ -872,14 +923,34 @@ class ChebyshevPSF(ExactPSF):
 
         kshape = field.shape
         kfield = fft.rfftn(field, **fftkwargs)
-        for k,c in enumerate(self.cheb.coefficients):
-            pad = self._kpad(c, finalshape=self.tile.shape, zpad=True, norm=False)
+        for k in xrange(self.cheb.degree):
+            pad = self._cheb_kernel(k)
             cov = np.real(fft.irfftn(kfield * pad, s=kshape, **fftkwargs))
 
             outfield += self.cheb.tk(k, zc)[:,None,None] * cov
 
         return outfield
 
+    def execute_many(self, fields):
+        if any(np.array(fields.shape[1:]) != self.tile.shape):
+            raise AttributeError("Fields passed to PSF incorrect shape")
+
+        outfield = np.zeros_like(fields, dtype='float')
+        zc,yc,xc = self.tile.coords(form='flat')
+
+        # the chebyshev kernels are fetched once per coefficient and reused
+        # for every field in the stack
+        axes = tuple(range(1, fields.ndim))
+        kshape = fields.shape[1:]
+        kfield = fft.rfftn(fields, axes=axes, **fftkwargs)
+        for k in xrange(self.cheb.degree):
+            pad = self._cheb_kernel(k)
+            cov = np.real(fft.irfftn(kfield * pad[None], s=kshape, axes=axes, **fftkwargs))
+
+            outfield += self.cheb.tk(k, zc)[None,:,None,None] * cov
+
+        return outfield
+
     def __str__(self):
         return "{} {}".format(self.__class__.__name__, [self.cheb_degree,
                 self.cheb_evals])
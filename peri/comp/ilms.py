@@ -128,6 +128,16 @@ class Polynomial3D(Component):
     def get(self):
         return self.field[self.tile.slicer]
 
+    def linear_basis(self, param):
+        return np.zeros(self.shape.shape) + self.term(self.param_term[param])
+
+    def snapshot(self, params, tile):
+        return [(f, None, getattr(self, f).copy()) for f in self._fields()]
+
+    def _fields(self):
+        """ The calculated fields which change with the parameters """
+        return ['field']
+
     def get_params(self):
         return self.params
 
@@ -315,6 +325,27 @@ class Polynomial2P1D(Polynomial3D):
             self.set_values(params, values)
             self.field[:] = self.calc_field()
 
+    def linear_basis(self, param):
+        if param in self.xy_param:
+            term, other = self.term(self.xy_param[param]), 1.0 + self.field_z
+        else:
+            term, other = self.term(self.z_param[param]), self.field_xy
+
+        if self.operation == '+':
+            return np.zeros(self.shape.shape) + term
+        return np.zeros(self.shape.shape) + term * other
+
+    def linear_deps(self, param):
+        # the field is a product, linear in each of the two sets separately
+        if self.operation == '+':
+            return []
+        if param in self.xy_param:
+            return self.z_param.keys()
+        return self.xy_param.keys()
+
+    def _fields(self):
+        return ['field', 'field_xy', 'field_z']
+
     def nopickle(self):
         return super(Polynomial2P1D, self).nopickle() + [
             'r', 'field', 'field_xy', 'field_z',
@@ -541,6 +572,53 @@ class BarnesPoly(Component, util.CompatibilityPatch):
     def get(self):
         return self.field[self.tile.slicer]
 
+    def _barnes_param_list(self):
+        c = self.category
+        return [p for p in self.params if p not in self.poly_params and
+                p not in [c+'-scale', c+'-off']]
+
+    def linear_basis(self, param):
+        c = self.category
+        op = {'*': mul, '+': add}[self.op]
+        if param == c+'-off':
+            return np.ones(self.shape.shape)
+        if param == c+'-scale':
+            return np.zeros(self.shape.shape) + op(
+                    1.0 + self._barnes_full(), 1.0 + self.poly)
+
+        if param in self.poly_params:
+            delta = self._term(self.poly_params[param])
+            other = 1.0 + self._barnes_full()
+        else:
+            # the barnes interpolant is linear in its control values
+            v0 = self.get_values(param)
+            b0 = self._barnes_full()
+            self.set_values(param, v0 + 1.0)
+            delta = self._barnes_full() - b0
+            self.set_values(param, v0)
+            other = 1.0 + self.poly
+
+        if self.op == '+':
+            return np.zeros(self.shape.shape) + self.scale * delta
+        return np.zeros(self.shape.shape) + self.scale * delta * other
+
+    def linear_deps(self, param):
+        c = self.category
+        if param == c+'-off':
+            return []
+        if param == c+'-scale':
+            return self.poly_params.keys() + self._barnes_param_list()
+        if self.op == '+':
+            return [c+'-scale']
+        if param in self.poly_params:
+            return [c+'-scale'] + self._barnes_param_list()
+        return [c+'-scale'] + self.poly_params.keys()
+
+    def snapshot(self, params, tile):
+        return [
+            ('field', None, self.field.copy()), ('poly', None, self.poly.copy())
+        ]
+
     def nopickle(self):
         return super(BarnesPoly, self).nopickle() + [
             'poly', 'b_in', 'b_out', 'r', 'field',
@@ -1,18 +1,36 @@
+import itertools
+import warnings
+from collections import defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 from scipy.special import erf
 
-try:
-    from scipy.weave import inline
-except ImportError as e:
-    from weave import inline
-
-from peri.special import functions
 from peri.comp import Component
+from peri.fft import fft, fftkwargs
 from peri.util import Tile, cdd, listify, delistify
 
 # maximum number of iterations to get an exact volume
 MAX_VOLUME_ITERATIONS = 10
 
+# side of the cells of the particle spatial index, in pixels
+INDEX_CELL_SIZE = 16
+
+# batched drawing (off by default, as on scripts/batch_draw_benchmark.py the
+# loop over particles is faster): the fewest particles worth stacking, and
+# the number of voxels evaluated at once (memory is ~20 doubles per voxel)
+BATCH_DRAW_MIN = 8
+BATCH_DRAW_VOXELS = 2**19
+
+# k-space rendering: most radius interpolation nodes, the refinement of the
+# grid the particles are spread onto, the half width of the spreading
+# gaussian in points of that grid (8 is accurate to ~1e-9), and the fewest
+# spread values computed at once
+KSPACE_MAX_NODES = 32
+KSPACE_OVERSAMPLE = 2
+KSPACE_SPREAD = 8
+KSPACE_CHUNK = 2**22
+
 
 #=============================================================================
 # Superclass for collections of particles
@@ -178,12 +196,20 @@ class PlatonicParticlesCollection(Component):
             raise ValueError('`param` passed as incorrect format')
 
 
+    def _draw_particles(self, inds, sign=1):
+        """
+        Draws (or un-draws if ``sign`` is -1) all the particles `inds` at
+        their current parameters. Subclasses may override this to draw many
+        particles at once.
+        """
+        args = self._drawargs()
+        for n in inds:
+            self._draw_particle(self.pos[n], *listify(args[n]), sign=sign)
+
     def initialize(self):
         """Start from scratch and initialize all objects / draw self.particles"""
         self.particles = np.zeros(self.shape.shape, dtype=self.float_precision)
-
-        for p0, arg0 in zip(self.pos, self._drawargs()):
-            self._draw_particle(p0, *listify(arg0))
+        self._draw_particles(np.arange(self.N))
 
     def get(self):
         return self.particles[self.tile.slicer]
@@ -265,15 +291,10 @@ class PlatonicParticlesCollection(Component):
         # otherwise, update individual particles. delete the current versions
         # of the particles update the particles, and redraw them anew at the
         # places given by (params, values)
-        oldargs = self._drawargs()
-        for n in particles:
-            self._draw_particle(self.pos[n], *listify(oldargs[n]), sign=-1)
-
+        particles = sorted(particles)
+        self._draw_particles(particles, sign=-1)
         self.set_values(params, values)
-
-        newargs = self._drawargs()
-        for n in particles:
-            self._draw_particle(self.pos[n], *listify(newargs[n]), sign=+1)
+        self._draw_particles(particles, sign=+1)
 
     def __str__(self):
         return "{} N={}".format(self.__class__.__name__, self.N)
@@ -293,9 +314,32 @@ def inner(r, p, a, zscale=1.0):
     n = norm(d)
     dhat = d / n[...,None]
 
-    o = norm((d - a*dhat)/s)
+    o = norm((d - np.asarray(a)[...,None]*dhat)/s)
     return o * np.sign(n - a)
 
+def inner_grad(r, p, a, zscale=1.0):
+    """
+    The signed distance to the sphere surface `inner` along with its
+    derivatives with respect to the sphere position `p` (shape [...,3]) and
+    radius `a`.
+    """
+    eps = np.array([1,1,1])*1e-8
+    s = np.array([zscale, 1.0, 1.0])
+
+    # with d = s(r-p), the distance is dr = (|d| - a) |dhat / s|
+    d = (r-p-eps)*s
+    n = norm(d)
+    dhat = d / n[...,None]
+    u = dhat / s
+    g = norm(u)
+    dr = (n - a) * g
+
+    # derivative of the direction dependent factor g = |dhat / s|
+    ud = (u*dhat/s).sum(axis=-1)
+    dg = s/(n*g)[...,None] * (dhat*ud[...,None] - u/s)
+    ddr_dp = -s*dhat*g[...,None] + (n - a)[...,None]*dg
+    return dr, ddr_dp, -g
+
 def sphere_bool(dr, a, alpha):
     return 1.0*(dr < 0)
 
@@ -314,6 +358,15 @@ def sphere_triangle_cdf(dr, a, alpha):
     return (1-np.clip(p0+p1, 0, 1))
 
 
+def sphere_lerp_grad(dr, a, alpha):
+    """ Derivatives of sphere_lerp wrt `dr` and `a` """
+    return -0.5/alpha*(np.abs(dr) < alpha), 0*dr
+
+def sphere_logistic_grad(dr, a, alpha):
+    """ Derivatives of sphere_logistic wrt `dr` and `a` """
+    p = sphere_logistic(dr, a, alpha)
+    return -alpha*p*(1-p), 0*dr
+
 def sphere_analytical_gaussian(dr, a, alpha=0.2765):
     """
     Analytically calculate the sphere's functional form by convolving the
@@ -327,6 +380,20 @@ def sphere_analytical_gaussian(dr, a, alpha=0.2765):
             )
     return term1 - term2
 
+def sphere_analytical_gaussian_grad(dr, a, alpha=0.2765):
+    """ Derivatives of sphere_analytical_gaussian wrt `dr` and `a` """
+    c = np.sqrt(0.5/np.pi)
+    e1 = np.exp(-0.5*dr**2/alpha**2)
+    e2 = np.exp(-0.5*(dr+2*a)**2/alpha**2)
+    q = dr+a+1e-10
+
+    dterm1_dr = c/alpha*(e2 - e1)
+    dterm1_da = 2*c/alpha*e2
+
+    dterm2_dr = c*alpha*((-dr*e1 + (dr+2*a)*e2)/(alpha**2*q) - (e1-e2)/q**2)
+    dterm2_da = c*alpha*(2*(dr+2*a)*e2/(alpha**2*q) - (e1-e2)/q**2)
+    return dterm1_dr - dterm2_dr, dterm1_da - dterm2_da
+
 def sphere_analytical_gaussian_trim(dr, a, alpha=0.2765, cut=1.6):
     """
     See sphere_analytical_gaussian_exact.
@@ -338,6 +405,7 @@ def sphere_analytical_gaussian_trim(dr, a, alpha=0.2765, cut=1.6):
 
     # only compute on the relevant scales
     rr = dr[m]
+    a = a[m] if np.ndim(a) else a
     t = -rr/(alpha*np.sqrt(2))
     q = 0.5*(1 + erf(t)) - np.sqrt(0.5/np.pi)*(alpha/(rr+a+1e-10)) * np.exp(-t*t)
 
@@ -348,40 +416,90 @@ def sphere_analytical_gaussian_trim(dr, a, alpha=0.2765, cut=1.6):
     ans[dr < -cut] = 1
     return ans
 
-def sphere_analytical_gaussian_fast(dr, a, alpha=0.2765, cut=1.20):
-    """
-    See sphere_analytical_gaussian_trim, but implemented in C with
-    fast erf and exp approximations found at
-        Abramowitz and Stegun: Handbook of Mathematical Functions
-        A Fast, Compact Approximation of the Exponential Function
+def sphere_analytical_gaussian_trim_grad(dr, a, alpha=0.2765, cut=1.6):
+    """ Derivatives of sphere_analytical_gaussian_trim wrt `dr` and `a` """
+    m = np.abs(dr) <= cut
 
-    The default cut 1.25 was chosen based on the accuracy of fast_erf
-    """
+    c = np.sqrt(0.5/np.pi)
+    rr = dr[m]
+    q = rr+(a[m] if np.ndim(a) else a)+1e-10
+    e = np.exp(-0.5*rr**2/alpha**2)
 
-    code = """
-    double coeff1 = 1.0/(alpha*sqrt(2.0));
-    double coeff2 = sqrt(0.5/pi)*alpha;
-
-    for (int i=0; i<N; i++){
-        double dri = dr[i];
-        if (dri < cut && dri > -cut){
-            double t = -dri*coeff1;
-            ans[i] = 0.5*(1+fast_erf(t)) - coeff2/(dri+a+1e-10) * fast_exp(-t*t);
-        } else {
-            ans[i] = 0.0*(dri > cut) + 1.0*(dri < -cut);
-        }
-    }
+    ddr, da = 0*dr, 0*dr
+    ddr[m] = e*(-c/alpha + c*alpha/q**2 + c*rr/(alpha*q))
+    da[m] = c*alpha*e/q**2
+    return ddr, da
+
+# largest error of the linear interpolation in the sphere profile tables
+PROFILE_TABLE_TOLERANCE = 1e-8
+_profile_tables = {}
+
+def _profile_table(alpha, cut):
+    """
+    Tables on [-cut, cut] of the two parts of sphere_analytical_gaussian_trim
+    which depend only on dr, f = (1 + erf(-dr/(alpha sqrt(2))))/2 and
+    g = alpha exp(-dr^2/(2 alpha^2)) / sqrt(2 pi), so that the profile is
+    f - g/(dr+a). The spacing h keeps the interpolation error h^2/8 max|f''|
+    below PROFILE_TABLE_TOLERANCE. Returns (h, f, df, g, dg).
     """
+    key = (float(alpha), float(cut))
+    if key not in _profile_tables:
+        c = np.sqrt(0.5/np.pi)
+        d2 = max(c*np.exp(-0.5)/alpha**2, c/alpha)
+        n = int(np.ceil(2*cut / np.sqrt(8*PROFILE_TABLE_TOLERANCE/d2))) + 1
+        x, h = np.linspace(-cut, cut, n, retstep=True)
+        f = 0.5*(1 + erf(-x/(alpha*np.sqrt(2))))
+        g = c*alpha*np.exp(-0.5*x**2/alpha**2)
+
+        # outside the cut the profile is exactly 1 or 0, as in the trim form
+        f[0], f[-1], g[0], g[-1] = 1.0, 0.0, 0.0, 0.0
+        _profile_tables[key] = (h, f, np.diff(f), g, np.diff(g))
+    return _profile_tables[key]
+
+def _profile_lookup(dr, a, alpha, cut):
+    """
+    The f, g parts of `_profile_table` on the shell |dr| <= cut, where the
+    profile is not simply 1 or 0. Returns the shell mask m, dr[m], f, g and
+    q = dr[m] + a. Near the centre of a sphere smaller than 2 cut, where
+    the table error in g would be amplified by 1/q, g is evaluated exactly.
+    """
+    h, f, df, g, dg = _profile_table(alpha, cut)
+    m = np.abs(dr) <= cut
+    rr = dr[m]
+    q = rr + (a[m] if np.ndim(a) else a) + 1e-10
 
-    shape = r.shape
-    r = r.flatten()
-    N = self.N
-    ans = r*0
-    pi = np.pi
+    # one index for all four tables; np.take beats fancy indexing here
+    u = (rr + cut) * (1.0/h)
+    i = np.minimum(u.astype('int'), df.size - 1)
+    u -= i
+    f = f.take(i) + u*df.take(i)
+    g = g.take(i) + u*dg.take(i)
 
-    inline(code, arg_names=['dr', 'a', 'alpha', 'cut', 'ans', 'pi', 'N'],
-            support_code=functions, verbose=0)
-    return ans.reshape(shape)
+    if np.min(a) < 2*cut:
+        near = q < cut
+        g[near] = np.sqrt(0.5/np.pi)*alpha*np.exp(-0.5*rr[near]**2/alpha**2)
+    return m, rr, f, g, q
+
+def sphere_analytical_gaussian_fast(dr, a, alpha=0.2765, cut=1.6):
+    """
+    See sphere_analytical_gaussian_trim, but with the erf and exp parts
+    read from a precomputed table with linear interpolation in dr (see
+    `_profile_table`) so that no special functions are evaluated per voxel.
+    Agrees with the trim form to about PROFILE_TABLE_TOLERANCE.
+    """
+    m, rr, f, g, q = _profile_lookup(dr, a, alpha, cut)
+    ans = 0*dr
+    ans[m] = f - g/q
+    ans[dr < -cut] = 1
+    return ans
+
+def sphere_analytical_gaussian_fast_grad(dr, a, alpha=0.2765, cut=1.6):
+    """ Derivatives of sphere_analytical_gaussian_fast wrt `dr` and `a` """
+    m, rr, f, g, q = _profile_lookup(dr, a, alpha, cut)
+    ddr, da = 0*dr, 0*dr
+    da[m] = g/q**2
+    ddr[m] = g*(rr/q - 1)/alpha**2 + da[m]
+    return ddr, da
 
 def sphere_constrained_cubic(dr, a, alpha):
     """
@@ -396,21 +514,54 @@ def sphere_constrained_cubic(dr, a, alpha):
     a, d = rscl + 0.5*sqrt3, rscl - 0.5*sqrt3
     return alpha*d*a*rscl + b_coeff*d*a - d/sqrt3
 
-try:
-    sphere_analytical_gaussian_fast(np.linspace(0,10,10), 5.0)
-except Exception as e:
-    sphere_analytical_gaussian_fast = sphere_analytical_gaussian_trim
+def sphere_constrained_cubic_grad(dr, a, alpha):
+    """ Derivatives of sphere_constrained_cubic wrt `dr` and `a` """
+    sqrt3 = np.sqrt(3)
+
+    k = 0.5/sqrt3*(1 - 0.6*sqrt3*alpha)
+    b_coeff = k*a/(0.15 + a*a)
+    db_coeff = k*(0.15 - a*a)/(0.15 + a*a)**2
+    rscl = np.clip(dr, -0.5*sqrt3, 0.5*sqrt3)
+
+    p, d = rscl + 0.5*sqrt3, rscl - 0.5*sqrt3
+    ddr = alpha*(p*rscl + d*rscl + d*p) + b_coeff*(p + d) - 1/sqrt3
+    return ddr*(np.abs(dr) < 0.5*sqrt3), db_coeff*d*p
+
+# draw methods whose profile is the smoothed sphere of `sphere_kspace`
+sphere_kspace_methods = [
+    'exact-gaussian', 'exact-gaussian-trim', 'exact-gaussian-fast'
+]
+
+# derivatives of the sphere functions wrt (dr, a), for analytic gradients
+sphere_gradients = {
+    sphere_lerp: sphere_lerp_grad,
+    sphere_logistic: sphere_logistic_grad,
+    sphere_analytical_gaussian: sphere_analytical_gaussian_grad,
+    sphere_analytical_gaussian_trim: sphere_analytical_gaussian_trim_grad,
+    sphere_analytical_gaussian_fast: sphere_analytical_gaussian_fast_grad,
+    sphere_constrained_cubic: sphere_constrained_cubic_grad,
+}
 
 def exact_volume_sphere(rvec, pos, radius, zscale=1.0, volume_error=1e-5,
-        function=sphere_analytical_gaussian, max_radius_change=1e-2, args=()):
+        function=sphere_analytical_gaussian, max_radius_change=1e-2, args=(),
+        return_radius=False, rprime=None, geometry=None):
     """
     Perform an iterative method to calculate the effective sphere that perfectly
-    (up to the volume_error) conserves volume.  Return the resulting image
+    (up to the volume_error) conserves volume.  Return the resulting image,
+    and the effective radius used to draw it if `return_radius` is True.
+    The iteration starts from the effective radius `rprime` if given (e.g.
+    from a `VolumeTable`), otherwise from `radius`. If `geometry` is given
+    as the (n, g) of a `DistanceCache`, it is used instead of `rvec`.
     """
     vol_goal = 4./3*np.pi*radius**3 / zscale
-    rprime = radius
+    rprime = radius if rprime is None else rprime
 
-    dr = inner(rvec, pos, rprime, zscale=zscale)
+    if geometry is None:
+        distance = lambda a: inner(rvec, pos, a, zscale=zscale)
+    else:
+        distance = lambda a: (geometry[0] - a)*geometry[1]
+
+    dr = distance(rprime)
     t = function(dr, rprime, *args)
     for i in xrange(MAX_VOLUME_ITERATIONS):
         vol_curr = np.abs(t.sum())
@@ -422,11 +573,555 @@ def exact_volume_sphere(rvec, pos, radius, zscale=1.0, volume_error=1e-5,
         if np.abs(rprime - radius)/radius > max_radius_change:
             break
 
-        dr = inner(rvec, pos, rprime, zscale=zscale)
+        dr = distance(rprime)
         t = function(dr, rprime, *args)
 
+    if return_radius:
+        return t, rprime
     return t
 
+def _sphere_stack(rvec, pos, radius, mask, zscale, function, args):
+    """ Sphere profiles of M spheres on stacked boxes, zero outside `mask` """
+    a = radius[:,None,None,None]
+    dr = inner(rvec, pos[:,None,None,None,:], a, zscale=zscale)
+    return function(dr, a*np.ones_like(dr), *args) * mask
+
+def exact_volume_spheres(rvec, pos, radius, mask, zscale=1.0,
+        volume_error=1e-5, function=sphere_analytical_gaussian,
+        max_radius_change=1e-2, args=(), rprime=None):
+    """
+    Batched `exact_volume_sphere` for M spheres drawn on boxes of the same
+    shape, stacked along the first axis: `rvec` is [M,Z,Y,X,3], `pos` [M,3],
+    `radius` [M] and `mask` [M,Z,Y,X] is True for the voxels inside the
+    field, which are the only ones counted towards the volume (as with the
+    clipped tiles of `exact_volume_sphere`). Each sphere follows the same
+    iteration as it would alone, starting from `rprime` [M] if given.
+    """
+    radius = np.asarray(radius, dtype='float')
+    vol_goal = 4./3*np.pi*radius**3 / zscale
+    rprime = np.array(radius if rprime is None else rprime, dtype='float')
+    axes = tuple(xrange(1, mask.ndim))
+
+    t = _sphere_stack(rvec, pos, rprime, mask, zscale, function, args)
+    active = np.arange(radius.size)
+    for i in xrange(MAX_VOLUME_ITERATIONS):
+        vol_curr = np.abs(t[active].sum(axis=axes))
+        goal = vol_goal[active]
+        unconverged = np.abs(goal - vol_curr)/goal >= volume_error
+        active, vol_curr = active[unconverged], vol_curr[unconverged]
+        if active.size == 0:
+            break
+
+        rprime[active] += 1.0*(vol_goal[active] - vol_curr) / (
+                4*np.pi*rprime[active]**2)
+        active = active[np.abs(rprime[active] - radius[active]) /
+                radius[active] <= max_radius_change]
+        if active.size == 0:
+            break
+
+        t[active] = _sphere_stack(rvec[active], pos[active], rprime[active],
+                mask[active], zscale, function, args)
+    return t
+
+def sphere_kspace(q, a, alpha=0.2765):
+    """
+    Fourier transform at wavenumbers `q` of a sphere of radius `a` smoothed
+    by a gaussian of width `alpha`, which in real space is the profile of
+    sphere_analytical_gaussian. Its value at q = 0 is exactly the volume
+    4/3 pi a^3.
+    """
+    x = q*a
+    small = x < 1e-3
+    xs = np.where(small, 1.0, x)
+    form = np.where(small, 1 - x**2/10., 3*(np.sin(xs) - xs*np.cos(xs))/xs**3)
+    return 4./3*np.pi*a**3 * form * np.exp(-0.5*(q*alpha)**2)
+
+def _lagrange_weights(x, lo, hi, n):
+    """
+    Chebyshev nodes [n] on [lo, hi] and the weights [len(x), n] of the
+    Lagrange interpolation at `x` from them.
+    """
+    if n == 1:
+        return np.array([lo]), np.ones((x.size, 1))
+    nodes = lo + (hi - lo)*(np.cos(np.pi*np.arange(n)/(n-1)) + 1)/2
+    bw = (-1.0)**np.arange(n)
+    bw[0], bw[-1] = 0.5*bw[0], 0.5*bw[-1]
+
+    diff = x[:,None] - nodes[None,:]
+    exact = diff == 0
+    diff[exact] = 1
+    L = bw / diff
+    L /= L.sum(axis=1)[:,None]
+    rows = exact.any(axis=1)
+    L[rows] = exact[rows]
+    return nodes, L
+
+def _spread_gaussian(pos, fine, tau):
+    """
+    Values of the gaussian exp(-d**2 / (4 tau)) around each point of `pos`
+    [M,3] (in pixels) at the 2*KSPACE_SPREAD nearest points along each axis
+    of a periodic grid `fine`, KSPACE_OVERSAMPLE times finer than the pixels.
+    Returns the flat indices into the grid and the values, both [M,K].
+    """
+    R = KSPACE_OVERSAMPLE
+    offsets = np.arange(1 - KSPACE_SPREAD, KSPACE_SPREAD + 1)
+    inds, vals = [], []
+    for i in xrange(3):
+        l = np.floor(R*pos[:,i]).astype('int')[:,None] + offsets[None,:]
+        vals.append(np.exp(-(l/float(R) - pos[:,i,None])**2 / (4*tau)))
+        inds.append(l % fine[i])
+
+    flat = ((inds[0][:,:,None,None]*fine[1] + inds[1][:,None,:,None])*fine[2]
+            + inds[2][:,None,None,:])
+    value = (vals[0][:,:,None,None] * vals[1][:,None,:,None] *
+            vals[2][:,None,None,:])
+    return flat.reshape(pos.shape[0], -1), value.reshape(pos.shape[0], -1)
+
+#=============================================================================
+# Lookup table of exact volume radii
+#=============================================================================
+class VolumeTable(object):
+    def __init__(self, function, args=(), zscale=1.0, support_pad=4,
+            volume_error=1e-5, max_radius_change=1e-2, rstep=0.25,
+            ostep=0.25, rmax=64.0):
+        """
+        Table of the effective radius r'(r, offset) which `exact_volume_sphere`
+        converges to for a sphere of radius r whose center is `offset` from
+        the nearest voxel, for one sphere function and zscale. Nodes are
+        spaced by `rstep` in radius and `ostep` in each component of the
+        offset, which by symmetry only runs over [0, 0.5]. They are computed
+        the first time they are needed and interpolated multilinearly. The
+        interpolated radius is only good to a few 1e-4 in volume, short of
+        the usual `volume_error`, so it is a starting point for the exact
+        volume iteration rather than a replacement for it.
+
+        Parameters
+        ----------
+        function : callable
+            The sphere function, `function(dr, a, *args)`
+
+        args : tuple
+            Extra arguments of the sphere function
+
+        zscale, support_pad, volume_error, max_radius_change :
+            As in :class:`PlatonicSpheresCollection`
+
+        rstep, ostep : float
+            Spacing of the table nodes in radius and offset
+
+        rmax : float
+            Largest radius in the table. Radii outside [0, rmax] (e.g. the
+            negative radii an optimizer may try) are not looked up, and
+            their effective radius is the radius itself.
+        """
+        self.function = function
+        self.args = tuple(args)
+        self.zscale = zscale
+        self.support_pad = support_pad
+        self.volume_error = volume_error
+        self.max_radius_change = max_radius_change
+        self.rstep = rstep
+        self.ostep = ostep
+        self.rmax = rmax
+
+        self.noff = int(np.round(0.5 / ostep)) + 1
+        self.table = np.zeros((0,) + (self.noff,)*3)
+
+    def _node(self, ir, io):
+        """ Effective radius at radius node `ir`, offset node `io` """
+        r = ir * self.rstep
+        if r == 0:
+            return 0.0
+        zsc = np.array([1.0/self.zscale, 1, 1])
+        h = np.round(zsc*np.ceil(r) + self.support_pad)
+        rvec = Tile(-h, h).coords(form='vector')
+        _, rprime = exact_volume_sphere(rvec, np.array(io)*self.ostep, r,
+                zscale=self.zscale, volume_error=self.volume_error,
+                function=self.function, args=self.args,
+                max_radius_change=self.max_radius_change, return_radius=True)
+        return rprime
+
+    def _fill(self, ir, io):
+        """ Compute any of the nodes (ir, io) not yet in the table """
+        n = ir.max() + 1
+        if n > self.table.shape[0]:
+            grow = np.nan*np.ones((n - self.table.shape[0],) + self.table.shape[1:])
+            self.table = np.concatenate([self.table, grow])
+        missing = np.isnan(self.table[ir, io[:,0], io[:,1], io[:,2]])
+        for node in set(zip(ir[missing], *io[missing].T)):
+            self.table[node] = self._node(node[0], node[1:])
+
+    def __call__(self, rad, pos):
+        """
+        Effective radii of spheres with radii `rad` [N] at positions `pos`
+        [N,3] on the pixel grid, or the radii themselves where they are
+        outside the table.
+        """
+        rad = np.atleast_1d(rad).astype('float')
+        pos = np.reshape(pos, (-1, 3))
+        with np.errstate(invalid='ignore'):
+            inside = (rad >= 0) & (rad <= self.rmax)
+        if not inside.all():
+            out = rad.copy()
+            if inside.any():
+                out[inside] = self(rad[inside], pos[inside])
+            return out
+
+        u = rad / self.rstep
+        ir = np.floor(u).astype('int')
+        u -= ir
+        v = np.abs(pos - np.round(pos)) / self.ostep
+        io = np.minimum(np.floor(v).astype('int'), self.noff-2)
+        v -= io
+
+        out = np.zeros(rad.shape)
+        for corner in itertools.product([0, 1], repeat=4):
+            w = u if corner[0] else 1 - u
+            for i in xrange(3):
+                w = w * (v[:,i] if corner[i+1] else 1 - v[:,i])
+            cr, co = ir + corner[0], io + np.array(corner[1:])
+            self._fill(cr, co)
+            out += w * self.table[cr, co[:,0], co[:,1], co[:,2]]
+        return out
+
+#=============================================================================
+# Cache of pre-rendered particles
+#=============================================================================
+class StampCache(object):
+    def __init__(self, render, max_bytes=2**28, rstep=0.05, ostep=0.1,
+            tolerance=0.01):
+        """
+        LRU cache of pre-rendered particle stamps, keyed by radius and
+        subpixel offset quantized to steps of `rstep` and `ostep` and by the
+        half-size of the drawing tile. A particle whose radius and offset
+        are all within `tolerance` of a node is drawn by blending the 16
+        stamps around it multilinearly; otherwise `stamp` returns None and
+        the particle should be drawn exactly.
+
+        The blend is linear between nodes, so its error grows with the
+        distance to the node and with the steps. With the default steps a
+        blended particle differs from the exact one by up to about 2.5e-3 (of
+        a unit contrast) at the default tolerance, and up to about 5e-3
+        midway between nodes. A particle whose stamps are not cached yet
+        renders all of the (up to 16) stamps around it exactly, so the first
+        draws near new nodes cost more than an exact draw.
+
+        Parameters
+        ----------
+        render : callable
+            ``render(rad, offset, half)`` returns the stamp of a particle of
+            radius `rad` at `offset` [3] from the center voxel of a tile of
+            shape ``2*half``
+
+        max_bytes : int
+            Memory budget of the cached stamps. The least recently used
+            stamps are evicted beyond it.
+
+        rstep, ostep : float
+            Quantization steps of the radius and offset, in pixels
+
+        tolerance : float
+            Largest distance from a node in any of radius and offset, in
+            pixels, for which the stamps are used. It should be below half
+            of both steps, or every particle is blended.
+        """
+        self.render = render
+        self.max_bytes = max_bytes
+        self.steps = np.array([rstep, ostep, ostep, ostep], dtype='float')
+        self.tolerance = tolerance
+
+        self.stamps = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions, self.fallbacks = 0, 0, 0, 0
+        self.rendered = 0
+
+    def _get(self, key):
+        """The stamp of node `key`, and whether it was already cached"""
+        cached = key in self.stamps
+        if cached:
+            stamp = self.stamps.pop(key)
+        else:
+            self.rendered += 1
+            stamp = self.render(key[0]*self.steps[0],
+                    np.array(key[1:4])*self.steps[1:], np.array(key[4:]))
+            self.nbytes += stamp.nbytes
+            while self.stamps and self.nbytes > self.max_bytes:
+                _, old = self.stamps.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+        self.stamps[key] = stamp
+        return stamp, cached
+
+    def stamp(self, rad, offset, half):
+        """
+        The blended stamp of a particle with radius `rad` at `offset` from
+        the center voxel of a tile of half-size `half`, or None if it is not
+        within the tolerance of the cached nodes.
+        """
+        q = np.hstack([rad, offset]) / self.steps
+        if (np.abs(q - np.round(q))*self.steps).max() > self.tolerance:
+            self.fallbacks += 1
+            return None
+
+        i0 = np.floor(q).astype('int')
+        w = q - i0
+        half = tuple(np.asarray(half, dtype='int').tolist())
+        out, hit = 0, True
+        for corner in itertools.product([0, 1], repeat=4):
+            wc = np.prod(np.where(corner, w, 1 - w))
+            if wc != 0:
+                key = tuple((i0 + corner).tolist()) + half
+                stamp, cached = self._get(key)
+                out = out + wc*stamp
+                hit = hit and cached
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return out
+
+    def stats(self):
+        """
+        Counts of particle draws whose stamps were all in the cache (hits),
+        draws which rendered any of their stamps (misses) and draws outside
+        the tolerance (fallbacks), and of stamps rendered and evicted, with
+        the number and size of the cached stamps.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'fallbacks': self.fallbacks, 'rendered': self.rendered,
+                'evictions': self.evictions, 'stamps': len(self.stamps),
+                'nbytes': self.nbytes}
+
+#=============================================================================
+# Cache of particle distance fields
+#=============================================================================
+class DistanceCache(object):
+    def __init__(self, max_bytes=2**28):
+        """
+        LRU cache of the geometry of particles' drawing tiles, so that
+        redrawing a particle whose position has not changed does not need to
+        recompute its distance field. For a particle at `pos` drawn on a
+        tile with coordinates `r`, it keeps the offsets ``r - pos`` and, for
+        the current zscale, the distance ``n = |s (r - pos)|`` with ``s =
+        (zscale, 1, 1)`` and the direction factor ``g = |dhat / s|``, so
+        that the signed distance to a sphere of radius `a` is just ``(n - a)
+        g`` (see `inner`). A change of radius then only needs the profile,
+        and a change of zscale only rescales the cached offsets. Entries are
+        keyed by position, so moving a particle never uses stale entries;
+        `discard` frees them early.
+
+        Parameters
+        ----------
+        max_bytes : int
+            Memory budget of the cache, beyond which the least recently
+            used entries are evicted.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.rescales, self.evictions = 0, 0, 0, 0
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= sum(a.nbytes for a in entry[2:3] + entry[4:])
+        return entry
+
+    def discard(self, pos):
+        """ Drop the entries of particles at positions `pos` [N,3] """
+        for p in np.reshape(pos, (-1, 3)).tolist():
+            self._pop(tuple(p))
+
+    def get(self, pos, tile, zscale):
+        """
+        The (n, g) of a particle at (translated) `pos` [3] drawn on `tile`
+        with the given zscale.
+        """
+        key = tuple(np.asarray(pos, dtype='float').tolist())
+        entry = self._pop(key)
+        if (entry is None or (entry[0] != tile.l).any() or
+                (entry[1] != tile.r).any()):
+            self.misses += 1
+            eps = np.array([1,1,1])*1e-8
+            delta = tile.coords(form='vector') - pos - eps
+            entry = [tile.l.copy(), tile.r.copy(), delta, None, None, None]
+        else:
+            self.hits += 1
+            self.rescales += entry[3] != zscale
+
+        if entry[3] != zscale:
+            s = np.array([zscale, 1.0, 1.0])
+            d = entry[2]*s
+            n = norm(d)
+            entry[3:] = [zscale, n, norm(d / n[...,None] / s)]
+
+        self.entries[key] = entry
+        self.nbytes += sum(a.nbytes for a in entry[2:3] + entry[4:])
+        while len(self.entries) > 1 and self.nbytes > self.max_bytes:
+            self._pop(next(iter(self.entries)))
+            self.evictions += 1
+        return entry[4], entry[5]
+
+    def stats(self):
+        """
+        Counts of lookups found in the cache (hits, of which rescales had a
+        new zscale), computed from scratch (misses) and evicted entries,
+        with the number and size of the entries.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'rescales': self.rescales, 'evictions': self.evictions,
+                'entries': len(self.entries), 'nbytes': self.nbytes}
+
+#=============================================================================
+# Spatial index of particle positions
+#=============================================================================
+class CellList(object):
+    def __init__(self, pos, cell_size=INDEX_CELL_SIZE):
+        """
+        Cell list of particle positions, bucketing the particles into cubic
+        cells of side `cell_size` so that range and nearest neighbor queries
+        only look at the particles in nearby cells. Particles are referred to
+        by their index, and the list is updated incrementally as particles
+        move, are added or removed.
+
+        Parameters
+        ----------
+        pos : ndarray [N, 3]
+            Initial positions of the particles
+
+        cell_size : float
+            Side length of the cells, in pixels. Should be about the size of
+            a particle's update tile.
+        """
+        self.cell_size = float(cell_size)
+        self.cells = defaultdict(set)
+        self.keys = []
+        self.append(pos)
+
+    def _keys(self, pos):
+        pos = np.reshape(pos, (-1, 3))
+        return map(tuple, np.floor(pos / self.cell_size).astype('int').tolist())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, pos):
+        """Add particles at `pos` with the next indices"""
+        n = len(self.keys)
+        for i, key in enumerate(self._keys(pos)):
+            self.cells[key].add(n + i)
+            self.keys.append(key)
+
+    def move(self, inds, pos):
+        """Update the positions of particles `inds` to `pos`"""
+        for i, key in zip(listify(inds), self._keys(pos)):
+            old = self.keys[i]
+            if key == old:
+                continue
+            self._discard(old, i)
+            self.cells[key].add(i)
+            self.keys[i] = key
+
+    def _discard(self, key, i):
+        cell = self.cells[key]
+        cell.discard(i)
+        if not cell:
+            del self.cells[key]
+
+    def compact(self, gone, holes, tail):
+        """
+        Remove particles `gone` and move the particles `tail` into the
+        indices `holes`, mirroring the compaction of the particle arrays.
+        """
+        for i in gone:
+            self._discard(self.keys[i], i)
+        for h, t in zip(holes, tail):
+            key = self.keys[t]
+            self._discard(key, t)
+            self.cells[key].add(h)
+            self.keys[h] = key
+        del self.keys[len(self.keys) - len(gone):]
+
+    def _gather(self, lo, hi):
+        """Indices of the particles in the cells from `lo` to `hi` inclusive"""
+        lo, hi = np.asarray(lo), np.asarray(hi)
+        ncells = np.prod(np.clip(hi - lo + 1, 0, None))
+        out = []
+        if ncells <= len(self.cells):
+            for key in itertools.product(*[xrange(a, b+1) for a, b in zip(lo, hi)]):
+                if key in self.cells:
+                    out.extend(self.cells[key])
+        else:
+            for key, cell in self.cells.iteritems():
+                if all(a <= k <= b for a, k, b in zip(lo, key, hi)):
+                    out.extend(cell)
+        return np.array(out, dtype='int')
+
+    def query_tile(self, l, r, pos):
+        """
+        Indices of the particles with `l` <= position < `r`, in the same
+        sense as :func:`peri.util.Tile.contains`.
+
+        Parameters
+        ----------
+        l, r : ndarray [3]
+            Left and right corners of the region
+
+        pos : ndarray [N, 3]
+            Current positions of the particles, for the exact test
+
+        Returns
+        -------
+        inds : ndarray
+            Sorted indices of the particles in the region
+        """
+        lo = np.floor(np.asarray(l, dtype='float') / self.cell_size)
+        hi = np.floor(np.asarray(r, dtype='float') / self.cell_size)
+        inds = np.sort(self._gather(lo.astype('int'), hi.astype('int')))
+        p = pos[inds]
+        return inds[((p >= l) & (p < r)).all(axis=-1)]
+
+    def query_nearest(self, x, pos, k=1):
+        """
+        Indices of the `k` particles closest to `x`, nearest first.
+
+        Parameters
+        ----------
+        x : ndarray [3]
+            Point to search around
+
+        pos : ndarray [N, 3]
+            Current positions of the particles, for the exact distances
+
+        k : int
+            Number of neighbors to return, at most the number of particles
+        """
+        x = np.asarray(x, dtype='float').reshape(3)
+        k = min(k, len(self.keys))
+        if k == 0:
+            return np.zeros(0, dtype='int')
+        c = np.floor(x / self.cell_size).astype('int')
+
+        # grow a cube of cells until it holds k particles; the kth closest
+        # of those bounds the distance that has to be searched exactly
+        ring = 0
+        while True:
+            inds = self._gather(c - ring, c + ring)
+            if inds.size >= k:
+                break
+            if (2*ring + 1)**3 > len(self.cells):
+                inds = np.arange(len(self.keys))
+                break
+            ring += 1
+        d2 = ((pos[inds] - x)**2).sum(axis=-1)
+        dk = np.sqrt(np.partition(d2, k-1)[k-1])
+
+        inds = self._gather(np.floor((x - dk) / self.cell_size).astype('int'),
+                np.floor((x + dk) / self.cell_size).astype('int'))
+        d2 = ((pos[inds] - x)**2).sum(axis=-1)
+        order = np.lexsort((inds, d2))[:k]
+        return inds[order]
+
 #=============================================================================
 # Actual sphere collection (and slab)
 #=============================================================================
@@ -435,7 +1130,10 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
             method='exact-gaussian-fast', alpha=None, user_method=None,
             exact_volume=True, volume_error=1e-5, max_radius_change=1e-2,
             param_prefix='sph', grouping='particle', category='obj',
-            float_precision=np.float64):
+            float_precision=np.float64, batch_draw=False, draw_workers=1,
+            volume_table=False,
+            stamp_cache=0, stamp_step=(0.05, 0.1), stamp_tolerance=0.01,
+            distance_cache=0, render='real'):
         """
         A collection of spheres in real-space with positions and radii, drawn
         not necessarily on a uniform grid (i.e. scale factor associated with
@@ -491,6 +1189,52 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
             maximum relative radius change allowed during iteration (due to
             edge particles and other confounding factors)
 
+        volume_table : boolean
+            whether to start the exact volume iteration from the effective
+            radius in a `VolumeTable`. The volume is still checked against
+            `volume_error` on every draw. Off by default: the interpolated
+            radius is only good to a few 1e-4 in volume, so the iteration
+            still takes about two steps and the lookup costs more than it
+            saves.
+
+        stamp_cache : int
+            Memory budget in bytes of a `StampCache` of pre-rendered particles
+            used for drawing, which pays off for nearly monodisperse samples.
+            Particle gradients are then finite differences of the blended
+            stamps rather than analytic. Default is 0, drawing every
+            particle exactly.
+
+        stamp_step : tuple (float, float)
+            Quantization steps of the radius and subpixel offset of the
+            stamps, in pixels
+
+        stamp_tolerance : float
+            Particles further than this (in pixels) from the nearest stamp
+            node in radius or offset are drawn exactly; it should be below
+            half of both steps. The blended particles are accurate to about
+            2.5e-3 with the defaults (see `StampCache`). See `stamp_stats` for
+            the hit rate to tune this and the steps.
+
+        distance_cache : int
+            Memory budget in bytes of a `DistanceCache` of the particles'
+            distance fields, which speeds up updates of only radii or
+            zscale. Default is 0, computing the distances on every draw.
+
+        render : string
+            How the whole field is drawn on initialize (and so on zscale and
+            shape changes). 'real' rasterizes every particle. 'fourier' sums
+            the analytic transforms of the spheres (see `sphere_kspace`),
+            whose volumes are then exact without iterating, and inverse
+            transforms once. This is the gaussian smoothed sphere of the
+            'exact-gaussian' methods, which it requires, sampled without
+            aliasing, so it is not the rasterized field: the two differ by
+            up to about 0.2 at the particle edges. Its band-limited profile
+            also rings far outside the particle, so it cannot be undrawn
+            locally. 'fourier' is therefore only a preview renderer: moving,
+            resizing, adding or removing particles raises a ValueError, and
+            an ImageState still convolves the field in real space rather
+            than using `get_kspace`. Use 'real' to fit.
+
         grouping : string
             Either 'particle' or 'parameter' parameter grouping. If 'particle'
             then grouped by xyza,xyza if 'parameter' then xyz,xyz,a,a
@@ -500,6 +1244,20 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
             for precomputed arrays. Default is np.float64; make it 16 or 32
             to save memory.
 
+        batch_draw : boolean
+            Whether particles redrawn together, e.g. on initialize or a
+            zscale update, are evaluated in batches on stacked arrays
+            rather than one at a time. Batching is slower than the loop on
+            ``scripts/batch_draw_benchmark.py``, so only turn it on where
+            that benchmark shows a gain. Default is False.
+
+        draw_workers : int
+            With `batch_draw`, the number of threads used when many
+            particles are redrawn at once. Each thread draws the particles
+            of a z-slab of the image, and slabs which are adjacent are drawn
+            in separate passes so that no two threads write to the same
+            voxels. Default is 1.
+
         """
         if isinstance(rad, (float, int)):
             rad = rad*np.ones(pos.shape[0])
@@ -515,13 +1273,244 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         self.max_radius_change = max_radius_change
         self.user_method = user_method
         self.grouping = grouping
+        self.batch_draw = batch_draw
+        self.draw_workers = draw_workers
+        self.volume_table = volume_table
+        self.stamp_cache = stamp_cache
+        self.stamp_step = stamp_step
+        self.stamp_tolerance = stamp_tolerance
+        self.distance_cache = distance_cache
+        self.render = render
 
         self.set_draw_method(method=method, alpha=alpha, user_method=user_method)
+        if render not in ('real', 'fourier'):
+            raise ValueError("render must be one of 'real', 'fourier'")
+        if render == 'fourier' and method not in sphere_kspace_methods:
+            raise ValueError('fourier rendering requires one of the methods '
+                    '%r' % sphere_kspace_methods)
 
         super(PlatonicSpheresCollection, self).__init__(pos=pos, shape=shape,
                 param_prefix=param_prefix, category=category, support_pad=
                 support_pad, float_precision=float_precision)
 
+    # pos, rad and the stable particle ids are views of the first N rows of
+    # buffers which grow by doubling, so adding particles is amortized O(1)
+    @property
+    def pos(self):
+        return self._pos[:self._N]
+
+    @pos.setter
+    def pos(self, pos):
+        pos = np.array(pos, dtype='float')
+        if getattr(self, '_rad', None) is not None and (
+                self._rad.shape[0] < pos.shape[0]):
+            raise ValueError('pos has more particles than rad')
+        self._pos = pos
+        self._N = self._pos.shape[0]
+        self._ids = np.arange(self._N)
+        self._next_id = self._N
+        self._index = None
+
+    @property
+    def rad(self):
+        return self._rad[:self._N]
+
+    @rad.setter
+    def rad(self, rad):
+        rad = np.array(rad, dtype='float')
+        if getattr(self, '_pos', None) is None:
+            # set before the positions, which then define N
+            self._rad = rad
+            self._N = rad.shape[0]
+            return
+        if rad.shape[0] != self._N:
+            raise ValueError('rad must have one entry per particle')
+        if getattr(self, '_rad', None) is not None and (
+                self._rad.shape[0] >= self._N):
+            self._rad[:self._N] = rad
+        else:
+            self._rad = rad
+
+    @property
+    def N(self):
+        return self._N
+
+    def _reserve(self, n):
+        """Grows the particle buffers to hold at least `n` particles"""
+        names = ['_pos', '_rad', '_ids']
+        cap = min(getattr(self, name).shape[0] for name in names)
+        if n <= cap:
+            return
+        cap = max(n, 2*cap, 16)
+        for name in names:
+            old = getattr(self, name)
+            if old.shape[0] >= cap:
+                continue
+            new = np.zeros((cap,) + old.shape[1:], dtype=old.dtype)
+            new[:self._N] = old[:self._N]
+            setattr(self, name, new)
+
+    def get_ids(self):
+        """
+        Stable ids of the particles, which unlike their indices do not change
+        when other particles are added or removed.
+        """
+        return self._ids[:self._N].copy()
+
+    def ids_to_inds(self, ids):
+        """The current indices of the particles `ids`, -1 if removed"""
+        ids = np.atleast_1d(ids)
+        cur = self._ids[:self._N]
+        if cur.size == 0:
+            return -np.ones(ids.size, dtype='int')
+        order = np.argsort(cur)
+        j = np.clip(np.searchsorted(cur, ids, sorter=order), 0, cur.size-1)
+        inds = order[j]
+        inds[cur[inds] != ids] = -1
+        return inds
+
+    @property
+    def index(self):
+        """Spatial index of the particle positions, built on first use"""
+        if getattr(self, '_index', None) is None:
+            self._index = CellList(self.pos)
+        return self._index
+
+    def particles_in_tile(self, tile):
+        """
+        Indices of the particles whose positions are inside `tile`, the same
+        as ``np.nonzero(tile.contains(self.pos))[0]`` but only looking at
+        particles near the tile.
+        """
+        return self.index.query_tile(tile.l, tile.r, self.pos)
+
+    def nearest_particles(self, x, k=1):
+        """Indices of the `k` particles closest to `x`, nearest first"""
+        return self.index.query_nearest(x, self.pos, k=k)
+
+    def closest_particle(self, x):
+        """ Get the index of the particle closest to vector `x` """
+        return self.nearest_particles(x, k=1)[0]
+
+    def initialize(self):
+        # positions may have been edited in place since the index was built
+        self._index = None
+        if getattr(self, 'render', 'real') == 'fourier':
+            self.particles = np.zeros(self.shape.shape,
+                    dtype=self.float_precision)
+            self._draw_kspace()
+        else:
+            super(PlatonicSpheresCollection, self).initialize()
+
+    def _kspace_extent(self):
+        """ Largest distance from a particle's center to its drawn edge """
+        rmax = self.rad.max() if self.N > 0 else 0.0
+        zsc = np.array([1.0/self.zscale, 1, 1])
+        return np.ceil(zsc*rmax).astype('int') + self.support_pad
+
+    def _kspace_sum(self, shape, pos, rad, real=True):
+        """
+        Sum of the analytic transforms of the particles at `pos`, relative to
+        the origin of a periodic grid of `shape`, with radii `rad`, on the
+        numpy.fft.rfftn grid if `real` else the fftn grid. The dependence on
+        radius is interpolated from Chebyshev nodes in radius. For each node,
+        the sum of the particles' phase factors is a non-uniform FFT: the
+        particles are spread with a gaussian onto a finer grid, which is
+        transformed and then divided by the transform of the gaussian
+        (Greengard & Lee, SIAM Review 46, 443 (2004)). The cost is
+        O(N + V log V) per node for N particles and V voxels, and the
+        memory that of a grid KSPACE_OVERSAMPLE**3 times larger than `shape`.
+        """
+        shape = tuple(int(n) for n in shape)
+        kz, ky = [2*np.pi*np.fft.fftfreq(n) for n in shape[:2]]
+        kx = 2*np.pi*(np.fft.rfftfreq(shape[2]) if real else
+                np.fft.fftfreq(shape[2]))
+        q = np.sqrt((kz[:,None,None]/self.zscale)**2 + ky[None,:,None]**2 +
+                kx[None,None,:]**2)
+
+        out = np.zeros(q.shape, dtype='complex')
+        if rad.size == 0:
+            return out
+
+        lo, hi = rad.min(), rad.max()
+        n = 1 if hi - lo < 1e-10 else 6 + int(np.ceil(q.max()*(hi - lo)/2))
+        if n > KSPACE_MAX_NODES:
+            warnings.warn('Radii %f to %f need %i interpolation nodes but '
+                    'KSPACE_MAX_NODES is %i, so the k-space field is '
+                    'inaccurate' % (lo, hi, n, KSPACE_MAX_NODES),
+                    RuntimeWarning)
+            n = KSPACE_MAX_NODES
+        nodes, L = _lagrange_weights(rad, lo, hi, n)
+
+        # the fine grid and the gaussian, and the factors which remove the
+        # gaussian from the wavenumbers of `shape` in its transform
+        R = KSPACE_OVERSAMPLE
+        fine = tuple(R*np.array(shape))
+        tau = KSPACE_SPREAD / (4*np.pi*R*(R - 0.5))
+        freqs, deconv = [], []
+        for i, k in enumerate([kz, ky, kx]):
+            freqs.append(np.round(k*shape[i]/(2*np.pi)).astype('int'))
+            deconv.append(np.exp(k**2*tau) / (R*np.sqrt(4*np.pi*tau)))
+        deconv = (deconv[0][:,None,None] * deconv[1][None,:,None] *
+                deconv[2][None,None,:])
+
+        # the spread grid is real, so the negative x wavenumbers of the
+        # fftn layout are the conjugates of the opposite positive ones
+        mz, my, mx = freqs
+        pos_picks = np.ix_(mz % fine[0], my % fine[1], np.abs(mx))
+        neg_picks = np.ix_(-mz % fine[0], -my % fine[1], np.abs(mx))
+        negative = (mx < 0)[None,None,:]
+
+        # spread at least as many values at once as the grid has points, so
+        # that summing each batch onto the grid costs no more than spreading
+        size = int(np.prod(fine))
+        step = max(1, max(KSPACE_CHUNK, size) // (2*KSPACE_SPREAD)**3)
+        for m in xrange(n):
+            grid = np.zeros(size)
+            for i in xrange(0, rad.size, step):
+                flat, value = _spread_gaussian(pos[i:i+step], fine, tau)
+                grid += np.bincount(flat.ravel(), weights=(value *
+                        L[i:i+step, m, None]).ravel(), minlength=size)
+            sm = fft.rfftn(grid.reshape(fine), **fftkwargs)
+            if negative.any():
+                sm = np.where(negative, np.conj(sm[neg_picks]), sm[pos_picks])
+            else:
+                sm = sm[pos_picks]
+            sm *= deconv
+            out += sphere_kspace(q, nodes[m], self.alpha[0]) / self.zscale * sm
+        return out
+
+    def _draw_kspace(self):
+        """
+        Draw all particles with a single inverse transform, on a grid
+        padded enough that the periodic images of particles near the edges
+        do not wrap into the field.
+        """
+        pos, rad = self._trans(self.pos), self.rad
+        shape, ext = np.array(self.shape.shape), self._kspace_extent()
+        keep = ((pos >= -ext) & (pos < shape + ext)).all(axis=-1) & (rad > 0)
+
+        margin = 2*ext
+        grid = tuple(shape + 2*margin)
+        pk = self._kspace_sum(grid, pos[keep] + margin, rad[keep])
+        field = fft.irfftn(pk, s=grid, **fftkwargs)
+        self.particles += field[Tile(margin, margin + shape).slicer]
+
+    def get_kspace(self, tile=None):
+        """
+        Analytic Fourier transform, in the numpy.fft.fftn layout, of the
+        particle field on `tile` (default the current tile) taken as
+        periodic. For a PSF which is a multiply in k-space, H(P) is then
+        ``psf.execute(obj.get_kspace())``, with no rasterization. This is
+        for previews and benchmarks: ImageState does not use it, as it is
+        the transform of the 'fourier' field rather than the rasterized one.
+        """
+        tile = self.tile if tile is None else tile
+        pos, rad = self._trans(self.pos), self.rad
+        keep = tile.contains(pos, pad=self._kspace_extent()) & (rad > 0)
+        return self._kspace_sum(tuple(tile.shape), pos[keep] - tile.l,
+                rad[keep], real=False)
+
     def _drawargs(self):
         return self.rad
 
@@ -536,36 +1525,74 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
             for i, (p0, r0) in enumerate(zip(self.pos, self.rad)):
                 self._params.extend([self._i2p(i, c) for c in ['z','y','x','a']])
         self._params += ['zscale']
+        # hash of name -> position in self._params, replacing name parsing
+        self._pindex = dict(zip(self._params, xrange(len(self._params))))
+
+    def _local_to_ind(self, inds):
+        """
+        Positions in self.params to (particle index, column) arrays, where
+        columns 0-2 are z,y,x, 3 the radius and -1 the zscale.
+        """
+        inds = np.asarray(inds, dtype='int')
+        N = self.N
+        if self.grouping == 'parameter':
+            part = np.where(inds < 3*N, inds // 3, inds - 3*N)
+            col = np.where(inds < 3*N, inds % 3, 3)
+        else:
+            part, col = inds // 4, inds % 4
+        col[inds == 4*N] = -1
+        return part, col
+
+    def _local_inds(self, params):
+        """Positions of `params` in self.params"""
+        try:
+            return np.array([self._pindex[p] for p in listify(params)],
+                    dtype='int')
+        except KeyError as e:
+            raise ValueError('%r is not a parameter of %r' % (e.args[0], self))
+
+    def get_values_at(self, inds=None):
+        if inds is None:
+            if self.grouping == 'parameter':
+                vals = [self.pos.ravel(), self.rad]
+            else:
+                vals = [np.hstack([self.pos, self.rad[:,None]]).ravel()]
+            return np.hstack(vals + [[self.zscale]])
+
+        part, col = self._local_to_ind(inds)
+        out = np.zeros(part.size)
+        ispos, israd, isz = (col >= 0) & (col < 3), col == 3, col == -1
+        out[ispos] = self.pos[part[ispos], col[ispos]]
+        out[israd] = self.rad[part[israd]]
+        out[isz] = self.zscale
+        return out
+
+    def set_values_at(self, inds, values):
+        part, col = self._local_to_ind(inds)
+        values = np.ravel(values).astype('float')
+        ispos, israd, isz = (col >= 0) & (col < 3), col == 3, col == -1
+        if self.distance_cache and ispos.any():
+            moved = np.unique(part[ispos])
+            self.get_distance_cache().discard(self._trans(self.pos[moved]))
+        self.pos[part[ispos], col[ispos]] = values[ispos]
+        self.rad[part[israd]] = values[israd]
+        if self._index is not None and ispos.any():
+            moved = np.unique(part[ispos])
+            self._index.move(moved, self.pos[moved])
+        if isz.any():
+            self.zscale = float(values[isz][-1])
+        self.trigger_values_change(inds=inds)
 
     def get_values(self, params):
-        values = []
-        for p in listify(params):
-            typ, ind = self._p2i(p)
-            if typ == 'zscale':
-                values.append(self.zscale)
-            elif typ == 'x':
-                values.append(self.pos[ind][2])
-            elif typ == 'y':
-                values.append(self.pos[ind][1])
-            elif typ == 'z':
-                values.append(self.pos[ind][0])
-            elif typ == 'a':
-                values.append(self.rad[ind])
-        return delistify(values, params)
+        values = self.get_values_at(self._local_inds(params))
+        return delistify(values.tolist(), params)
 
     def set_values(self, params, values):
-        for p,v in zip(listify(params), listify(values)):
-            typ, ind = self._p2i(p)
-            if typ == 'zscale':
-                self.zscale = v
-            elif typ == 'x':
-                self.pos[ind][2] = v
-            elif typ == 'y':
-                self.pos[ind][1] = v
-            elif typ == 'z':
-                self.pos[ind][0] = v
-            elif typ == 'a':
-                self.rad[ind] = v
+        self.set_values_at(self._local_inds(params), listify(values))
+
+    @property
+    def values(self):
+        return self.get_values_at().tolist()
 
     def set_draw_method(self, method, alpha=None, user_method=None):
         self.methods = [
@@ -606,6 +1633,114 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         else:
             self.alpha = tuple(listify(self.alpha_defaults[self.method]))
 
+    def _draw_tile(self, pos, rad):
+        """ The tile on which a particle at (translated) `pos` is drawn """
+        p = np.round(pos)
+        r = np.round(np.array([1.0/self.zscale,1,1])*np.ceil(rad)+self.support_pad)
+        return Tile(p-r, p+r, 0, self.shape.shape)
+
+    def get_volume_table(self):
+        """ The `VolumeTable` for the current draw method and zscale """
+        key = (self.method, self.alpha, self.zscale, self.support_pad,
+                self.volume_error, self.max_radius_change)
+        if getattr(self, '_vtable_key', None) != key:
+            self._vtable = VolumeTable(self.sphere_functions[self.method],
+                    self.alpha, zscale=self.zscale, support_pad=self.support_pad,
+                    volume_error=self.volume_error,
+                    max_radius_change=self.max_radius_change)
+            self._vtable_key = key
+        return self._vtable
+
+    def get_stamp_cache(self):
+        """ The `StampCache` for the current draw settings """
+        key = (self.method, self.alpha, self.zscale, self.support_pad,
+                self.exact_volume, self.volume_error, self.max_radius_change,
+                self.volume_table, self.stamp_cache, tuple(self.stamp_step),
+                self.stamp_tolerance)
+        if getattr(self, '_stamps_key', None) != key:
+            self._stamps = StampCache(self._render_stamp, self.stamp_cache,
+                    rstep=self.stamp_step[0], ostep=self.stamp_step[1],
+                    tolerance=self.stamp_tolerance)
+            self._stamps_key = key
+        return self._stamps
+
+    def stamp_stats(self):
+        """ Hit and miss counts of the stamp cache, see `StampCache.stats` """
+        return self.get_stamp_cache().stats()
+
+    def _render_stamp(self, rad, offset, half):
+        """ Draw a particle at `offset` from the center of a tile +-`half` """
+        rvec = Tile(-half, half).coords(form='vector')
+        if rad == 0:
+            return np.zeros(rvec.shape[:-1])
+        if self.exact_volume:
+            return exact_volume_sphere(rvec, offset, rad, zscale=self.zscale,
+                    volume_error=self.volume_error,
+                    function=self.sphere_functions[self.method], args=self.alpha,
+                    max_radius_change=self.max_radius_change,
+                    rprime=self._rprime(rad, offset))
+        dr = inner(rvec, offset, rad, zscale=self.zscale)
+        return self.sphere_functions[self.method](dr, rad, *self.alpha)
+
+    def _stamp(self, pos, rad, tile):
+        """
+        The cached stamp of a particle at (translated) `pos` drawn on `tile`,
+        or None if it has to be drawn exactly. Particles clipped by the edge
+        of the field are always drawn exactly, as their exact volume is
+        computed on the clipped tile.
+        """
+        cache = self.get_stamp_cache()
+        half = np.round(np.array([1.0/self.zscale,1,1])*np.ceil(rad) +
+                self.support_pad)
+        if (tile.shape != 2*half).any():
+            cache.fallbacks += 1
+            return None
+        return cache.stamp(rad, pos - np.round(pos), half)
+
+    def get_distance_cache(self):
+        """ The `DistanceCache` of the particles """
+        if getattr(self, '_dcache_size', None) != self.distance_cache:
+            self._dcache = DistanceCache(self.distance_cache)
+            self._dcache_size = self.distance_cache
+        return self._dcache
+
+    def distance_stats(self):
+        """ Hit and miss counts of the distance cache """
+        return self.get_distance_cache().stats()
+
+    def _rprime(self, rad, pos):
+        """
+        Starting effective radii of the exact volume iteration for particles
+        `rad` at (translated) `pos`, from the volume table if it is in use.
+        """
+        if not self.volume_table:
+            return None
+        rprime = self.get_volume_table()(rad, pos)
+        return rprime if np.ndim(rad) else rprime[0]
+
+    def volume_errors(self, inds=None):
+        """
+        Relative volume errors of particles `inds` (default all) drawn at the
+        effective radius from the volume table alone, without iterating and
+        without clipping to the field, to compare against `volume_error`.
+        """
+        inds = np.arange(self.N) if inds is None else np.array(listify(inds))
+        func = self.sphere_functions[self.method]
+        zsc = np.array([1.0/self.zscale, 1, 1])
+        errs = np.zeros(inds.size)
+        for j, n in enumerate(inds):
+            pos, rad = self._trans(self.pos[n]), self.rad[n]
+            if rad == 0.0:
+                continue
+            rprime = self.get_volume_table()(rad, pos)[0]
+            h = np.round(zsc*np.ceil(rad) + self.support_pad)
+            rvec = Tile(np.round(pos)-h, np.round(pos)+h).coords(form='vector')
+            t = func(inner(rvec, pos, rprime, zscale=self.zscale), rprime,
+                    *self.alpha)
+            goal = 4./3*np.pi*rad**3 / self.zscale
+            errs[j] = np.abs(goal - np.abs(t.sum())) / goal
+        return errs
+
     def _draw_particle(self, pos, rad, sign=1):
         # we can't draw 0 radius particles correctly, abort
         if rad == 0.0:
@@ -614,11 +1749,16 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         # translate to its actual position in the padded image
         pos = self._trans(pos)
 
-        p = np.round(pos)
-        r = np.round(np.array([1.0/self.zscale,1,1])*np.ceil(rad)+self.support_pad)
-
-        tile = Tile(p-r, p+r, 0, self.shape.shape)
-        rvec = tile.coords(form='vector')
+        tile = self._draw_tile(pos, rad)
+        stamp = self._stamp(pos, rad, tile) if self.stamp_cache else None
+        if stamp is not None:
+            self.particles[tile.slicer] += sign*stamp
+            return
+        if self.distance_cache:
+            rvec, geometry = None, self.get_distance_cache().get(pos, tile,
+                    self.zscale)
+        else:
+            rvec, geometry = tile.coords(form='vector'), None
 
         # if required, do an iteration to find the best radius to produce
         # the goal volume as given by the particular goal radius
@@ -626,15 +1766,181 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
             t = sign*exact_volume_sphere(
                 rvec, pos, rad, zscale=self.zscale, volume_error=self.volume_error,
                 function=self.sphere_functions[self.method], args=self.alpha,
-                max_radius_change=self.max_radius_change
+                max_radius_change=self.max_radius_change,
+                rprime=self._rprime(rad, pos), geometry=geometry
             )
         else:
             # calculate the anti-aliasing according to the interpolation type
-            dr = inner(rvec, pos, rad, zscale=self.zscale)
+            if geometry is None:
+                dr = inner(rvec, pos, rad, zscale=self.zscale)
+            else:
+                dr = (geometry[0] - rad)*geometry[1]
             t = sign*self.sphere_functions[self.method](dr, rad, *self.alpha)
 
         self.particles[tile.slicer] += t
 
+    def _draw_particles(self, inds, sign=1):
+        """
+        Draws (or un-draws) the particles `inds`. With `batch_draw`,
+        particles with the same size of drawing tile are evaluated together
+        on stacked arrays and added into the field, giving the same field
+        as drawing them one at a time with `_draw_particle`.
+        """
+        inds = np.asarray(inds, dtype='int').ravel()
+        inds = inds[self.rad[inds] != 0.0]
+        if (not self.batch_draw or inds.size < BATCH_DRAW_MIN or
+                self.stamp_cache or self.distance_cache):
+            return super(PlatonicSpheresCollection, self)._draw_particles(
+                    inds, sign=sign)
+
+        pos, rad = self._trans(self.pos[inds]), self.rad[inds]
+        workers = getattr(self, 'draw_workers', 1)
+        if workers <= 1:
+            self._draw_batch(pos, rad, sign)
+            return
+
+        # z-slabs at least as thick as the tallest drawing tile, so that
+        # particles from every other slab can never touch the same voxels
+        hz = np.round(np.ceil(rad)/self.zscale + self.support_pad)
+        thick = max(2*int(hz.max()), 1, int(np.ceil(
+                self.shape.shape[0] / (2.0*workers))))
+        slab = np.clip(np.round(pos[:,0]) // thick, 0, None).astype('int')
+
+        pool = ThreadPool(workers)
+        try:
+            for parity in [0, 1]:
+                jobs = [np.nonzero(slab == i)[0] for i in np.unique(slab)
+                        if i % 2 == parity]
+                pool.map(lambda j: self._draw_batch(pos[j], rad[j], sign), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _draw_batch(self, pos, rad, sign=1):
+        """
+        Draws the particles at translated positions `pos` with radii `rad`,
+        grouping them by the size of their drawing tile (see `_draw_tile`).
+        """
+        zsc = np.array([1.0/self.zscale, 1, 1])
+        left = np.round(pos)
+        half = np.round(zsc*np.ceil(rad)[:,None] + self.support_pad)
+        left -= half
+
+        groups = defaultdict(list)
+        for i, h in enumerate(half.astype('int').tolist()):
+            groups[tuple(h)].append(i)
+
+        for h, members in groups.iteritems():
+            members = np.array(members)
+            step = max(1, BATCH_DRAW_VOXELS // int(np.prod(2*np.array(h))))
+            for i in xrange(0, members.size, step):
+                sl = members[i:i+step]
+                self._draw_stack(pos[sl], rad[sl], left[sl].astype('int'),
+                        2*np.array(h), sign)
+
+    def _draw_stack(self, pos, rad, left, size, sign=1):
+        """
+        Draws M particles whose drawing tiles all have shape `size`, with
+        left corners `left` [M,3], clipping the tiles to the field.
+        """
+        shape = np.array(self.shape.shape)
+        crds = [left[:,i,None] + np.arange(size[i])[None,:] for i in xrange(3)]
+        inside = [(c >= 0) & (c < shape[i]) for i, c in enumerate(crds)]
+
+        rvec = np.zeros((left.shape[0],) + tuple(size) + (3,))
+        rvec[...,0] = crds[0][:,:,None,None]
+        rvec[...,1] = crds[1][:,None,:,None]
+        rvec[...,2] = crds[2][:,None,None,:]
+        mask = (inside[0][:,:,None,None] & inside[1][:,None,:,None] &
+                inside[2][:,None,None,:])
+
+        function = self.sphere_functions[self.method]
+        if self.exact_volume:
+            t = exact_volume_spheres(rvec, pos, rad, mask, zscale=self.zscale,
+                    volume_error=self.volume_error, function=function,
+                    max_radius_change=self.max_radius_change, args=self.alpha,
+                    rprime=self._rprime(rad, pos))
+        else:
+            t = _sphere_stack(rvec, pos, rad, mask, self.zscale, function,
+                    self.alpha)
+
+        lo = np.clip(left, 0, shape)
+        hi = np.clip(left + size, 0, shape)
+        for j in xrange(left.shape[0]):
+            if (hi[j] <= lo[j]).any():
+                continue
+            field = tuple(np.s_[l:r] for l, r in zip(lo[j], hi[j]))
+            local = tuple(np.s_[l:r] for l, r in zip(lo[j]-left[j], hi[j]-left[j]))
+            self.particles[field] += sign*t[j][local]
+
+    @property
+    def analytic_grad(self):
+        """
+        Whether the draw method supports analytic particle gradients. Not
+        with the stamp cache, as the field is then blended from stamps
+        whose derivative is not that of the exact profile; gradients are
+        then taken by finite differences of the blended field.
+        """
+        return (not getattr(self, 'stamp_cache', 0) and
+                self.sphere_functions[self.method] in sphere_gradients)
+
+    def particle_grad(self, ind):
+        """
+        Analytic derivative of the particle field with respect to the
+        position and radius of particle `ind`.
+
+        Returns
+        -------
+        tile : :class:`peri.util.Tile`
+            The tile on which the particle is drawn
+
+        grad : ndarray [4, tile.shape]
+            The derivative of ``self.particles[tile.slicer]`` with respect to
+            the parameters z, y, x, a of the particle
+        """
+        if not self.analytic_grad:
+            raise ValueError('No analytic gradient for method %r' % self.method)
+
+        pos, rad = self._trans(self.pos[ind]), self.rad[ind]
+        tile = self._draw_tile(pos, rad)
+        rvec = tile.coords(form='vector')
+
+        func = self.sphere_functions[self.method]
+        gfunc = sphere_gradients[func]
+
+        if rad == 0.0:
+            return tile, np.zeros((4,) + tuple(tile.shape))
+
+        # the drawn sphere has an effective radius for exact volumes, which
+        # changes with the radius to keep sum(P) = 4/3 pi a^3 / zscale
+        rprime = rad
+        if self.exact_volume:
+            _, rprime = exact_volume_sphere(
+                rvec, pos, rad, zscale=self.zscale, volume_error=self.volume_error,
+                function=func, args=self.alpha,
+                max_radius_change=self.max_radius_change, return_radius=True,
+                rprime=self._rprime(rad, pos)
+            )
+
+        dr, ddr_dp, ddr_da = inner_grad(rvec, pos, rprime, zscale=self.zscale)
+        dP_ddr, dP_da = gfunc(dr, rprime, *self.alpha)
+
+        grad = np.zeros((4,) + tuple(tile.shape))
+        for i in xrange(3):
+            grad[i] = dP_ddr * ddr_dp[...,i]
+
+        dP_da = dP_ddr * ddr_da + dP_da
+        if self.exact_volume:
+            # sum(P) is held fixed, so a change of any parameter moves the
+            # effective radius by dr' = -sum(dP/dp) / sum(dP/dr'), which for
+            # the radius is offset by the change of the goal volume
+            norm = dP_da.sum()
+            for i in xrange(3):
+                grad[i] -= dP_da * (grad[i].sum() / norm)
+            dP_da = dP_da * (4*np.pi*rad**2/self.zscale / norm)
+        grad[3] = dP_da
+        return tile, grad
+
     def param_radii(self):
         """ Return params of all radii """
         return [self._i2p(i, 'a') for i in xrange(self.N)]
@@ -654,10 +1960,17 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         ind = self._vps(listify(ind))
         return [self._i2p(i, 'a') for i in ind]
 
+    def _check_local_update(self):
+        if getattr(self, 'render', 'real') == 'fourier':
+            raise ValueError("render='fourier' draws the whole field at once "
+                    "and cannot update particles locally; use render='real' "
+                    "to fit or edit particles")
+
     def add_particle(self, pos, rad):
         """
         Add a particle or list of particles given by a list of positions and
-        radii, both need to be array-like.
+        radii, both need to be array-like. All the particles are drawn in a
+        single update, so add many particles at once where possible.
 
         Parameters
         ----------
@@ -672,16 +1985,32 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         inds : N-element numpy.ndarray.
             Indices of the added particles.
         """
+        self._check_local_update()
         rad = listify(rad)
+        N, k = self.N, len(rad)
         # add some zero mass particles to the list (same as not having these
         # particles in the image, which is true at this moment)
-        inds = np.arange(self.N, self.N+len(rad))
-        self.pos = np.vstack([self.pos, pos])
-        self.rad = np.hstack([self.rad, np.zeros(len(rad))])
+        inds = np.arange(N, N+k)
+        self._reserve(N+k)
+        self._pos[N:N+k] = np.reshape(pos, (k, -1))
+        self._rad[N:N+k] = 0.0
+        self._ids[N:N+k] = np.arange(self._next_id, self._next_id+k)
+        self._next_id += k
+        self._N = N+k
+        if self._index is not None:
+            self._index.append(self._pos[N:N+k])
 
-        # update the parameters globally
-        self.setup_variables()
-        self.trigger_parameter_change()
+        if self.grouping == 'parameter':
+            self.setup_variables()
+            self.trigger_parameter_change()
+        else:
+            # the new parameters go between the old particles and zscale
+            at = 4*N
+            names = self.param_particle(inds)
+            self._params[at:at] = names
+            self._pindex.update(zip(names, xrange(at, at+len(names))))
+            self._pindex['zscale'] = len(self._params) - 1
+            self.trigger_parameter_insert(at, names)
 
         # now request a drawing of the particle plz
         params = self.param_particle_rad(inds)
@@ -690,12 +2019,16 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
 
     def remove_particle(self, inds):
         """
-        Remove the particle at index `inds`, may be a list.
+        Remove the particle at index `inds`, may be a list. The removed
+        particles are erased in a single update and the last particles are
+        moved into their places, so only the indices of those particles
+        change; see `get_ids` for ids which do not change.
         Returns [3,N], [N] element numpy.ndarray of pos, rad.
         """
-        if self.rad.shape[0] == 0:
+        if self.N == 0:
             return
 
+        self._check_local_update()
         inds = listify(inds)
 
         # Here's the game plan:
@@ -709,13 +2042,34 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         rad = self.rad[inds].copy()
 
         self.trigger_update(self.param_particle_rad(inds), np.zeros(len(inds)))
+        if self.distance_cache:
+            self.get_distance_cache().discard(self._trans(pos))
+
+        # the erased particles no longer change the field, so the slots
+        # past the new end are moved into the holes left below it
+        gone = np.unique(np.arange(self.N)[inds])
+        N, keep = self.N, self.N - gone.size
+        holes = gone[gone < keep]
+        tail = np.setdiff1d(np.arange(keep, N), gone)
+        for name in ['_pos', '_rad', '_ids']:
+            arr = getattr(self, name)
+            arr[holes] = arr[tail]
+        self._N = keep
+        if self._index is not None:
+            self._index.compact(gone, holes, tail)
 
-        self.pos = np.delete(self.pos, inds, axis=0)
-        self.rad = np.delete(self.rad, inds, axis=0)
-
-        # update the parameters globally
-        self.setup_variables()
-        self.trigger_parameter_change()
+        if self.grouping == 'parameter':
+            self.setup_variables()
+            self.trigger_parameter_change()
+        else:
+            at = 4*keep
+            for name in self._params[at:4*N]:
+                del self._pindex[name]
+            del self._params[at:4*N]
+            self._pindex['zscale'] = at
+            self.trigger_parameter_remove(np.arange(at, 4*N))
+            # the particles moved into the holes keep their parameter names
+            self.trigger_values_change(params=self.param_particle(holes))
         return np.array(pos).reshape(-1,3), np.array(rad).reshape(-1)
 
     def get_radii(self):
@@ -723,7 +2077,8 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
 
     def exports(self):
         return (super(PlatonicSpheresCollection, self).exports() +
-                [self.get_radii])
+                [self.get_radii, self.get_ids, self.particles_in_tile,
+                self.nearest_particles, self.get_kspace])
 
     def _p2i(self, param):
         """
@@ -732,6 +2087,15 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         rad    : ('a', 100)
         zscale : ('zscale, None)
         """
+        k, N = self._pindex.get(param), self.N
+        if k is not None:
+            if k == 4*N:
+                return 'zscale', None
+            if self.grouping == 'parameter':
+                ind, col = divmod(k, 3) if k < 3*N else (k - 3*N, 3)
+            else:
+                ind, col = divmod(k, 4)
+            return 'zyxa'[col], ind
         g = param.split('-')
         if len(g) == 1:
             return 'zscale', None
@@ -756,11 +2120,34 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         pos = self._trans(pos)
         return Tile(pos - zsc*rad, pos + zsc*rad).pad(self.support_pad)
 
+    def snapshot(self, params, tile):
+        """
+        Copy the section of the particle field changed by an update of
+        `params` within `tile`.
+        """
+        if self._update_type(params)[0]:
+            return [('particles', None, self.particles.copy())]
+
+        # particles are drawn on a rounded tile which can extend past the
+        # update tile by up to the z-scaling plus one pixel
+        zsc = np.array([1.0/self.zscale, 1, 1])
+        tile = Tile.intersection(tile.pad(np.ceil(zsc).astype('int')+1),
+                self.shape)
+        return [('particles', tile.slicer, self.particles[tile.slicer].copy())]
+
+    def get_update_tile(self, params, values):
+        if not self._update_type(params)[0]:
+            self._check_local_update()
+        return super(PlatonicSpheresCollection, self).get_update_tile(params,
+                values)
+
     def update(self, params, values):
         """Calls an update, but clips radii to be > 0"""
         # radparams = self.param_radii()
         params = listify(params)
         values = listify(values)
+        if not self._update_type(params)[0]:
+            self._check_local_update()
         for i, p in enumerate(params):
             # if (p in radparams) & (values[i] < 0):
             if (p[-2:] == '-a') and (values[i] < 0):
@@ -777,13 +2164,31 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
     def __getstate__(self):
         odict = self.__dict__.copy()
         cdd(odict, super(PlatonicSpheresCollection, self).nopickle())
-        cdd(odict, ['rvecs', 'particles', '_params'])
+        cdd(odict, ['rvecs', 'particles', '_params', '_pindex', '_index',
+                '_vtable', '_vtable_key', '_stamps', '_stamps_key', '_dcache',
+                '_dcache_size'])
+        for name in ['_pos', '_rad', '_ids']:
+            odict[name] = odict[name][:self._N].copy()
         return odict
 
     def __setstate__(self, idict):
+        idict = idict.copy()
+        pos, rad = idict.pop('pos', None), idict.pop('rad', None)
         self.__dict__.update(idict)
+        self._index = None
         ##Compatibility patches...
+        if pos is not None:
+            self.rad = rad
+            self.pos = pos
         self.float_precision = self.__dict__.get('float_precision', np.float64)
+        self.batch_draw = self.__dict__.get('batch_draw', False)
+        self.draw_workers = self.__dict__.get('draw_workers', 1)
+        self.volume_table = self.__dict__.get('volume_table', False)
+        self.stamp_cache = self.__dict__.get('stamp_cache', 0)
+        self.stamp_step = self.__dict__.get('stamp_step', (0.05, 0.1))
+        self.stamp_tolerance = self.__dict__.get('stamp_tolerance', 0.01)
+        self.distance_cache = self.__dict__.get('distance_cache', 0)
+        self.render = self.__dict__.get('render', 'real')
         ##end compatibility patch
         self.setup_variables()
         if self.shape:
@@ -3,10 +3,18 @@ import numpy as np
 from numpy.lib.scimath import sqrt as csqrt
 from scipy.special import j0,j1, la_roots
 
-from peri import util
+from peri import util, conf
 from peri import interpolation
 from peri.comp import psfs
 
+# number of threads computing psf slices, chebyshev nodes and wavelengths in
+# parallel, see util.parallel_map
+PSF_WORKERS = int(conf.load_conf()['psf-workers'])
+
+# largest interpolation error of get_hsym_asym_radial, relative to the
+# largest value of the psf in the same z-plane
+RHO_TABLE_TOLERANCE = 1e-5
+
 def j2(x):
     """ A fast j2 defined in terms of other special functions """
     to_return = 2./(x+1e-15)*j1(x) - j0(x)
@@ -352,6 +360,99 @@ def get_hsym_asym(rho, z, get_hdet=False, include_K3_det=True, **kwargs):
 
     return hsym.real, hasym.real #imaginary part should be 0
 
+def _interp_rows(table, rows, t):
+    """
+    Cubic Lagrange interpolation of the rows `rows` of `table` at the
+    fractional column indices `t`, which must be within [1, ncols-2].
+    """
+    i = np.clip(np.floor(t).astype('int'), 1, table.shape[1]-3)
+    u = t - i
+    w = [
+        -u*(u-1)*(u-2)/6., (u+1)*(u-1)*(u-2)/2.,
+        -(u+1)*u*(u-2)/2., (u+1)*u*(u-1)/6.
+    ]
+    return sum(w[k]*table[rows, i+k-1] for k in xrange(4))
+
+def get_hsym_asym_radial(rho, z, get_hdet=False, include_K3_det=True,
+        tolerance=RHO_TABLE_TOLERANCE, **kwargs):
+    """
+    Calculates the symmetric and asymmetric portions of a confocal PSF, as
+    :func:`get_hsym_asym`, but from one-dimensional tables in rho for each
+    distinct value of z, since they only depend on (rho, z).
+
+    Whichever of these needs the fewest evaluations of the integrals is
+    used:
+
+        * evaluating at every point, as :func:`get_hsym_asym`
+        * evaluating exactly at every pair of distinct z and distinct rho
+        * evaluating on a uniform grid in rho for each distinct z, and
+          interpolating it with cubic polynomials
+
+    The second and third win when (rho, z) sample a grid in (x, y, z), as
+    for a psf slice. hsym and hasym are even in rho and band-limited with
+    frequency at most 2 sin(alpha), so the interpolation error is at most
+    0.375 (step sin(alpha))**4 times their largest value in the same
+    z-plane. The step is chosen to make this `tolerance`.
+
+    Parameters
+    ----------
+        rho : numpy.ndarray
+            Rho in cylindrical coordinates, in units of 1/k.
+        z : numpy.ndarray
+            Z in cylindrical coordinates, in units of 1/k. Must be the
+            same shape as `rho`
+        get_hdet : Bool, optional
+            Set to True to get the detection portion of the psf; False
+            to get the illumination portion of the psf. Default is True
+        include_K3_det : Bool, optional.
+            See :func:`get_hsym_asym`. Default is True
+        tolerance : Float, optional
+            Largest interpolation error relative to the largest value of
+            hsym in the same z-plane. Default is RHO_TABLE_TOLERANCE.
+
+    Other Parameters
+    ----------------
+        alpha, zint, n2n1 : Float, optional
+            See :func:`get_hsym_asym`.
+
+    Returns
+    -------
+        hsym : numpy.ndarray
+            `rho`.shape numpy.array of the symmetric portion of the PSF
+        hasym : numpy.ndarray
+            `rho`.shape numpy.array of the asymmetric portion of the PSF
+    """
+    if type(rho) != np.ndarray or type(z) != np.ndarray or (rho.shape != z.shape):
+        raise ValueError('rho and z must be np.arrays of same shape.')
+
+    zu, zi = np.unique(z, return_inverse=True)
+    ru, ri = np.unique(np.abs(rho), return_inverse=True)
+
+    step = (tolerance / 0.375)**0.25 / np.sin(kwargs.get('alpha', 1.0))
+    nr = int(np.ceil(ru[-1] / step)) + 3
+
+    method = np.argmin([rho.size, zu.size*ru.size, zu.size*nr])
+    if method == 0:
+        return get_hsym_asym(rho, z, get_hdet=get_hdet,
+                include_K3_det=include_K3_det, **kwargs)
+
+    rvec = ru if method == 1 else step*np.arange(nr)
+    zg, rg = np.meshgrid(zu, rvec, indexing='ij')
+    hsym, hasym = get_hsym_asym(rg, zg, get_hdet=get_hdet,
+            include_K3_det=include_K3_det, **kwargs)
+
+    if method == 1:
+        return hsym[zi, ri].reshape(rho.shape), hasym[zi, ri].reshape(rho.shape)
+
+    # mirror the grid to rho = -step, so that every point has two table
+    # entries on either side
+    t = ru[ri] / step + 1
+    out = []
+    for h in [hsym, hasym]:
+        table = np.append(h[:,1:2], h, axis=1)
+        out.append(_interp_rows(table, zi, t).reshape(rho.shape))
+    return out[0], out[1]
+
 def calculate_pinhole_psf(x, y, z, kfki=0.89, zint=100.0, normalize=False,
         **kwargs):
     """
@@ -406,8 +507,10 @@ def calculate_pinhole_psf(x, y, z, kfki=0.89, zint=100.0, normalize=False,
     rho = np.sqrt(x**2 + y**2)
     phi = np.arctan2(y, x)
 
-    hsym, hasym = get_hsym_asym(rho, z, zint=zint, get_hdet=False, **kwargs)
-    hdet, toss  = get_hsym_asym(rho*kfki, z*kfki, zint=kfki*zint, get_hdet=True, **kwargs)
+    hsym, hasym = get_hsym_asym_radial(rho, z, zint=zint, get_hdet=False,
+            **kwargs)
+    hdet, toss  = get_hsym_asym_radial(rho*kfki, z*kfki, zint=kfki*zint,
+            get_hdet=True, **kwargs)
 
     if normalize:
         hasym /= hsym.sum()
@@ -524,13 +627,15 @@ def calculate_polychrome_pinhole_psf(x, y, z, normalize=False, kfki=0.889,
     phi = np.arctan2(y, x)
 
     #1. Hilm
-    hsym, hasym = get_hsym_asym(rho, z, zint=zint, get_hdet=False, **kwargs)
+    hsym, hasym = get_hsym_asym_radial(rho, z, zint=zint, get_hdet=False,
+            **kwargs)
     hilm = (hsym + np.cos(2*phi)*hasym)
 
     #2. Hdet
-    hdet_func = lambda kfki: get_hsym_asym(rho*kfki, z*kfki,
+    hdet_func = lambda kfki: get_hsym_asym_radial(rho*kfki, z*kfki,
                 zint=kfki*zint, get_hdet=True, **kwargs)[0]
-    inner = [wts[a] * hdet_func(kfkipts[a]) for a in xrange(nkpts)]
+    inner = util.parallel_map(lambda a: wts[a] * hdet_func(kfkipts[a]),
+            xrange(nkpts), workers=PSF_WORKERS)
     hdet = np.sum(inner, axis=0)
 
     #3. Normalize and return
@@ -683,13 +788,15 @@ def calculate_linescan_ilm_psf(y,z, polar_angle=0., nlpts=1,
     y_pinhole *= np.sqrt(2)*pinhole_width
     wts_pinhole /= np.sqrt(np.pi)
 
-    #Pinhole hermgauss first:
-    for yp, wp in zip(y_pinhole, wts_pinhole):
-        rho = np.sqrt(xg*xg + (yg-yp)*(yg-yp))
-        phi = np.arctan2(yg,xg)
+    #Pinhole hermgauss first, all the pinhole points at once so that
+    #they share the tables in rho:
+    rho = np.array([np.sqrt(xg*xg + (yg-yp)*(yg-yp)) for yp in y_pinhole])
+    zp = np.array([zg]*nlpts)
+    phi = np.arctan2(yg,xg)
 
-        hsym, hasym = get_hsym_asym(rho,zg,get_hdet = False, **kwargs)
-        hilm += wp*(hsym + np.cos(2*(phi-polar_angle))*hasym)
+    hsym, hasym = get_hsym_asym_radial(rho, zp, get_hdet=False, **kwargs)
+    for a in xrange(nlpts):
+        hilm += wts_pinhole[a]*(hsym[a] + np.cos(2*(phi-polar_angle))*hasym[a])
 
     #Now line hermgauss
     for a in xrange(x_vals.size):
@@ -778,11 +885,11 @@ def calculate_linescan_psf(x, y, z, normalize=False, kfki=0.889, zint=100.,
     #2. Hdet
     if wrap:
         #Lambda function that ignores its args but still returns correct values
-        func = lambda *args: get_hsym_asym(rho3*kfki, z3*kfki, zint=kfki*zint,
-                    get_hdet=True, **kwargs)[0]
+        func = lambda *args: get_hsym_asym_radial(rho3*kfki, z3*kfki,
+                    zint=kfki*zint, get_hdet=True, **kwargs)[0]
         hdet = wrap_and_calc_psf(xpts, ypts, z, func)
     else:
-        hdet, toss = get_hsym_asym(rho3*kfki, z3*kfki, zint=kfki*zint,
+        hdet, toss = get_hsym_asym_radial(rho3*kfki, z3*kfki, zint=kfki*zint,
                 get_hdet=True, **kwargs)
 
     if normalize:
@@ -892,14 +999,15 @@ def calculate_polychrome_linescan_psf(x, y, z, normalize=False, kfki=0.889,
     #2. Hdet
     if wrap:
         #Lambda function that ignores its args but still returns correct values
-        func = lambda x,y,z, kfki=1.: get_hsym_asym(rho3*kfki, z3*kfki,
+        func = lambda x,y,z, kfki=1.: get_hsym_asym_radial(rho3*kfki, z3*kfki,
                 zint=kfki*zint, get_hdet=True, **kwargs)[0]
         hdet_func = lambda kfki: wrap_and_calc_psf(xpts,ypts,z, func, kfki=kfki)
     else:
-        hdet_func = lambda kfki: get_hsym_asym(rho3*kfki, z3*kfki,
+        hdet_func = lambda kfki: get_hsym_asym_radial(rho3*kfki, z3*kfki,
                 zint=kfki*zint, get_hdet=True, **kwargs)[0]
     #####
-    inner = [wts[a] * hdet_func(kfkipts[a]) for a in xrange(nkpts)]
+    inner = util.parallel_map(lambda a: wts[a] * hdet_func(kfkipts[a]),
+            xrange(nkpts), workers=PSF_WORKERS)
     hdet = np.sum(inner, axis=0)
 
     if normalize:
@@ -2,6 +2,8 @@ import os
 import atexit
 import cPickle as pickle
 import numpy as np
+from scipy import sparse
+from collections import OrderedDict
 from multiprocessing import cpu_count
 from numpy.polynomial.legendre import legval
 from numpy.polynomial.chebyshev import chebval
@@ -10,12 +12,75 @@ from peri.fft import fft, fftkwargs
 from peri.comp import Component
 from peri.util import Tile, cdd, memoize, listify
 
+#=============================================================================
+# Cache of padded k-space kernels
+#=============================================================================
+class KernelCache(object):
+    def __init__(self, max_bytes=2**28):
+        """
+        LRU cache of the padded, transformed kernels a PSF convolves with,
+        keyed by a name, the tile shape and anything else the kernel depends
+        on (a z-slice or Chebyshev coefficient index). Every key also holds
+        the parameter version of the PSF, which `invalidate` advances when
+        the parameters change, so stale kernels are never returned.
+
+        Parameters
+        ----------
+        max_bytes : int
+            Memory budget of the cached kernels. The least recently used
+            kernels are evicted beyond it.
+        """
+        self.max_bytes = max_bytes
+        self.kernels = OrderedDict()
+        self.nbytes = 0
+        self.version = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key, compute):
+        """
+        The kernel stored under `key`, calling ``compute()`` to create it
+        if it is not in the cache.
+        """
+        key = (self.version,) + tuple(key)
+        if key in self.kernels:
+            self.hits += 1
+            kernel = self.kernels.pop(key)
+        else:
+            self.misses += 1
+            kernel = compute()
+            self.nbytes += kernel.nbytes
+            while self.kernels and self.nbytes > self.max_bytes:
+                _, old = self.kernels.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+        self.kernels[key] = kernel
+        return kernel
+
+    def invalidate(self):
+        """Drop every kernel and advance the parameter version"""
+        self.kernels.clear()
+        self.nbytes = 0
+        self.version += 1
+
+    def stats(self):
+        """
+        Counts of kernel lookups found in the cache (hits), computed
+        (misses) and kernels evicted, with the parameter version and the
+        number and size of the cached kernels.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'version': self.version,
+                'kernels': len(self.kernels), 'nbytes': self.nbytes}
+
 #=============================================================================
 # Begin 3-dimensional point spread functions
 #=============================================================================
 class PSF(Component):
     category = 'psf'
 
+    # memory budget of the k-space kernel cache, see `get_kernel_cache`
+    kernel_cache_bytes = 2**28
+
     def __init__(self, params, values, shape=None):
         """
         Point spread function classes must contain the following classes in order
@@ -37,8 +102,24 @@ class PSF(Component):
         self.update(self.params, self.values)
         self.set_tile(self.shape)
 
-    @memoize()
+    def get_kernel_cache(self):
+        """
+        The KernelCache of padded k-space kernels for this PSF, created on
+        first use with a budget of `kernel_cache_bytes`
+        """
+        if getattr(self, '_kernels', None) is None:
+            self._kernels = KernelCache(max_bytes=self.kernel_cache_bytes)
+        return self._kernels
+
+    def kernel_stats(self):
+        """Hit statistics of the k-space kernel cache, see KernelCache.stats"""
+        return self.get_kernel_cache().stats()
+
     def calculate_kpsf(self, shape):
+        return self.get_kernel_cache().get(('kpsf', tuple(shape)),
+                lambda: self._calculate_kpsf(shape))
+
+    def _calculate_kpsf(self, shape):
         d = ((shape - self.min_support))
 
         # fix off-by-one issues when going odd to even tile sizes
@@ -72,7 +153,8 @@ class PSF(Component):
         self.set_values(params, values)
         self.min_rpsf, self.min_support = self.calculate_min_rpsf()
 
-        # clean out the cache since it is no longer useful
+        # clean out the caches since they are no longer useful
+        self.get_kernel_cache().invalidate()
         if hasattr(self, '_memoize_clear'):
             self._memoize_clear()
 
@@ -83,13 +165,33 @@ class PSF(Component):
         if any(field.shape != self.tile.shape):
             raise AttributeError("Field passed to PSF incorrect shape")
 
-        if not np.iscomplex(field.ravel()[0]):
+        if not np.iscomplexobj(field):
             infield = fft.fftn(field, **fftkwargs)
         else:
             infield = field
 
         return np.real(fft.ifftn(infield * self.kpsf, **fftkwargs))
 
+    def execute_many(self, fields):
+        """
+        Apply the PSF to a stack of fields at once, where `fields` has shape
+        (N,) + tile.shape. The kernel is shared across the stack so that a
+        single batched transform replaces N separate calls to `execute`.
+        """
+        if any(np.array(fields.shape[1:]) != self.tile.shape):
+            raise AttributeError("Fields passed to PSF incorrect shape")
+
+        axes = tuple(range(1, fields.ndim))
+        infield = fft.fftn(fields, axes=axes, **fftkwargs)
+        return np.real(fft.ifftn(infield * self.kpsf[None], axes=axes, **fftkwargs))
+
+    def __call__(self, field):
+        # a leading axis beyond the tile dimension marks a stack of fields,
+        # which lets model strings like H(dP) act on several fields at once
+        if np.ndim(field) == len(self.tile.shape) + 1:
+            return self.execute_many(field)
+        return self.execute(field)
+
     def get(self):
         return self
 
@@ -101,7 +203,7 @@ class PSF(Component):
 
     def nopickle(self):
         return super(PSF, self).nopickle() + [
-            '_memoize_clear', '_memoize_caches',
+            '_memoize_clear', '_memoize_caches', '_kernels',
             'rpsf', 'kpsf', 'min_rpsf'
         ]
 
@@ -143,6 +245,9 @@ class IdentityPSF(PSF):
 
     def execute(self, field):
         return field
+
+    def execute_many(self, fields):
+        return fields
     
     def get_padding_size(self, tile):
         return Tile(np.ones(3))
@@ -211,7 +316,8 @@ class PSF4D(PSF):
         convolve in the z direction
 
         The key variables are rpsf (2d) and kpsf (2d) which are used for the
-        x-y convolution.  The z-convolution cannot be cached.
+        x-y convolution, and zop, the z-convolution as a sparse banded matrix
+        acting on the z-planes of the tile.
         """
         super(PSF4D, self).__init__(params=params, values=values, shape=shape)
 
@@ -243,11 +349,42 @@ class PSF4D(PSF):
 
         return rpsf, kpsf
 
+    @memoize()
+    def _calc_tile_z_operator(self, tile):
+        """
+        The z-convolution over the planes of `tile` as a sparse matrix, whose
+        row i holds `rpsf_z` for the planes within the padding size of plane
+        i, so that it is banded.
+        """
+        zs = self._zpos(tile)
+        inds = np.arange(len(zs))
+        rows, cols, vals = [], [], []
+
+        for i,z in enumerate(zs):
+            size = self.get_padding_size(tile=None, z=z).shape
+            m = inds[(zs >= z-size[0]) & (zs <= z+size[0])]
+            rows.append(i*np.ones(m.size, dtype='int'))
+            cols.append(m)
+            vals.append(self.rpsf_z(zs[m], z))
+
+        return sparse.csr_matrix(
+            (np.hstack(vals), (np.hstack(rows), np.hstack(cols))),
+            shape=(len(zs), len(zs))
+        )
+
     def set_tile(self, tile):
         if not hasattr(self, 'tile') or (self.tile != tile).any():
             self.tile = tile
 
         self.rpsf, self.kpsf = self._calc_tile_2d_psf(self.tile)
+        self.zop = self._calc_tile_z_operator(self.tile)
+
+    def _zconvolve(self, field, axis=0):
+        """Apply the z-convolution `zop` along the z `axis` of `field`"""
+        field = np.rollaxis(field, axis, 0)
+        shape = field.shape
+        out = self.zop.dot(field.reshape(shape[0], -1)).reshape(shape)
+        return np.rollaxis(out, 0, axis+1)
 
     def update(self, params, values):
         # what should we update when the parameters are adjusted for
@@ -271,18 +408,19 @@ class PSF4D(PSF):
             infield = field
 
         cov2d = np.real(fft.ifft2(infield * self.kpsf, **fftkwargs))
-        cov2dT = np.rollaxis(cov2d, 0, 3)
+        return self._zconvolve(cov2d)
 
-        out = np.zeros_like(cov2d)
-        z = self._zpos(self.tile)
+    def execute_many(self, fields):
+        if any(np.array(fields.shape[1:]) != self.tile.shape):
+            raise AttributeError("Fields passed to PSF incorrect shape")
 
-        for i in xrange(len(z)):
-            size = self.get_padding_size(tile=None, z=z[i]).shape
-            m = (z >= z[i]-size[0]) & (z <= z[i]+size[0])
-            g = self.rpsf_z(z[m], z[i])
-            out[i] = cov2dT[...,m].dot(g)
+        # fft2 acts on the last two axes, so the stack rides along for free
+        infield = fft.fft2(fields, **fftkwargs)
+        cov2d = np.real(fft.ifft2(infield * self.kpsf[None], **fftkwargs))
+        return self._zconvolve(cov2d, axis=1)
 
-        return out
+    def nopickle(self):
+        return super(PSF4D, self).nopickle() + ['zop']
 
     def rpsf_xy(self, vecs, z):
         """
@@ -559,19 +697,24 @@ class FromArray(PSF):
         if any(field.shape != self.tile.shape):
             raise AttributeError("Field passed to PSF incorrect shape")
 
-        if not np.iscomplex(field.ravel()[0]):
+        if not np.iscomplexobj(field):
             infield = fft.fftn(field, **fftkwargs)
         else:
             infield = field
 
         outfield = np.zeros_like(infield, dtype='float')
 
+        cache = self.get_kernel_cache()
         for i in xrange(field.shape[0]):
             z = int(self.tile.l[0] + i)
-            kpsf = self._pad(self.array[z])
+            kpsf = cache.get(('array', tuple(self.tile.shape), z),
+                    lambda: self._pad(self.array[z]))
             outfield[i] = np.real(fft.ifftn(infield * kpsf, **fftkwargs))[i]
 
         return outfield
 
+    def execute_many(self, fields):
+        return np.array([self.execute(f) for f in fields])
+
     def get_padding_size(self, tile, z=None):
         return Tile(self.support)
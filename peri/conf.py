@@ -16,6 +16,8 @@ Variable name             Default value          Description
 ``log-to-file``           False                  Whether or not to actually save logs to a file as well
 ``log-colors``            False                  Display logs in color (supported by xterm256)
 ``verbosity``             vvv                    Level of verbosity for logs, the more v's the more verbose
+``psf-workers``           1                      Number of threads computing the slices, Chebyshev nodes and
+                                                 wavelengths of the exact PSFs, -1 indicates all available
 ========================= ====================== =============================================================
 """
 
@@ -31,6 +33,7 @@ default_conf = {
     "log-to-file": False,
     "log-colors": False,
     "verbosity": 'vvv',
+    "psf-workers": 1,
 }
 
 def get_conf_filename():
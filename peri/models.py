@@ -154,6 +154,25 @@ class Model(object):
         name = self.diffname(self.ivarmap[category])
         return self.modelstr.get(name)
 
+    def difference_variables(self, category):
+        """
+        The categories of the components which the difference model wrt
+        `category` depends upon. For the ``ConfocalImageModel``,
+        ``difference_variables('ilm') == set(['psf', 'obj'])``.
+        """
+        regex = re.compile('([a-zA-Z_][a-zA-Z0-9_]*)')
+        eq = self.get_difference_model(category) or ''
+        return set([self.varmap[v] for v in regex.findall(eq) if v in self.varmap])
+
+    def is_linear(self, category):
+        """
+        Whether the model is linear in the component of `category`, i.e. it
+        has a difference model which does not depend on the component itself
+        """
+        if category not in self.ivarmap or not self.get_difference_model(category):
+            return False
+        return category not in self.difference_variables(category)
+
     def map_vars(self, comps, funcname='get', diffmap=None, **kwargs):
         """
         Map component function ``funcname`` result into model variables
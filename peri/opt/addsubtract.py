@@ -713,7 +713,7 @@ def add_subtract_misfeatured_tile(st, tile, rad='calc', max_iter=3,
         rad = np.median(st.obj_get_radii())
     # 1. Remove all possibly bad particles within the tile.
     initial_error = np.copy(st.error)
-    rinds = np.nonzero(tile.contains(st.obj_get_positions()))[0]
+    rinds = opt.find_particles_in_tile(st, tile)
     if rinds.size >= max_allowed_remove:
         CLOG.fatal('Misfeatured region too large!')
         raise RuntimeError
@@ -4,12 +4,14 @@ import time
 import tempfile
 import pickle
 import gc
+import itertools
+import multiprocessing
 
 import numpy as np
 from numpy.random import randint
 from scipy.optimize import newton, minimize_scalar
 
-from peri.util import Tile, Image
+from peri.util import Tile, Image, listify
 from peri import states
 from peri import models as mdl
 from peri.logger import log
@@ -59,7 +61,8 @@ rather than for all the pixels (in addition to leastsq solution instead of
 linalg.solve)
 """
 
-def get_rand_Japprox(s, params, num_inds=1000, include_cost=False, **kwargs):
+def get_rand_Japprox(s, params, num_inds=1000, include_cost=False,
+        analytic=True, inds=None, dtype=None, **kwargs):
     """
     Calculates a random approximation to J by returning J only at a
     set of random pixel/voxel locations.
@@ -76,6 +79,19 @@ def get_rand_Japprox(s, params, num_inds=1000, include_cost=False, **kwargs):
         include_cost : Bool, optional
             Set to True to append a finite-difference measure of the full
             cost gradient onto the returned J.
+        analytic : Bool, optional
+            Set to False to always use finite differences. Otherwise, if the
+            state supports it and any of `params` has an analytic column,
+            the columns of particle parameters are calculated analytically
+            with s.gradmodel_analytic. Default is True.
+        inds : numpy.ndarray, slice or None, optional
+            Set to the sorted pixel indices (or ``slice(0, None)``) returned
+            by a previous call to reuse them instead of drawing `num_inds`
+            new ones. Default is None.
+        dtype : numpy.dtype, string or None, optional
+            The dtype to store J in, e.g. 'float32' to halve its memory.
+            The cost gradient is always double precision. Default is None,
+            i.e. float64.
 
     Other Parameters
     ----------------
@@ -92,7 +108,10 @@ def get_rand_Japprox(s, params, num_inds=1000, include_cost=False, **kwargs):
     """
     start_time = time.time()
     tot_pix = s.residuals.size
-    if num_inds < tot_pix:
+    if inds is not None and not isinstance(inds, slice):
+        slicer = None
+        return_inds = inds
+    elif inds is None and num_inds < tot_pix:
         inds = np.random.choice(tot_pix, size=num_inds, replace=False)
         slicer = None
         return_inds = np.sort(inds)
@@ -100,7 +119,26 @@ def get_rand_Japprox(s, params, num_inds=1000, include_cost=False, **kwargs):
         inds = None
         return_inds = slice(0, None)
         slicer = [slice(0, None)]*len(s.residuals.shape)
-    if include_cost:
+    # only worth it if some column is analytic; otherwise gradmodel_analytic
+    # is plain finite differences with extra bookkeeping
+    if analytic and hasattr(s, 'gradmodel_analytic'):
+        analytic = (getattr(s, 'linear_cache_max_mem', 0) > 0 or any([
+                s._analytic_particle(p) is not None for p in listify(params)]))
+    if analytic and hasattr(s, 'gradmodel_analytic'):
+        out = None
+        if dtype is not None:
+            #fill J in place so a full double-precision copy never exists
+            npx = tot_pix if inds is None else np.size(inds)
+            out = np.zeros([len(params), npx], dtype=dtype)
+            if include_cost:
+                out = [out, np.zeros(len(params))]
+        J = s.gradmodel_analytic(params=params, inds=inds, slicer=slicer,
+                flat=False, include_cost=include_cost, out=out, **kwargs)
+        if include_cost:
+            J[0] *= -1
+        else:
+            J *= -1
+    elif include_cost:
         Jact, ge = s.gradmodel_e(params=params, inds=inds, slicer=slicer,flat=False,
                 **kwargs)
         Jact *= -1
@@ -108,6 +146,11 @@ def get_rand_Japprox(s, params, num_inds=1000, include_cost=False, **kwargs):
     else:
         J = -s.gradmodel(params=params, inds=inds, slicer=slicer, flat=False,
                 **kwargs)
+    if dtype is not None:
+        if include_cost:
+            J[0] = J[0].astype(dtype, copy=False)
+        else:
+            J = J.astype(dtype, copy=False)
     CLOG.debug('J:\t%f' % (time.time()-start_time))
     return J, return_inds
 
@@ -130,14 +173,66 @@ def name_globals(s, remove_params=None):
             remove_params removed.
     """
     all_params = s.params
-    for p in s.param_particle(range(s.obj_get_positions().shape[0])):
-        all_params.remove(p)
+    drop = set(s.param_particle(range(s.obj_get_positions().shape[0])))
     if remove_params is not None:
-        for p in set(remove_params):
-            all_params.remove(p)
-    return all_params
+        missing = set(remove_params) - set(all_params)
+        if len(missing) > 0:
+            raise ValueError('%r are not parameters of the state' % list(
+                    missing))
+        drop.update(remove_params)
+    return [p for p in all_params if p not in drop]
+
+def separate_linear_params(s, params):
+    """
+    Separates a list of parameters into those which the model is jointly
+    linear in and the rest.
+
+    A parameter is linear if its component provides a linear basis (see
+    :func:`peri.comp.comp.Component.linear_basis`) and the model is linear
+    in the component. Parameters which are only linear separately (e.g. the
+    x-y and z coefficients of a ``Polynomial2P1D`` with ``operation='*'``)
+    are split so that the linear set is as large as possible while its
+    basis images do not depend on each other.
+
+    Parameters
+    ----------
+        s : :class:`peri.states.ImageState`
+            The state.
+        params : List
+            The parameter names to separate.
 
-def get_num_px_jtj(s, nparams, decimate=1, max_mem=1e9, min_redundant=20):
+    Returns
+    -------
+        nonlinear : List
+            The parameters which the model is not (jointly) linear in.
+        linear : List
+            The parameters which the model is jointly linear in.
+    """
+    candidates = []
+    for p in params:
+        c = s._linear_comp(p)
+        if c is not None and c.linear_basis(p) is not None:
+            candidates.append((len(c.linear_deps(p)), p, c))
+
+    #Greedily, fewest dependencies first:
+    chosen = []
+    for _, p, c in sorted(candidates):
+        deps = set(c.linear_deps(p))
+        dvars = s.mdl.difference_variables(c.category)
+        clash = False
+        for q, d in chosen:
+            clash |= (q in deps) or (p in d.linear_deps(q))
+            clash |= (d is not c) and ((d.category in dvars) or
+                    (c.category in s.mdl.difference_variables(d.category)))
+        if not clash:
+            chosen.append((p, c))
+
+    linear = [p for p in params if p in set([q for q, _ in chosen])]
+    nonlinear = [p for p in params if p not in set(linear)]
+    return nonlinear, linear
+
+def get_num_px_jtj(s, nparams, decimate=1, max_mem=1e9, min_redundant=20,
+        itemsize=8):
     """
     Calculates the number of pixels to use for J at a given memory usage.
 
@@ -162,6 +257,9 @@ def get_num_px_jtj(s, nparams, decimate=1, max_mem=1e9, min_redundant=20):
         min_redundant : Int, optional
             The number of pixels must be at least `min_redundant` *
             `nparams`. If not, an error is raised. Default is 20
+        itemsize : Int, optional
+            The number of bytes per element of J, e.g. 4 for a J stored
+            at single precision. Default is 8
 
     Returns
     -------
@@ -169,7 +267,7 @@ def get_num_px_jtj(s, nparams, decimate=1, max_mem=1e9, min_redundant=20):
             The number of pixels at which to calcualte J.
     """
     #1. Max for a given max_mem:
-    px_mem = int(max_mem / 8 / nparams) #1 float = 8 bytes
+    px_mem = int(max_mem / itemsize / nparams) #1 float64 = 8 bytes
     #2. num_pix for a given redundancy
     px_red = min_redundant*nparams
     #3. And # desired for decimation
@@ -208,9 +306,19 @@ def vectorize_damping(params, damping=1.0, increase_list=[['psf-', 1e4]]):
     return damp_vec
 
 def low_mem_sq(m, step=100000):
-    """np.dot(m, m.T) with low mem usage, by doing it in small steps"""
+    """
+    np.dot(m, m.T) with low mem usage, by doing it in small steps. If `m`
+    is not double precision, the product is accumulated in float64 over
+    chunks of `step` columns.
+    """
     if not m.flags.c_contiguous:
         raise ValueError('m must be C ordered for this to work with less mem.')
+    if m.dtype != np.float64:
+        mmt = np.zeros([m.shape[0], m.shape[0]])
+        for a in xrange(0, m.shape[1], step):
+            mc = m[:, a:a+step].astype('float64')
+            mmt += np.dot(mc, mc.T)
+        return mmt
     # -- can make this even faster with pre-allocating arrays, but not worth it
     # right now
     # mmt = np.zeros([m.shape[0], m.shape[0]])  #6us
@@ -231,6 +339,53 @@ def low_mem_sq(m, step=100000):
         mmt[:, a:mx] = np.dot(m, m[a:mx].T)
     return mmt
 
+def low_mem_dot(m, v, step=100000):
+    """
+    np.dot(m, v) accumulated in double precision, upcasting `m` in chunks
+    of `step` columns if it is stored at a lower precision.
+    """
+    if m.dtype == np.float64:
+        return np.dot(m, v)
+    out = np.zeros((m.shape[0],) + np.shape(v)[1:])
+    for a in xrange(0, m.shape[1], step):
+        out += np.dot(m[:, a:a+step].astype('float64'), v[a:a+step])
+    return out
+
+def check_J_precision(J, residuals, damping=1.0, dtype='float32'):
+    """
+    Compares the Levenberg-Marquardt quantities from a double-precision J
+    with those from J stored at `dtype` and accumulated in float64.
+
+    Parameters
+    ----------
+        J : numpy.ndarray
+            [nparams, npix] C-ordered Jacobian at double precision.
+        residuals : numpy.ndarray
+            [npix] residuals at the pixels of J.
+        damping : Float, optional
+            The Marquardt damping of the step to compare. Default is 1.0
+        dtype : numpy.dtype or string, optional
+            The storage precision to test. Default is 'float32'
+
+    Returns
+    -------
+        dict
+            The maximum relative difference of JTJ (`'jtj'`, relative to
+            the diagonal), of the gradient (`'grad'`) and of the damped LM
+            step (`'step'`).
+    """
+    Jl = J.astype(dtype)
+    jtj0, jtj1 = np.dot(J, J.T), low_mem_sq(Jl)
+    g0, g1 = np.dot(J, residuals), low_mem_dot(Jl, residuals)
+    d = np.sqrt(np.outer(np.diag(jtj0), np.diag(jtj0)))
+    nrm = lambda x: np.sqrt(np.dot(x, x))
+    step = lambda jtj, g: np.linalg.lstsq(jtj + damping*np.diag(np.diag(jtj)),
+            -g, rcond=1e-13)[0]
+    s0, s1 = step(jtj0, g0), step(jtj1, g1)
+    return {'jtj': np.max(np.abs(jtj1 - jtj0) / np.clip(d, 1e-300, np.inf)),
+            'grad': nrm(g1 - g0) / max(nrm(g0), 1e-300),
+            'step': nrm(s1 - s0) / max(nrm(s0), 1e-300)}
+
 #=============================================================================#
 #               ~~~~~  Particle Optimization stuff  ~~~~~
 #=============================================================================#
@@ -250,6 +405,8 @@ def find_particles_in_tile(state, tile):
         numpy.ndarray, int
             The indices of the particles in the tile.
     """
+    if hasattr(state, 'obj_particles_in_tile'):
+        return state.obj_particles_in_tile(tile)
     bools = tile.contains(state.obj_get_positions())
     return np.arange(bools.size)[bools]
 
@@ -317,7 +474,8 @@ def separate_particles_into_groups(s, region_size=40, bounds=None,
 
     return groups
 
-def calc_particle_group_region_size(s, region_size=40, max_mem=1e9, **kwargs):
+def calc_particle_group_region_size(s, region_size=40, max_mem=1e9,
+        itemsize=8, **kwargs):
     """
     Finds the biggest region size for LM particle optimization with a
     given memory constraint.
@@ -330,6 +488,8 @@ def calc_particle_group_region_size(s, region_size=40, max_mem=1e9, **kwargs):
             The initial guess for the region size. Default is 40
         max_mem : Numeric, optional
             The maximum memory for the optimizer to take. Default is 1e9
+        itemsize : Int, optional
+            The number of bytes per element of J. Default is 8 (float64)
 
     Other Parameters
     ----------------
@@ -359,7 +519,7 @@ def calc_particle_group_region_size(s, region_size=40, max_mem=1e9, **kwargs):
             nms = s.param_particle(group)
             tile = s.get_update_io_tiles(nms, s.get_values(nms))[2]
             return tile.shape.prod() * len(nms)
-        mems = [8*get_tile_jsize(g) for g in biggroups]  # 8 for bytes/float64
+        mems = [itemsize*get_tile_jsize(g) for g in biggroups]
         return np.max(mems)
 
     im_shape = s.oshape.shape
@@ -375,6 +535,48 @@ def calc_particle_group_region_size(s, region_size=40, max_mem=1e9, **kwargs):
 
     return region_size
 
+def color_particle_groups(s, particle_groups, margin=2):
+    """
+    Colors particle groups so that groups of the same color can be
+    optimized at the same time.
+
+    Two groups conflict if their padded update tiles, grown by `margin`
+    pixels to allow for the particles moving, overlap. A group gets a
+    color later than that of every earlier group it conflicts with, so
+    running the colors in order keeps every pair of conflicting groups in
+    the order of `particle_groups`, as in a serial run.
+
+    LM steps are not bounded, so the margin is only a guess of how far the
+    particles move; LMParticleGroupCollection checks the tiles the groups
+    actually touched and re-runs those which overlap.
+
+    Parameters
+    ----------
+        s : :class:`peri.states.ImageState`
+            The state with the particles
+        particle_groups : List
+            The groups of particle indices, as returned by
+            separate_particles_into_groups.
+        margin : Int, optional
+            The number of pixels to pad the update tiles by. Default is 2
+
+    Returns
+    -------
+        colors : numpy.ndarray of ints
+            The color of each group, starting from 0.
+    """
+    tiles = []
+    for group in particle_groups:
+        nms = s.param_particle(group)
+        tiles.append(s.get_update_io_tiles(nms, s.get_values(nms))[0].pad(
+                margin))
+    colors = np.zeros(len(particle_groups), dtype='int')
+    for a in xrange(len(tiles)):
+        for b in xrange(a):
+            if (Tile.intersection(tiles[a], tiles[b]).shape > 0).all():
+                colors[a] = max(colors[a], colors[b] + 1)
+    return colors
+
 def get_residuals_update_tile(st, padded_tile):
     """
     Translates a tile in the padded image to the unpadded image.
@@ -398,6 +600,85 @@ def get_residuals_update_tile(st, padded_tile):
     inner_tile = st.ishape.intersection([st.ishape, padded_tile])
     return inner_tile.translate(-st.pad)
 
+def calc_particle_J(st, params, inds=None, slicer=None, max_mem=1e9,
+        dtype='float64', colored=False):
+    """
+    Builds the model Jacobian for a group of particle parameters, pushing
+    the analytic derivatives of each particle through the psf as one stack
+    with ``psf.execute_many`` on that particle's own tile, rather than one
+    column at a time.
+
+    Parameters
+    ----------
+        st : :class:`peri.states.ImageState`
+            The state
+        params : List
+            The particle parameters (positions and/or radii) to take the
+            derivative with respect to.
+        inds : numpy.ndarray or None, optional
+            Flat indices of the model to sample, as in `gradmodel`.
+        slicer : slice or None, optional
+            Slice of the model to sample, as in `gradmodel`.
+        max_mem : Numeric, optional
+            The maximum memory, in bytes, of a single stack of fields sent
+            through the psf; larger stacks are split. Default is 1e9.
+        dtype : numpy.dtype or string, optional
+            The dtype of the returned J. Default is 'float64'
+        colored : Bool, optional
+            Whether the finite-difference columns of the fallback are
+            calculated with colored finite differences. Default is False
+
+    Returns
+    -------
+        numpy.ndarray
+            [len(params), npix] gradient of the model (not the residuals).
+
+    Notes
+    -----
+    If any of the parameters does not have an analytic derivative this
+    falls back to :func:`peri.states.ImageState.gradmodel_analytic`.
+    """
+    cols = [st._analytic_particle(p) for p in params]
+    if any([c is None for c in cols]):
+        return st.gradmodel_analytic(params=params, inds=inds,
+                slicer=slicer, colored=colored).astype(dtype, copy=False)
+
+    #one stack per particle, on that particle's own tile: the bounding tile
+    #of a spread-out group is the whole image
+    groups = {}
+    for i, (ind, j) in enumerate(cols):
+        groups.setdefault(ind, []).append((i, j))
+
+    obj = st.get('obj')
+    coords = st._sample_coords(inds=inds, slicer=slicer)
+    J = np.zeros([len(params), coords[0].size], dtype=dtype)
+    for ind, these in groups.iteritems():
+        gtile, dP = obj.particle_grad(ind)
+        otile, itile, iotile = st.get_io_tiles(gtile)
+        st.set_tile(otile)
+
+        #Which samples lie in the changed region, and where they are in it:
+        tile = itile.translate(-st.ishape.l)
+        mask = np.ones(coords[0].size, dtype='bool')
+        for c, l, r in zip(coords, tile.l, tile.r):
+            mask &= (c >= l) & (c < r)
+        sinds = (slice(None),) + tuple(c[mask] - l for c, l in
+                zip(coords, tile.l))
+
+        #fields, their transforms and the output ~ 4 arrays of floats/column
+        chunk = max(int(max_mem / 8 / 4 / otile.volume), 1)
+        for start in xrange(0, len(these), chunk):
+            block = these[start:start+chunk]
+            fields = np.zeros((len(block),) + tuple(otile.shape))
+            for k, (_, j) in enumerate(block):
+                fields[k][gtile.translate(-otile.l).slicer] = dP[j]
+            dms = st.mdl.evaluate(st.comps, 'get',
+                    diffmap={obj.category: fields})
+            dms = dms[(slice(None),) + tuple(iotile.slicer)][sinds]
+            for (i, _), dm in zip(block, dms):
+                J[i, mask] = dm
+    return J
+
 #=============================================================================#
 #         ~~~~~        Class/Engine LM minimization Stuff     ~~~~~
 #=============================================================================#
@@ -493,6 +774,10 @@ class LMEngine(object):
         broyden_update_frequency: Int, optional
             If broyden_update, the frequency to do this partial update.
             Default is 1.
+        J_dtype: numpy.dtype or string, optional
+            The dtype to store J in. Set to 'float32' to halve the memory
+            of J; JTJ and the gradient are still accumulated in float64.
+            Default is 'float64'.
 
     Attributes
     ----------
@@ -620,7 +905,8 @@ class LMEngine(object):
                 errtol=1e-5, exptol=1e-3, fractol=1e-6, costol=None,
                 max_iter=5, run_length=5, update_J_frequency=1,
                 broyden_update=True, eig_update=False, eig_update_frequency=3,
-                num_eig_dirs=8, eig_dl=1e-5, broyden_update_frequency=1):
+                num_eig_dirs=8, eig_dl=1e-5, broyden_update_frequency=1,
+                J_dtype='float64'):
         self.increase_damp_factor = float(increase_damp_factor)
         self.decrease_damp_factor = float(decrease_damp_factor)
         self.min_eigval = min_eigval
@@ -645,6 +931,7 @@ class LMEngine(object):
         self._inner_run_counter = 0
         self.eig_update_frequency = eig_update_frequency
         self.broyden_update_frequency = broyden_update_frequency
+        self.J_dtype = np.dtype(J_dtype)
 
         #Initializing counters etc for the first loop:
         self._num_iter = 0
@@ -959,8 +1246,7 @@ class LMEngine(object):
             if (subblock.sum() == 0) or (subblock.size == 0):
                 CLOG.fatal('Empty subblock in find_LM_updates')
                 raise ValueError('Empty sub-block')
-            j = self.J[subblock]
-            JTJ = np.dot(j, j.T)
+            JTJ = self.JTJ[subblock][:, subblock]
             damped_JTJ = self._calc_damped_jtj(JTJ, subblock=subblock)
             grad = grad[subblock]  #select the subblock of the grad
         else:
@@ -994,7 +1280,7 @@ class LMEngine(object):
             CLOG.debug('%d degenerate of %d total directions' % (
                     delta0.size-rank, delta0.size))
         if subblock is not None:
-            delta = np.zeros(self.J.shape[0])
+            delta = np.zeros(self.param_vals.size)
             delta[subblock] = delta0
         else:
             delta = delta0.copy()
@@ -1203,17 +1489,23 @@ class LMEngine(object):
         #Update self._exp_err
         self._exp_err = self.error - self.find_expected_error(delta_params='perfect')
 
+    def _calc_JTJ(self):
+        """np.dot(J, J.T), accumulated in float64 if J is not."""
+        if self.J.dtype == np.float64:
+            return np.dot(self.J, self.J.T)
+        return low_mem_sq(self.J, step=max(self.J.shape[1] // 100, 1))
+
     def calc_grad(self):
         """The gradient of the cost w.r.t. the parameters."""
         residuals = self.calc_residuals()
-        return 2*np.dot(self.J, residuals)
+        return 2*low_mem_dot(self.J, residuals)
 
     def _rank_1_J_update(self, direction, values):
         """
         Does J += np.outer(direction, new_values - old_values) without
         using lots of memory
         """
-        vals_to_sub = np.dot(direction, self.J)
+        vals_to_sub = np.dot(direction.astype(self.J.dtype), self.J)
         delta_vals = values - vals_to_sub
         for a in xrange(direction.size):
             self.J[a] += direction[a] * delta_vals
@@ -1232,7 +1524,7 @@ class LMEngine(object):
         direction = delta_vals / nrm
         vals = delta_residuals / nrm
         self._rank_1_J_update(direction, vals)
-        self.JTJ = np.dot(self.J, self.J.T)
+        self.JTJ = self._calc_JTJ()
 
     def check_update_eig_J(self):
         do_update = (self.eig_update & (not self._fresh_JTJ) &
@@ -1257,7 +1549,7 @@ class LMEngine(object):
             grad_stif = (res1-res0)/dl
             self._rank_1_J_update(stif_dir, grad_stif)
 
-        self.JTJ = np.dot(self.J, self.J.T)
+        self.JTJ = self._calc_JTJ()
         #Putting the parameters back:
         _ = self.update_function(self.param_vals)
 
@@ -1286,7 +1578,7 @@ class LMEngine(object):
         rm2 = self.calc_residuals().copy()
         der2 = (rm2 + rm1 - 2*rm0)
 
-        corr, res, rank, s = np.linalg.lstsq(damped_JTJ, np.dot(self.J, der2),
+        corr, res, rank, s = np.linalg.lstsq(damped_JTJ, low_mem_dot(self.J, der2),
                 rcond=self.min_eigval)
         corr *= -0.5
         return corr
@@ -1309,7 +1601,7 @@ class LMEngine(object):
         self.J[blk] = np.array(blk_J)
         self.update_function(p0)
         #Then we also need to update JTJ:
-        self.JTJ = np.dot(self.J, self.J.T)
+        self.JTJ = self._calc_JTJ()
         if np.any(np.isnan(self.J)) or np.any(np.isnan(self.JTJ)):
             raise FloatingPointError('J, JTJ have nans.')
 
@@ -1560,7 +1852,97 @@ class OptState(OptObj):
         self.update_function(p0)
         return np.array(J)
 
-class LMGlobals(LMEngine):
+class _StateTrialSteps(object):
+    """
+    Mixin for LMEngines which optimize ``self.param_names`` of a state
+    ``self.state``. Every trial step is pushed onto the state's update stack,
+    so that a rejected step is reverted with
+    :func:`peri.states.ImageState.pop_update` (a copy from the undo cache)
+    instead of being recomputed. A step is taken as accepted once the
+    engine's ``param_vals`` have changed since it was pushed. A step may
+    consist of several pushes, see ``_push_trial``.
+    """
+    _trial_vals = None
+    _trial_pushes = 0
+
+    def _resolve_trial(self):
+        """
+        Pops the pending trial step if it was rejected or commits it if it
+        was accepted. Returns True if the step was popped.
+        """
+        if self._trial_vals is None:
+            return False
+        rejected = np.array_equal(self._trial_vals, self.param_vals)
+        self._trial_vals = None
+        for _ in xrange(self._trial_pushes):
+            if rejected:
+                self.state.pop_update()
+            else:
+                self.state.commit_update()
+        self._trial_pushes = 0
+        return rejected
+
+    def _push_trial(self, params, values):
+        """Pushes a further update of the state onto the pending step"""
+        self._trial_pushes += 1
+        self.state.push_update(params, values)
+
+    def _update_state(self, values):
+        """
+        Updates the state's ``self.param_names`` to ``values``. Returns
+        False if this only reverted a rejected step.
+        """
+        if self._resolve_trial() and np.array_equal(values, self.param_vals):
+            return False
+        self._trial_vals = self.param_vals.copy()
+        self._push_trial(self.param_names, values)
+        return True
+
+    def do_run_1(self):
+        try:
+            super(_StateTrialSteps, self).do_run_1()
+        finally:
+            self._resolve_trial()
+
+    def do_run_2(self):
+        try:
+            super(_StateTrialSteps, self).do_run_2()
+        finally:
+            self._resolve_trial()
+
+    def do_internal_run(self, *args, **kwargs):
+        try:
+            return super(_StateTrialSteps, self).do_internal_run(*args,
+                    **kwargs)
+        finally:
+            self._resolve_trial()
+
+class _StateGlobals(_StateTrialSteps):
+    """
+    Mixin for LMEngines on the globals ``self.param_names`` of a state
+    ``self.state``, compared at the pixels ``self._inds`` of the residuals.
+    """
+    def _set_err_paramvals(self):
+        self.error = self.state.error
+        self._last_error = (1 + 2*self.fractol) * self.state.error
+        self.param_vals = np.ravel(self.state.state[self.param_names])
+        self._last_vals = self.param_vals.copy()
+
+    def calc_residuals(self):
+        return self.state.residuals.ravel()[self._inds].copy()
+
+    def update_function(self, values):
+        self._update_state(values)
+        if np.any(np.isnan(self.state.residuals)):
+            raise FloatingPointError('state update caused nans in residuals')
+        return self.state.error
+
+    def set_params(self, new_param_names, new_damping=None):
+        self.param_names = new_param_names
+        self._set_err_paramvals()
+        self.reset(new_damping=new_damping)
+
+class LMGlobals(_StateGlobals, LMEngine):
     """
     Levenberg-Marquardt, optimized for state globals.
 
@@ -1608,43 +1990,24 @@ class LMGlobals(LMEngine):
         self.state = state
         self.opt_kwargs = opt_kwargs
         self.max_mem = max_mem
+        itemsize = np.dtype(kwargs.get('J_dtype', 'float64')).itemsize
         self.num_pix = get_num_px_jtj(state, len(param_names), max_mem=max_mem,
-                **self.opt_kwargs)
+                itemsize=itemsize, **self.opt_kwargs)
         self.param_names = param_names
         super(LMGlobals, self).__init__(**kwargs)
 
-    def _set_err_paramvals(self):
-        self.error = self.state.error
-        self._last_error = (1 + 2*self.fractol) * self.state.error
-        self.param_vals = np.ravel(self.state.state[self.param_names])
-        self._last_vals = self.param_vals.copy()
-
     def calc_J(self):
         del self.J
         # self.J, self._inds = get_rand_Japprox(self.state,
                 # self.param_names, num_inds=self.num_pix)
         je, self._inds = get_rand_Japprox(self.state, self.param_names,
-                num_inds=self.num_pix, include_cost=True)
+                num_inds=self.num_pix, include_cost=True, dtype=self.J_dtype)
         self.J = je[0]
         #Storing the _direction_ of the exact gradient of the model, rescaled
         #as to the size we expect from the inds:
         rescale = float(self.J.shape[1])/self.state.residuals.size
         self._graderr = je[1] * rescale
 
-    def calc_residuals(self):
-        return self.state.residuals.ravel()[self._inds].copy()
-
-    def update_function(self, values):
-        self.state.update(self.param_names, values)
-        if np.any(np.isnan(self.state.residuals)):
-            raise FloatingPointError('state update caused nans in residuals')
-        return self.state.error
-
-    def set_params(self, new_param_names, new_damping=None):
-        self.param_names = new_param_names
-        self._set_err_paramvals()
-        self.reset(new_damping=new_damping)
-
     def update_select_J(self, blk):
         """
         Updates J only for certain parameters, described by the boolean
@@ -1655,7 +2018,7 @@ class LMGlobals(LMEngine):
         blk_J = -self.state.gradmodel(params=params, inds=self._inds, flat=False)
         self.J[blk] = blk_J
         #Then we also need to update JTJ:
-        self.JTJ = np.dot(self.J, self.J.T)
+        self.JTJ = self._calc_JTJ()
         if np.any(np.isnan(self.J)) or np.any(np.isnan(self.JTJ)):
             raise FloatingPointError('J, JTJ have nans.')
 
@@ -1742,9 +2105,199 @@ class LMGlobals(LMEngine):
             return self._graderr
         else:
             residuals = self.calc_residuals()
-            return 2*np.dot(self.J, residuals)
+            return 2*low_mem_dot(self.J, residuals)
+
+class LMStreamGlobals(_StateGlobals, LMEngine):
+    """
+    Levenberg-Marquardt on state globals over every pixel of the image,
+    without storing J.
+
+    The image is streamed in blocks of pixels (slabs of z-slices, or rows
+    of a slice if one slice is too large) whose columns of J for all the
+    parameters fit in `max_mem`. On each block every parameter is changed
+    once, its columns found with
+    :func:`peri.states.ImageState.gradmodel_tiles` over that block alone,
+    and the block's part of JTJ and JTr is added up. Besides the state
+    itself, the memory is that of JTJ and one block of J and of the model.
+    The gradient between full
+    J updates follows the quadratic model, and the Broyden and eigen
+    updates act on JTJ directly, matching the model to the measured
+    error along the step or the stiff directions.
+
+    Parameters
+    ----------
+        state : :class:`peri.states.ImageState`
+            The state to optimize. Stored as self.state.
+        param_names : List
+            List of the parameter names (strings) to optimize over. Stored
+            as self.param_names.
+        max_mem : Numeric, optional
+            The maximum memory of the block of J kept at once. If all of J
+            fits, each parameter is changed once per J update; otherwise
+            once per block of pixels. Default is 1e9. Stored as
+            self.max_mem
+        dl : Float, optional
+            The finite-difference step for J. Default is 2e-5.
+
+    Methods
+    -------
+        set_params(new_param_names, new_damping=None)
+            Change the parameter names to optimize.
+        update_select_J(blk)
+            Updates the rows and columns of JTJ and JTr of the parameters
+            in the boolean mask `blk`.
+        reset(new_damping=None)
+            Resets counters etc to zero, allowing more runs to commence.
 
-class LMParticles(LMEngine):
+    See Also
+    --------
+        LMGlobals : LM optimization on globals with a sampled, stored J.
+        do_levmarq : Convenience function, with ``stream=True``
+
+    Notes
+    -----
+    The eigen update finite-differences the error rather than the
+    residuals, so `eig_dl` defaults to 1e-3 here. The geodesic
+    acceleration (``use_accel``) needs J and is not supported.
+    """
+    def __init__(self, state, param_names, max_mem=1e9, dl=2e-5, **kwargs):
+        if kwargs.get('use_accel', False):
+            raise ValueError('use_accel is not supported by LMStreamGlobals')
+        kwargs.setdefault('eig_dl', 1e-3)
+        self.state = state
+        self.max_mem = max_mem
+        self.dl = dl
+        self.num_pix = state.residuals.size
+        self.param_names = param_names
+        self._inds = slice(0, None)
+        super(LMStreamGlobals, self).__init__(**kwargs)
+
+    def _chunk_tiles(self, ncols):
+        """
+        Tiles of the inner image whose `ncols` columns of J fit in max_mem:
+        slabs of whole z-slices, or of rows of a slice etc if one slice
+        does not fit.
+        """
+        shape = self.state.residuals.shape
+        npx = max(self.max_mem / (8. * ncols), 1)
+        a = min([i for i in xrange(len(shape)) if np.prod(shape[i+1:]) <=
+                npx])
+        n = int(np.clip(npx / np.prod(shape[a+1:]), 1, shape[a]))
+        for lead in itertools.product(*[xrange(m) for m in shape[:a]]):
+            for x0 in xrange(0, shape[a], n):
+                x1 = min(x0 + n, shape[a])
+                yield Tile(list(lead) + [x0] + [0]*(len(shape)-a-1),
+                        [l+1 for l in lead] + [x1] + list(shape[a+1:]))
+
+    def _stream_JTJ(self, rows):
+        """
+        Sets the rows and columns `rows` of JTJ and the elements `rows` of
+        JTr, at the current parameters, streaming over blocks of pixels.
+        """
+        rows = np.asarray(rows)
+        n = len(self.param_names)
+        JTJ = np.zeros([rows.size, n])
+        JTr = np.zeros(rows.size)
+        for tile in self._chunk_tiles(n):
+            m0 = self.state.model_tile(tile)
+            J = np.zeros([n, tile.volume])
+            for i, p in enumerate(self.param_names):
+                for g in self.state.gradmodel_tiles(p, [tile], dl=self.dl,
+                        models=[m0]):
+                    #J = grad(residuals) = -grad(model)
+                    J[i] = -g
+            JTJ += np.dot(J[rows], J.T)
+            JTr += np.dot(J[rows], self.state.residuals[tile.slicer].ravel())
+            del J
+        self.JTJ[rows] = JTJ
+        self.JTJ[:, rows] = JTJ.T
+        self._JTr[rows] = JTr
+        self._J_vals = self.param_vals.copy()
+
+    def update_J(self):
+        """Accumulates JTJ and JTr over the image, and internal counters."""
+        n = len(self.param_names)
+        self.JTJ = np.zeros([n, n])
+        self._JTr = np.zeros(n)
+        self._stream_JTJ(np.arange(n))
+
+        self._graderr = 2*self._JTr
+        self._fresh_JTJ = True
+        self._J_update_counter = 0
+        if np.any(np.isnan(self.JTJ)):
+            raise FloatingPointError('J, JTJ have nans.')
+        self._exp_err = self.error - self.find_expected_error(delta_params='perfect')
+
+    def update_select_J(self, blk):
+        """
+        Updates the rows and columns of JTJ, and the elements of JTr, of
+        the parameters in the boolean mask `blk` by streaming them over
+        the image. The rest of JTr is moved to the current parameters
+        along the quadratic model.
+        """
+        self.update_function(self.param_vals)
+        self._JTr = 0.5*self.calc_grad()
+        self._stream_JTJ(np.nonzero(blk)[0])
+        if np.any(np.isnan(self.JTJ)):
+            raise FloatingPointError('J, JTJ have nans.')
+
+    def calc_grad(self):
+        """The gradient of the cost, from JTr and the quadratic model."""
+        return 2*(self._JTr + np.dot(self.JTJ, self.param_vals - self._J_vals))
+
+    def calc_model_cosine(self, decimate=None, mode='err'):
+        """
+        Calculates the cosine of the residuals with the model tangent
+        space, :math:`|P^T r|/|r|` with :math:`|P^T r|^2 = r^T J^T (J J^T)^{-1} J r`,
+        from JTJ and JTr over the whole image. `decimate` and `mode` are
+        accepted for compatibility with LMEngine and ignored, as both of
+        its modes reduce to this.
+        """
+        JTr = 0.5*self.calc_grad()
+        proj = np.linalg.lstsq(self.JTJ, JTr, rcond=self.min_eigval)[0]
+        return np.sqrt(np.clip(np.dot(JTr, proj) / self.error, 0, 1))
+
+    def _rank_1_JTJ_update(self, direction, curvature):
+        """Sets the curvature of JTJ along the unit vector `direction`"""
+        old = np.dot(direction, np.dot(self.JTJ, direction))
+        self.JTJ += (max(curvature, 0.5*old) - old) * np.outer(direction,
+                direction)
+
+    def update_Broyden_J(self):
+        """
+        Secant update of JTJ along the last step, so that the quadratic
+        model reproduces the error found at the end of the step.
+        """
+        CLOG.debug('Broyden update.')
+        delta_vals = self.param_vals - self._last_vals
+        nrm2 = np.dot(delta_vals, delta_vals)
+        if nrm2 == 0:
+            return
+        grad = 2*(self._JTr + np.dot(self.JTJ, self._last_vals - self._J_vals))
+        linear_err = self._last_error + np.dot(grad, delta_vals)
+        direction = delta_vals / np.sqrt(nrm2)
+        self._rank_1_JTJ_update(direction, (self.error - linear_err) / nrm2)
+
+    def update_eig_J(self):
+        """
+        Eigen update of JTJ and the gradient from the error measured on
+        either side of the stiffest directions.
+        """
+        CLOG.debug('Eigen update.')
+        vls, vcs = np.linalg.eigh(self.JTJ)
+        p0 = self.param_vals.copy()
+        er0 = self.error
+        dl = self.eig_dl
+        for a in xrange(min([self.num_eig_dirs, vls.size])):
+            stif_dir = vcs[:, -(a+1)]
+            er_p = self.update_function(p0 + dl*stif_dir)
+            er_m = self.update_function(p0 - dl*stif_dir)
+            self._rank_1_JTJ_update(stif_dir, (er_p + er_m - 2*er0)/(2*dl*dl))
+            slope = (er_p - er_m) / (2*dl)
+            self._JTr += 0.5*(slope - np.dot(self.calc_grad(), stif_dir)) * stif_dir
+        _ = self.update_function(p0)
+
+class LMParticles(_StateTrialSteps, LMEngine):
     """
     Levenberg-Marquardt, optimized for state globals.
 
@@ -1760,6 +2313,15 @@ class LMParticles(LMEngine):
         include_rad : Bool, optional
             Whether or not to include the particle radii in the
             optimization. Default is True
+        colored_J : Bool, optional
+            Set to True to calculate J with colored finite differences,
+            perturbing particles with non-overlapping tiles together. See
+            :func:`peri.states.ImageState.color_params`. Only the columns
+            without analytic derivatives are finite differences, so set
+            `analytic_J` to False to color all of them. Default is False
+        analytic_J : Bool, optional
+            Set to False to calculate J with finite differences even if the
+            particle draw method has analytic derivatives. Default is True
 
     Attributes
     ----------
@@ -1796,13 +2358,21 @@ class LMParticles(LMEngine):
     the pad and barely overlapping the image) these numbers might be
     insufficient.
     """
-    def __init__(self, state, particles, include_rad=True, **kwargs):
+    def __init__(self, state, particles, include_rad=True, colored_J=False,
+            analytic_J=True, **kwargs):
         self.state = state
+        self.colored_J = colored_J
+        self.analytic_J = analytic_J
         if len(particles) == 0:
             raise ValueError('Empty list of particle indices')
         self.particles = particles
         self.param_names = (state.param_particle(particles) if include_rad
                 else state.param_particle_pos(particles))
+        if colored_J and analytic_J and hasattr(state, '_analytic_particle'
+                ) and all([state._analytic_particle(p) is not None for p in
+                self.param_names]):
+            CLOG.warn('colored_J has no effect as J is analytic for all the '
+                    'particle parameters; set analytic_J=False to use it')
         self._dif_tile = self._get_diftile()
         #Max, min rads, distance from edge for allowed updates
         self._MINRAD = 1e-3
@@ -1835,11 +2405,17 @@ class LMParticles(LMEngine):
         self._dif_tile = self._get_diftile()
         del self.J
         #J = grad(residuals) = -grad(model)
-        if self._dif_tile.volume > 0:
+        if self._dif_tile.volume > 0 and self.analytic_J and hasattr(
+                self.state, 'gradmodel_analytic'):
+            self.J = -calc_particle_J(self.state, self.param_names,
+                slicer=self._dif_tile.slicer, dtype=self.J_dtype,
+                colored=self.colored_J)
+        elif self._dif_tile.volume > 0:
             self.J = -self.state.gradmodel(params=self.param_names, rts=True,
-                slicer=self._dif_tile.slicer)
+                slicer=self._dif_tile.slicer, colored=self.colored_J).astype(
+                self.J_dtype, copy=False)
         else:
-            self.J = np.zeros([len(self.param_names), 1])
+            self.J = np.zeros([len(self.param_names), 1], dtype=self.J_dtype)
 
     def calc_residuals(self):
         if self._dif_tile.volume > 0:
@@ -1857,7 +2433,7 @@ class LMParticles(LMEngine):
                     self._MINDIST - pd[a], self.state.ishape.shape[a] +
                     pd[a] - self._MINDIST)
 
-        self.state.update(self.param_names, values)
+        self._update_state(values)
         if np.any(np.isnan(self.state.residuals)):
             raise FloatingPointError('state update caused nans in residuals')
         return self.state.error
@@ -1898,6 +2474,9 @@ class LMParticleGroupCollection(object):
             Set to True to create a series of temp files that save J
             for each group of particles. Needed for do_internal_run().
             Default is False.
+        n_workers : Int, optional
+            The number of processes to optimize groups of particles with
+            at the same time. Default is 1, i.e. serially.
 
     Other Parameters
     ----------------
@@ -1947,15 +2526,36 @@ class LMParticleGroupCollection(object):
     which will raise an error. So use with caution. Deleting any
     references to the temp files by deleting the LMParticleGroupCollection
     instance will close and remove the temporary files.
+
+    With `n_workers` > 1 the groups are colored with color_particle_groups
+    and the groups of each color are run by one pool of processes, created
+    once per run. Each worker is handed its own copy of this collection
+    and its state when the pool starts (which the fork of the pool shares
+    copy-on-write with the parent). Each worker returns only the new
+    particle values and the bounding tile of every position it tried,
+    and puts its copy of the state back. The parent commits the values to
+    the state color by color, in group order, and sends the committed
+    updates along with the next groups so that the workers replay them
+    before optimizing. A group whose tile overlaps that of an
+    earlier group of the same color moved further than the coloring
+    allowed for, and is re-run serially on the updated state instead. So
+    this gives the same result as the serial run, except that termination
+    tests relative to the total error (`fractol`) see the error before the
+    other groups of the same color were optimized, rather than after.
+    Passing
+    ``J_dtype='float32'`` through to LMParticles stores J, and the temp
+    files, at single precision, so the region size picked for a given
+    `max_mem` holds about twice as many pixels.
     """
     def __init__(self, state, region_size=40, do_calc_size=True, max_mem=1e9,
-            get_cos=False, save_J=False, **kwargs):
+            get_cos=False, save_J=False, n_workers=1, **kwargs):
         self.state = state
         self._kwargs = kwargs
         self.region_size = region_size
         self.get_cos = get_cos
         self.save_J = save_J
         self.max_mem = max_mem
+        self.n_workers = n_workers
 
         self.reset(do_calc_size=do_calc_size)
 
@@ -1982,8 +2582,10 @@ class LMParticleGroupCollection(object):
         if new_max_mem != None:
             self.max_mem = new_max_mem
         if do_calc_size:
+            itemsize = np.dtype(self._kwargs.get('J_dtype', 'float64')).itemsize
             self.region_size = calc_particle_group_region_size(self.state,
-                    region_size=self.region_size, max_mem=self.max_mem)
+                    region_size=self.region_size, max_mem=self.max_mem,
+                    itemsize=itemsize)
         self.stats = []
         self.particle_groups = separate_particles_into_groups(self.state,
                 self.region_size, doshift='rand')
@@ -2012,34 +2614,106 @@ class LMParticleGroupCollection(object):
         j_file, tile_file = self._get_tmpfiles(group_index)
         np.save(j_file, j)
         pickle.dump(tile, tile_file)
+        #flushed, since a worker process may have written them:
+        j_file.flush()
+        tile_file.flush()
 
     def _load_j_diftile(self, group_index):
         j_file, tile_file = self._get_tmpfiles(group_index)
-        J = np.load(j_file)
+        J = np.load(j_file)  # keeps the dtype it was saved with
         tile = pickle.load(tile_file)
-        JTJ = np.dot(J, J.T)
+        JTJ = np.dot(J, J.T) if J.dtype == np.float64 else low_mem_sq(J)
         return J, JTJ, tile
 
+    def _run_group(self, group_index, mode='1', revert=False):
+        """
+        Optimizes one group of particles, returning its parameter names,
+        their new values, the termination stats and the bounding tile of
+        the model changed while optimizing. If `revert`, the state is put
+        back to the values before optimizing.
+        """
+        group = self.particle_groups[group_index]
+        lp = _TrackedLMParticles(self.state, group, **self._kwargs)
+        values0 = lp.param_vals.copy()
+        if mode == 'internal':
+            lp.J, lp.JTJ, lp._dif_tile = self._load_j_diftile(group_index)
+
+        if mode == '1':
+            lp.do_run_1()
+        if mode == '2':
+            lp.do_run_2()
+        if mode == 'internal':
+            lp.do_internal_run()
+
+        stats = lp.get_termination_stats(get_cos=self.get_cos)
+        if self.save_J and (mode != 'internal'):
+            self._dump_j_diftile(group_index, lp.J, lp._dif_tile)
+        values = np.ravel(self.state.state[lp.param_names])
+        if revert:
+            self.state.update(lp.param_names, values0)
+        return lp.param_names, values, stats, lp.touched_tile
+
     def _do_run(self, mode='1'):
         """workhorse for the self.do_run_xx methods."""
+        if self.n_workers > 1:
+            return self._do_run_parallel(mode=mode)
         for a in xrange(len(self.particle_groups)):
-            group = self.particle_groups[a]
-            lp = LMParticles(self.state, group, **self._kwargs)
-            if mode == 'internal':
-                lp.J, lp.JTJ, lp._dif_tile = self._load_j_diftile(a)
-
-            if mode == '1':
-                lp.do_run_1()
-            if mode == '2':
-                lp.do_run_2()
-            if mode == 'internal':
-                lp.do_internal_run()
-
-            self.stats.append(lp.get_termination_stats(get_cos=self.get_cos))
+            self.stats.append(self._run_group(a, mode=mode)[2])
             if self.save_J and (mode != 'internal'):
-                self._dump_j_diftile(a, lp.J, lp._dif_tile)
                 self._has_saved_J[a] = True
 
+    def _do_run_parallel(self, mode='1'):
+        """_do_run, with the groups of each color run by a process pool."""
+        colors = color_particle_groups(self.state, self.particle_groups)
+        ncolors = colors.max() + 1 if colors.size > 0 else 0
+        stats = [None] * len(self.particle_groups)
+        #the updates committed to the state so far, replayed by the workers:
+        committed = []
+        nproc = min(self.n_workers, np.bincount(colors).max()
+                if colors.size > 0 else 1)
+        pool = multiprocessing.Pool(nproc, initializer=_init_collection_worker,
+                initargs=(self,))
+        try:
+            for c in xrange(ncolors):
+                todo = np.nonzero(colors == c)[0].tolist()
+                if len(todo) == 1:
+                    results = [self._run_group(todo[0], mode=mode)]
+                    committed.append(results[0][:2])
+                else:
+                    results = pool.map(_run_collection_group,
+                            [(a, mode, committed) for a in todo])
+                    results = self._commit_color(todo, results, mode=mode)
+                    committed.extend([r[:2] for r in results])
+                for a, (_, _, st, _) in zip(todo, results):
+                    stats[a] = st
+                    if self.save_J and (mode != 'internal'):
+                        self._has_saved_J[a] = True
+        finally:
+            pool.close()
+            pool.join()
+        CLOG.debug('Ran %d particle groups in %d colors with %d processes' % (
+                len(stats), ncolors, nproc))
+        self.stats.extend(stats)
+
+    def _commit_color(self, todo, results, mode='1'):
+        """
+        Updates the state to the values found by the workers for the groups
+        `todo` of one color, in order, re-running any group whose touched
+        tile overlaps that of an earlier one. Returns the results as of the
+        committed state.
+        """
+        touched, out = [], []
+        for a, res in zip(todo, results):
+            if any([(Tile.intersection(res[3], t).shape > 0).all()
+                    for t in touched]):
+                CLOG.debug('Re-running particle group %d' % a)
+                res = self._run_group(a, mode=mode)
+            else:
+                self.state.update(res[0], res[1])
+            touched.append(res[3])
+            out.append(res)
+        return out
+
     def do_run_1(self):
         """Calls LMParticles.do_run_1 for each group of particles."""
         self._do_run(mode='1')
@@ -2056,6 +2730,49 @@ class LMParticleGroupCollection(object):
             raise RuntimeError('J, JTJ have not been pre-computed. Call do_run_1 or do_run_2')
         self._do_run(mode='internal')
 
+class _TrackedLMParticles(LMParticles):
+    """
+    LMParticles which keeps the bounding tile of the padded update tiles of
+    every position tried, `touched_tile`, i.e. all of the model it changed.
+    """
+    def __init__(self, *args, **kwargs):
+        super(_TrackedLMParticles, self).__init__(*args, **kwargs)
+        self.touched_tile = self._current_tile()
+
+    def _current_tile(self):
+        vals = np.ravel(self.state.state[self.param_names])
+        return self.state.get_update_io_tiles(self.param_names, vals)[0]
+
+    def update_function(self, values):
+        error = super(_TrackedLMParticles, self).update_function(values)
+        self.touched_tile = Tile.boundingtile(self.touched_tile,
+                self._current_tile())
+        return error
+
+#A pool worker's copy of the LMParticleGroupCollection being run in
+#parallel, and the number of committed updates it has replayed:
+_WORKER_COLLECTION = None
+_WORKER_REPLAYED = 0
+
+def _init_collection_worker(collection):
+    """Pool initializer for LMParticleGroupCollection._do_run_parallel"""
+    global _WORKER_COLLECTION, _WORKER_REPLAYED
+    _WORKER_COLLECTION = collection
+    _WORKER_REPLAYED = 0
+
+def _run_collection_group(args):
+    """
+    Pool worker for LMParticleGroupCollection._do_run_parallel, which
+    brings its state up to date with the updates committed by the parent
+    and optimizes a group without keeping the result.
+    """
+    global _WORKER_REPLAYED
+    group_index, mode, committed = args
+    for params, values in committed[_WORKER_REPLAYED:]:
+        _WORKER_COLLECTION.state.update(params, values)
+    _WORKER_REPLAYED = len(committed)
+    return _WORKER_COLLECTION._run_group(group_index, mode=mode, revert=True)
+
 class AugmentedState(object):
     """
     Augments a state with a set of radii(z) parameters.
@@ -2284,18 +3001,247 @@ class LMAugmentedState(LMGlobals):
     def update_select_J(self, *args, **kwargs):
         raise NotImplementedError('Not yet implemented for LMAugmentedState')
 
+class LMVarPro(LMGlobals):
+    """
+    Levenberg-Marquardt on the nonlinear globals of a state, with the
+    globals which the model is linear in eliminated by variable projection
+    (Golub & Pereyra [1]_).
+
+    Every function evaluation sets the nonlinear parameters and then solves
+    for the linear ones (ILM, background and offset coefficients) by least
+    squares on the sampled pixels, so LM only steps and damps along the
+    nonlinear directions (psf, zscale, slab, ...). J is the Kaufman [2]_
+    approximation of the Jacobian of the projected residuals, i.e. the
+    nonlinear J with its projection onto the linear basis removed.
+
+    Parameters
+    ----------
+        state : :class:`peri.states.ImageState`
+            The state to optimize. Stored as self.state.
+        param_names : List
+            The parameters to optimize. Stored as self.param_names. If
+            `linear_names` is None these are split with
+            :func:`separate_linear_params`, otherwise these are taken as
+            the nonlinear parameters.
+        linear_names : List or None, optional
+            The parameters which the model is jointly linear in, solved for
+            at each step. Stored as self.linear_names. Default is None.
+        max_mem : Numeric, optional
+            The maximum memory to use for J and the linear basis; controls
+            pixel decimation. Default is 1e9. Stored as self.max_mem
+        opt_kwargs : Dict, optional
+            Dict of ``**kwargs`` for get_num_px_jtj, i.e. keys of 'decimate',
+            'min_redundant'. Default is `{}`. Stored as self.opt_kwargs
+
+    Attributes
+    ----------
+        num_pix : Int
+            The number of pixels of the residuals used to calculate J and
+            to solve for the linear parameters. The pixels are drawn once,
+            so that repeated evaluations at the same parameters agree.
+
+    Methods
+    -------
+        solve_linear()
+            Sets the linear parameters to their least-squares values.
+        set_params(new_param_names, new_damping=None, new_linear_names=None)
+            Change the parameter names to optimize.
+        reset(new_damping=None)
+            Resets counters etc to zero, allowing more runs to commence.
+
+    See Also
+    --------
+        LMGlobals : LM optimization of all the globals together.
+        separate_linear_params : How the parameters are split.
+        do_varpro : Convenience function for LMVarPro
+
+    Notes
+    -----
+    Each function evaluation costs one convolution per linear parameter to
+    form its basis image at the sampled pixels, unless the state's linear
+    basis cache holds them for the current psf and particles. The cache
+    (``linear_cache_max_mem``) is raised for the length of each run to
+    hold the bases of two sets of nonlinear parameters, so that returning
+    to the current parameters after a trial step, or taking the better of
+    the two trial steps of ``do_run_2``, reuses them. Trial steps are pushed onto the state and
+    rejected ones are popped from its undo cache, as in LMGlobals.
+
+    References
+    ----------
+        .. [1] G. Golub and V. Pereyra, "Separable nonlinear least squares:
+            the variable projection method and its applications," Inverse
+            Problems 19, R1 (2003)
+        .. [2] L. Kaufman, "A variable projection method for solving
+            separable nonlinear least squares problems," BIT 15, 49 (1975)
+    """
+    def __init__(self, state, param_names, linear_names=None, max_mem=1e9,
+            opt_kwargs={}, **kwargs):
+        if linear_names is None:
+            param_names, linear_names = separate_linear_params(state,
+                    param_names)
+        if len(param_names) == 0:
+            raise ValueError('No nonlinear parameters to optimize')
+        self.state = state
+        self.opt_kwargs = opt_kwargs
+        self.max_mem = max_mem
+        self.J_dtype = np.dtype(kwargs.get('J_dtype', 'float64'))
+        self._set_names(param_names, linear_names)
+        LMEngine.__init__(self, **kwargs)
+
+    def _set_names(self, param_names, linear_names):
+        """
+        Sets the parameters, draws the pixels anew on the next J and sizes
+        the linear basis cache needed for two sets of bases.
+        """
+        self.param_names = param_names
+        self.linear_names = linear_names
+        #J is stored at J_dtype and the bases at double precision:
+        itemsize = self.J_dtype.itemsize
+        nparams = len(param_names) + 2*len(linear_names)*8./itemsize
+        self.num_pix = get_num_px_jtj(self.state, int(np.ceil(nparams)),
+                max_mem=self.max_mem, itemsize=itemsize, **self.opt_kwargs)
+        self._inds = None
+        self._cache_mem = 2 * 8. * len(linear_names) * self.num_pix
+
+    def _run_with_cache(self, run, *args, **kwargs):
+        """
+        Calls `run` with the state's linear basis cache raised to hold two
+        sets of bases, restoring the state's own limit when it returns.
+        """
+        old_mem = self.state.linear_cache_max_mem
+        self.state.linear_cache_max_mem = max(self._cache_mem, old_mem)
+        try:
+            return run(*args, **kwargs)
+        finally:
+            self.state.linear_cache_max_mem = old_mem
+            if old_mem < self._cache_mem:
+                self.state.reset_linear_cache()
+
+    def do_run_1(self):
+        self._run_with_cache(super(LMVarPro, self).do_run_1)
+
+    def do_run_2(self):
+        self._run_with_cache(super(LMVarPro, self).do_run_2)
+
+    def do_internal_run(self, *args, **kwargs):
+        return self._run_with_cache(super(LMVarPro, self).do_internal_run,
+                *args, **kwargs)
+
+    def _set_err_paramvals(self):
+        self.solve_linear()
+        super(LMVarPro, self)._set_err_paramvals()
+
+    def _sample_inds(self):
+        tot_pix = self.state.residuals.size
+        if self.num_pix < tot_pix:
+            return np.sort(np.random.choice(tot_pix, size=self.num_pix,
+                    replace=False))
+        return slice(0, None)
+
+    def calc_linear_basis(self):
+        """
+        Returns the [n_linear, num_pix] gradient of the model wrt the linear
+        parameters at the sampled pixels.
+        """
+        if self._inds is None:
+            self._inds = self._sample_inds()
+        B = []
+        for p in self.linear_names:
+            B.append(self.state._linear_column(p, inds=self._inds))
+        return np.array(B)
+
+    def _project(self, J, B=None):
+        """
+        Removes from J its projection onto the rows of B, in double
+        precision, returning it at the dtype of J.
+        """
+        if len(self.linear_names) == 0:
+            return J
+        if B is None:
+            B = self.calc_linear_basis()
+        coeffs = np.linalg.lstsq(B.T, J.T.astype('float64'),
+                rcond=self.min_eigval)[0]
+        return (J - np.dot(coeffs.T, B)).astype(J.dtype, copy=False)
+
+    def _linear_solution(self):
+        """The least-squares values of the linear parameters"""
+        B = self.calc_linear_basis()
+        r = self.state.residuals.ravel()[self._inds]
+        dc = np.linalg.lstsq(B.T, r, rcond=self.min_eigval)[0]
+        return np.ravel(self.state.state[self.linear_names]) + dc
+
+    def solve_linear(self):
+        """
+        Sets the linear parameters to their least-squares values on the
+        sampled pixels, given the nonlinear ones. Returns the state error.
+        """
+        if len(self.linear_names) == 0:
+            return self.state.error
+        self.state.update(self.linear_names, self._linear_solution())
+        return self.state.error
+
+    def calc_J(self):
+        del self.J
+        if self._inds is None:
+            self._inds = self._sample_inds()
+        je, _ = get_rand_Japprox(self.state, self.param_names,
+                include_cost=True, inds=self._inds, dtype=self.J_dtype)
+        self.J = self._project(je[0])
+        #At the linear optimum, the gradient of the projected cost is the
+        #partial gradient wrt the nonlinear parameters:
+        rescale = float(self.J.shape[1])/self.state.residuals.size
+        self._graderr = je[1] * rescale
+
+    def update_function(self, values):
+        #the linear solution is part of the trial step, so that reverting
+        #the step restores the linear parameters as well:
+        if self._update_state(values) and len(self.linear_names) > 0:
+            self._push_trial(self.linear_names, self._linear_solution())
+        if np.any(np.isnan(self.state.residuals)):
+            raise FloatingPointError('state update caused nans in residuals')
+        return self.state.error
+
+    def update_select_J(self, blk):
+        """
+        Updates J only for certain parameters, described by the boolean
+        mask blk.
+        """
+        self.update_function(self.param_vals)
+        params = np.array(self.param_names)[blk].tolist()
+        blk_J = -self.state.gradmodel(params=params, inds=self._inds, flat=False)
+        self.J[blk] = self._project(blk_J)
+        self.JTJ = self._calc_JTJ()
+        if np.any(np.isnan(self.J)) or np.any(np.isnan(self.JTJ)):
+            raise FloatingPointError('J, JTJ have nans.')
+
+    def set_params(self, new_param_names, new_damping=None,
+            new_linear_names=None):
+        """
+        Change the parameters to optimize. If `new_linear_names` is None,
+        `new_param_names` are split with :func:`separate_linear_params`.
+        """
+        if new_linear_names is None:
+            new_param_names, new_linear_names = separate_linear_params(
+                    self.state, new_param_names)
+        if len(new_param_names) == 0:
+            raise ValueError('No nonlinear parameters to optimize')
+        self._resolve_trial()
+        self._set_names(new_param_names, new_linear_names)
+        self.reset(new_damping=new_damping)
+
 #=============================================================================#
 #         ~~~~~             Convenience Functions             ~~~~~
 #=============================================================================#
 def do_levmarq(s, param_names, damping=0.1, decrease_damp_factor=10.,
         run_length=6, eig_update=True, collect_stats=False, rz_order=0,
-        run_type=2, **kwargs):
+        run_type=2, stream=False, **kwargs):
     """
     Runs Levenberg-Marquardt optimization on a state.
 
     Convenience wrapper for LMGlobals. Same keyword args, but the defaults
     have been set to useful values for optimizing globals.
-    See LMGlobals and LMEngine for documentation.
+    See LMGlobals and LMEngine for documentation. Set `stream` to True to
+    use every pixel through LMStreamGlobals instead (rz_order must be 0).
 
     See Also
     --------
@@ -2309,7 +3255,13 @@ def do_levmarq(s, param_names, damping=0.1, decrease_damp_factor=10.,
 
         LMEngine : Engine superclass for all the optimizers.
     """
-    if rz_order > 0:
+    if stream:
+        if rz_order > 0:
+            raise ValueError('stream=True requires rz_order=0')
+        lm = LMStreamGlobals(s, param_names, damping=damping, run_length=
+                run_length, decrease_damp_factor=decrease_damp_factor,
+                eig_update=eig_update, **kwargs)
+    elif rz_order > 0:
         aug = AugmentedState(s, param_names, rz_order=rz_order)
         lm = LMAugmentedState(aug, damping=damping, run_length=run_length,
                 decrease_damp_factor=decrease_damp_factor, eig_update=
@@ -2327,6 +3279,35 @@ def do_levmarq(s, param_names, damping=0.1, decrease_damp_factor=10.,
     if collect_stats:
         return lm.get_termination_stats()
 
+def do_varpro(s, param_names, damping=0.1, decrease_damp_factor=10.,
+        run_length=6, eig_update=True, collect_stats=False, run_type=2,
+        **kwargs):
+    """
+    Runs variable-projection Levenberg-Marquardt optimization on a state.
+
+    Convenience wrapper for LMVarPro. Same keyword args, but the defaults
+    have been set to useful values for optimizing globals. The linear
+    parameters among `param_names` are solved for at each step, see
+    LMVarPro and separate_linear_params.
+
+    See Also
+    --------
+        do_levmarq : Levenberg-Marquardt on all the parameters at once.
+
+        LMVarPro : Optimizer object; the workhorse of do_varpro.
+    """
+    lm = LMVarPro(s, param_names, damping=damping, run_length=run_length,
+            decrease_damp_factor=decrease_damp_factor, eig_update=eig_update,
+            **kwargs)
+    if run_type == 2:
+        lm.do_run_2()
+    elif run_type == 1:
+        lm.do_run_1()
+    else:
+        raise ValueError('run_type=1,2 only')
+    if collect_stats:
+        return lm.get_termination_stats()
+
 def do_levmarq_particles(s, particles, damping=1.0, decrease_damp_factor=10.,
         run_length=4, collect_stats=False, max_iter=2, **kwargs):
     """
@@ -2414,7 +3395,8 @@ def do_levmarq_n_directions(s, directions, max_iter=2, run_length=2,
 
 def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
         errtol=1e-2, mode='burn', max_mem=1e9, include_rad=True,
-        do_line_min='default', partial_log=False, dowarn=True):
+        do_line_min='default', partial_log=False, dowarn=True, varpro=False,
+        n_workers=1):
     """
     Optimizes all the parameters of a state.
 
@@ -2466,6 +3448,14 @@ def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
         dowarn : Bool, optional
             Whether to log a warning if termination results from finishing
             loops rather than from convergence. Default is True.
+        varpro : Bool, optional
+            Set to True to optimize the globals with LMVarPro, solving for
+            the linear globals (ILM, background, offset) at every step
+            instead of damping them. Ignored if rz_order > 0. Default is
+            False.
+        n_workers : Int, optional
+            The number of processes to optimize the particle groups with,
+            see LMParticleGroupCollection. Default is 1.
 
     Returns
     -------
@@ -2532,7 +3522,7 @@ def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
     CLOG.info('Start of loop %d:\t%f' % (0, s.error))
     for a in xrange(n_loop):
         start_err = s.error
-        start_params = np.copy(s.state[s.params])
+        start_params = s.get_values_at()
         #2a. Globals
         # glbl_dmp = 0.3 if a == 0 else 3e-2
         ####FIXME we damp degenerate but convenient spaces in the ilm, bkg
@@ -2543,15 +3533,29 @@ def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
         ####
         glbl_dmp = vectorize_damping(glbl_nms + ['rz']*rz_order, damping=1.0,
                 increase_list=[['psf-', 3e1]] + BAD_LIST)
+        if varpro and rz_order == 0:
+            nonlin_nms, lin_nms = separate_linear_params(s, glbl_nms)
+            vp_dmp = vectorize_damping(nonlin_nms, damping=1.0,
+                    increase_list=[['psf-', 3e1]] + BAD_LIST)
         if a != 0 or mode != 'do-particles':
             if partial_log:
                 log.set_level('debug')
-            gstats = do_levmarq(s, glbl_nms, max_iter=glbl_mx_itr, run_length=
-                    glbl_run_length, eig_update=eig_update, num_eig_dirs=10,
-                    eig_update_frequency=3, rz_order=rz_order, damping=
-                    glbl_dmp, decrease_damp_factor=10., use_accel=use_accel,
-                    collect_stats=collect_stats, fractol=0.1*fractol,
-                    max_mem=max_mem)
+            if varpro and rz_order == 0 and len(nonlin_nms) > 0:
+                gstats = do_varpro(s, nonlin_nms, linear_names=lin_nms,
+                        max_iter=glbl_mx_itr, run_length=glbl_run_length,
+                        eig_update=eig_update, num_eig_dirs=10,
+                        eig_update_frequency=3, damping=vp_dmp,
+                        decrease_damp_factor=10., use_accel=use_accel,
+                        collect_stats=collect_stats, fractol=0.1*fractol,
+                        max_mem=max_mem)
+            else:
+                gstats = do_levmarq(s, glbl_nms, max_iter=glbl_mx_itr,
+                        run_length=glbl_run_length, eig_update=eig_update,
+                        num_eig_dirs=10, eig_update_frequency=3,
+                        rz_order=rz_order, damping=glbl_dmp,
+                        decrease_damp_factor=10., use_accel=use_accel,
+                        collect_stats=collect_stats, fractol=0.1*fractol,
+                        max_mem=max_mem)
             if partial_log:
                 log.set_level('info')
             all_lm_stats.append(gstats)
@@ -2567,7 +3571,8 @@ def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
         pstats = do_levmarq_all_particle_groups(s, region_size=40, max_iter=1,
                 do_calc_size=True, run_length=4, eig_update=False,
                 damping=prtl_dmp, fractol=0.1*fractol, collect_stats=
-                collect_stats, max_mem=max_mem, include_rad=include_rad)
+                collect_stats, max_mem=max_mem, include_rad=include_rad,
+                n_workers=n_workers)
         all_lp_stats.append(pstats)
         if desc is not None:
             states.save(s, desc=desc)
@@ -2576,7 +3581,7 @@ def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
         all_loop_values.append(s.values)
 
         #2c. Line min?
-        end_params = np.copy(s.state[s.params])
+        end_params = s.get_values_at()
         _delta_vals.append(start_params - end_params)
         if do_line_min:
             all_line_stats.append(do_levmarq_n_directions(s, _delta_vals[-3:],
@@ -2603,13 +3608,14 @@ def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
     return d
 
 def finish(s, desc='finish', n_loop=4, max_mem=1e9, separate_psf=True,
-        fractol=1e-7, errtol=1e-3, dowarn=True):
+        fractol=1e-7, errtol=1e-3, dowarn=True, stream=False, n_workers=1):
     """
     Crawls slowly to the minimum-cost state.
 
-    Blocks the global parameters into small enough sections such that each
-    can be optimized separately while including all the pixels (i.e. no
-    decimation). Optimizes the globals, then the psf separately if desired,
+    Optimizes the globals while including all the pixels (i.e. no
+    decimation), either all together by accumulating JTJ over the image
+    (`stream`) or blocked into sections small enough that each J fits in
+    memory. Optimizes the globals, then the psf separately if desired,
     then particles, then a line minimization along the step direction to
     speed up convergence.
 
@@ -2636,6 +3642,16 @@ def finish(s, desc='finish', n_loop=4, max_mem=1e9, separate_psf=True,
         dowarn : Bool, optional
             Whether to log a warning if termination results from finishing
             loops rather than from convergence. Default is True.
+        stream : Bool, optional
+            If True, optimizes all the globals together with
+            LMStreamGlobals, accumulating JTJ over the full image in
+            chunks of at most `max_mem`, and likewise the psf if
+            `separate_psf`. If False, the globals are split into groups
+            small enough that each full J fits in `max_mem`. Default is
+            False.
+        n_workers : Int, optional
+            The number of processes to optimize the particle groups with,
+            see LMParticleGroupCollection. Default is 1.
 
     Returns
     -------
@@ -2647,35 +3663,40 @@ def finish(s, desc='finish', n_loop=4, max_mem=1e9, separate_psf=True,
             state's values, at the start of optimization and at the end of
             each loop, before the line minimization.
     """
-    values = [np.copy(s.state[s.params])]
+    values = [s.get_values_at()]
     remove_params = s.get('psf').params if separate_psf else None  # FIXME explicit params
     globals = name_globals(s, remove_params=remove_params)
     #FIXME this could be done much better, since much of the globals such
     #as the ilm are local. Could be done with sparse matrices and/or taking
     #nearby globals in a group and using the update tile only as the slicer,
     #rather than the full residuals.
-    gs = np.floor(max_mem / s.residuals.nbytes).astype('int')
-    groups = [globals[a:a+gs] for a in xrange(0, len(globals), gs)]
+    if stream:
+        groups = [globals]
+    else:
+        gs = np.floor(max_mem / s.residuals.nbytes).astype('int')
+        groups = [globals[a:a+gs] for a in xrange(0, len(globals), gs)]
     CLOG.info('Start  ``finish``:\t{}'.format(s.error))
     for a in xrange(n_loop):
         start_err = s.error
         #1. Min globals:
         for g in groups:
             do_levmarq(s, g, damping=0.1, decrease_damp_factor=20.,
-                    max_iter=1, max_mem=max_mem, eig_update=False)
+                    max_iter=1, max_mem=max_mem, eig_update=False,
+                    stream=stream)
         if separate_psf:
             do_levmarq(s, remove_params, max_mem=max_mem, max_iter=4,
-                    eig_update=False)
+                    eig_update=False, stream=stream)
         CLOG.info('Globals,   loop {}:\t{}'.format(a, s.error))
         if desc is not None:
             states.save(s, desc=desc)
         #2. Min particles
-        do_levmarq_all_particle_groups(s, max_iter=1, max_mem=max_mem)
+        do_levmarq_all_particle_groups(s, max_iter=1, max_mem=max_mem,
+                n_workers=n_workers)
         CLOG.info('Particles, loop {}:\t{}'.format(a, s.error))
         if desc is not None:
             states.save(s, desc=desc)
         #3. Append vals, line min:
-        values.append(np.copy(s.state[s.params]))
+        values.append(s.get_values_at())
         dv = (np.array(values[1:]) - np.array(values[0]))[-3:]
         do_levmarq_n_directions(s, dv, damping=1e-2, max_iter=2, errtol=3e-4)
         CLOG.info('Line min., loop {}:\t{}'.format(a, s.error))
@@ -2,10 +2,13 @@ import os
 import re
 import copy
 import json
+import hashlib
+import itertools
 import numpy as np
 import cPickle as pickle
 
 from functools import partial
+from collections import defaultdict, OrderedDict
 from contextlib import contextmanager
 
 from peri import util, comp, models
@@ -71,6 +74,14 @@ out : ndarray or None, optional
     check for shape internally; will just raise an error. Default is None,
     i.e. initialize the output internally.
 
+colored : boolean, optional
+    Gradients only. If True, parameters which change non-overlapping
+    regions of the model are perturbed together and their derivatives
+    separated by region, so the number of updates is the number of colors
+    instead of the number of parameters. Only valid for `func` which sample
+    the model or residuals and for `nout` = 1. Always returns to start.
+    Requires an :class:`~peri.states.ImageState`. Default is False.
+
 **kwargs :
     Arguments to `func`
 """
@@ -251,6 +262,13 @@ class State(comp.ParameterGroup):
         params, values = self.stack.pop()
         self.update(params, values)
 
+    def commit_update(self):
+        """
+        Accept the last update pushed by :func:`peri.states.States.push_update`,
+        removing it from the stack without undoing the change.
+        """
+        self.stack.pop()
+
     @contextmanager
     def temp_update(self, params, values):
         """
@@ -275,11 +293,14 @@ class State(comp.ParameterGroup):
         vals = self.get_values(p)
         f0 = funct(**kwargs)
 
-        self.update(p, vals+dl)
+        if rts:
+            self.push_update(p, vals+dl)
+        else:
+            self.update(p, vals+dl)
         f1 = funct(**kwargs)
 
         if rts:
-            self.update(p, vals)
+            self.pop_update()
         if nout == 1:
             return (f1 - f0) / dl
         else:
@@ -309,7 +330,7 @@ class State(comp.ParameterGroup):
         return (f11 - f10 - f01 + f00) / (dl**2)
 
     def _grad(self, funct, params=None, dl=2e-5, rts=False, nout=1, out=None,
-            **kwargs):
+            colored=False, **kwargs):
         """
         Gradient of `func` wrt a set of parameters params. (see _graddoc)
         """
@@ -317,6 +338,10 @@ class State(comp.ParameterGroup):
             params = self.param_all()
 
         ps = util.listify(params)
+        if colored:
+            if nout != 1:
+                raise ValueError('colored gradients require nout=1')
+            return self._grad_colored(funct, ps, dl=dl, out=out, **kwargs)
         f0 = funct(**kwargs)
 
         # get the shape of the entire gradient to return and make an array
@@ -343,6 +368,13 @@ class State(comp.ParameterGroup):
         return grad  # was np.squeeze(grad)
 
 
+    def _grad_colored(self, funct, params, dl=2e-5, out=None, **kwargs):
+        """
+        Gradient of `func` perturbing groups of parameters with independent
+        support at once. (see _graddoc)
+        """
+        raise NotImplementedError('colored gradients require parameter tiles')
+
     def _jtj(self, funct, params=None, dl=2e-5, rts=False, **kwargs):
         """
         jTj of a `func` wrt to parmaeters `params`. (see _graddoc)
@@ -496,7 +528,9 @@ class PolyFitState(State):
 #=============================================================================
 class ImageState(State, comp.ComponentCollection):
     def __init__(self, image, comps, mdl=models.ConfocalImageModel(), sigma=0.04,
-            priors=None, pad=24, model_as_data=False):
+            priors=None, pad=24, model_as_data=False, undo_max_mem=2e8,
+            error_resync_interval=1000, linear_cache_max_mem=0,
+            fft_tiles=False):
         """
         The state object to create a confocal image.  The model is that of
         a spatially varying illumination field, from which platonic particle
@@ -536,8 +570,46 @@ class ImageState(State, comp.ComponentCollection):
 
         model_as_data : boolean
             Whether to use the model image as the true image after initializing
+
+        undo_max_mem : float, optional
+            The maximum number of bytes of model, residuals and component
+            fields stored by :func:`~peri.states.ImageState.push_update` so
+            that :func:`~peri.states.ImageState.pop_update` can revert an
+            update with a copy instead of recomputing the model. Set to 0 to
+            disable. Default is 2e8.
+
+        error_resync_interval : integer, optional
+            The sum of squared residuals :attr:`~peri.states.ImageState.error`
+            is updated from the changed tile on every update and recalculated
+            exactly every `error_resync_interval` updates. Set to 0 to never
+            recalculate. Default is 1000.
+
+        linear_cache_max_mem : float, optional
+            The maximum number of bytes of samples of blurred basis images
+            (e.g. H(term_k*(1-P)) for an ILM coefficient) cached for the
+            parameters which the model is linear in, see
+            :func:`~peri.states.ImageState.gradmodel_analytic`. Set to 0 to
+            calculate these gradients with finite differences. Default is 0.
+
+        fft_tiles : boolean, optional
+            Whether to grow the padded update tiles to the next size whose
+            prime factors are all 2, 3, 5 or 7 (see
+            :func:`~peri.util.fft_size`), which the FFTs of the PSF transform
+            quickly. Rounding means fewer distinct tile shapes, and so fewer
+            FFT plans and PSF kernels to compute and cache. The model is the
+            same to within floating point rounding. Default is False.
         """
         self.dim = image.get_image().ndim
+        self.stack = []
+        self.undo_max_mem = undo_max_mem
+        self.error_resync_interval = error_resync_interval
+        self.linear_cache_max_mem = linear_cache_max_mem
+        self.fft_tiles = fft_tiles
+        self._versions = {}
+        self._version_clock = itertools.count(1)
+        self.reset_tile_stats()
+        self.reset_undo_cache()
+        self.reset_linear_cache()
 
         self.sigma = sigma
         self.priors = priors
@@ -589,6 +661,7 @@ class ImageState(State, comp.ComponentCollection):
 
         self._model = np.zeros(self._data.shape, dtype=np.float64)
         self._residuals = np.zeros(self._data.shape, dtype=np.float64)
+        self.reset_linear_cache()
         self.calculate_model()
 
     def set_tile_full(self):
@@ -603,13 +676,16 @@ class ImageState(State, comp.ComponentCollection):
     def reset(self):
         for c in self.comps:
             c.initialize()
+        self.reset_linear_cache()
         self.calculate_model()
 
     def calculate_model(self):
+        self._update_count += 1
         self._model[:] = self._calc_model()
         self._residuals[:] = self._calc_residuals()
         self._loglikelihood = self._calc_loglikelihood()
         self._logprior = self._calc_logprior()
+        self.resync_error()
 
     @property
     def data(self):
@@ -625,10 +701,370 @@ class ImageState(State, comp.ComponentCollection):
     def residuals(self):
         return self._residuals[self.inner]
 
+    @property
+    def error(self):
+        """
+        Sum of the squared residuals, kept up to date from the changed tile
+        during updates. See :func:`~peri.states.ImageState.resync_error`.
+        """
+        return self._error
+
     @property
     def loglikelihood(self):
         return self._loglikelihood
 
+    def color_params(self, params, dl=2e-5):
+        """
+        Greedy graph coloring of the parameters `params`, where two
+        parameters are connected if an update of each by `dl` changes
+        overlapping regions of the model. Parameters of the same color can
+        therefore be perturbed together without their effects mixing.
+
+        Returns
+        -------
+        colors : list of tuples
+            One (params, tiles) pair per color, where tiles are the regions
+            of the padded model changed by each parameter (None if the
+            parameter does not change the model).
+        """
+        colors = []
+        for p in util.listify(params):
+            tile = self.get_update_io_tiles([p], [self.get_values(p)+dl])[1]
+            for cparams, ctiles in colors:
+                if tile is not None and all([t is not None and
+                        (util.Tile.intersection(tile, t).shape <= 0).any()
+                        for t in ctiles]):
+                    cparams.append(p)
+                    ctiles.append(tile)
+                    break
+            else:
+                colors.append(([p], [tile]))
+        return colors
+
+    def _sample_coords(self, inds=None, slicer=None, flat=True):
+        """
+        Coordinates (in the inner image) of the elements returned by
+        :func:`~peri.states.sample` of the model for the same arguments
+        """
+        shape = self.model.shape
+        if inds is not None:
+            return np.unravel_index(inds, shape)
+
+        if slicer is None:
+            slicer = tuple(slice(None) for s in shape)
+        vecs = [np.arange(s)[sl] for s, sl in zip(shape, slicer)]
+        return [v.ravel() for v in np.meshgrid(*vecs, indexing='ij')]
+
+    def _grad_colored(self, funct, params, dl=2e-5, out=None, **kwargs):
+        """
+        Gradient of `func` wrt `params`, one update per color of
+        :func:`~peri.states.ImageState.color_params`. (see _graddoc)
+        """
+        ps = util.listify(params)
+        f0 = funct(**kwargs)
+        grad = out if out is not None else np.zeros((len(ps),) + f0.shape)
+
+        index = {p: i for i, p in enumerate(ps)}
+        coords = self._sample_coords(**kwargs)
+
+        for cparams, ctiles in self.color_params(ps, dl=dl):
+            vals = np.array(util.listify(self.get_values(cparams)))
+            self.push_update(cparams, vals + dl)
+            df = (funct(**kwargs) - f0) / dl
+            self.pop_update()
+
+            for p, tile in zip(cparams, ctiles):
+                if tile is None:
+                    grad[index[p]] = 0
+                    continue
+
+                # only keep the part of the change inside this param's tile
+                tile = tile.translate(-self.ishape.l)
+                mask = np.ones(df.size, dtype='bool')
+                for c, l, r in zip(coords, tile.l, tile.r):
+                    mask &= (c >= l) & (c < r)
+                grad[index[p]] = df * mask.reshape(df.shape)
+        return grad
+
+    def reset_linear_cache(self):
+        """ Forget all cached linear basis images """
+        self._linear = OrderedDict()
+        self._linear_mem = 0
+
+    def _bump_versions(self, comps):
+        """
+        Give `comps` new version numbers, which are never reused, after
+        their values changed.
+        """
+        for c in comps:
+            self._versions[c.category] = next(self._version_clock)
+
+    def _linear_comp(self, param):
+        """
+        The component whose field `param` enters, if the model is linear in
+        that component.
+        """
+        comps = self.lmap.get(param, [])
+        if len(comps) != 1:
+            return None
+        if not self.mdl.is_linear(comps[0].category):
+            return None
+        return comps[0]
+
+    def _linear_key(self, param, c):
+        """
+        What the blurred basis image of `param` depends on: the values of
+        the dependencies of the basis itself and the versions of all the
+        components in the difference model (e.g. the psf and the particles).
+        """
+        deps = self.mdl.difference_variables(c.category)
+        vals = tuple(util.listify(c.get_values(c.linear_deps(param))))
+        return vals, tuple(self._versions.get(d.category, 0)
+                for d in self.comps if d.category in deps)
+
+    @staticmethod
+    def _sample_key(inds, slicer):
+        """A hashable key for the pixels sampled by `inds` or `slicer`"""
+        def _slices(sl):
+            sl = sl if isinstance(sl, (list, tuple)) else [sl]
+            return tuple((i.start, i.stop, i.step) for i in sl)
+
+        if inds is not None:
+            if isinstance(inds, slice):
+                return ('slice',) + _slices(inds)
+            inds = np.ascontiguousarray(inds)
+            digest = hashlib.sha1(inds.view('uint8')).hexdigest()
+            return ('inds', inds.shape, inds.dtype.str, digest)
+        if slicer is not None:
+            return ('slicer',) + _slices(slicer)
+        return None
+
+    def _linear_column(self, param, inds=None, slicer=None):
+        """
+        The blurred basis image of `param` over the inner image, i.e. the
+        exact gradient of the model, sampled at `inds` or `slicer` as
+        :func:`~peri.states.sample` and flattened, or None if it has no
+        linear basis. The samples are cached, up to `linear_cache_max_mem`
+        bytes with the least recently used dropped first, under
+        :func:`~peri.states.ImageState._linear_key`. As versions are never
+        reused, the samples of earlier versions stay valid, and are hit
+        again once an update is undone from the undo cache.
+        """
+        c = self._linear_comp(param)
+        if c is None:
+            return None
+
+        ckey = (param, self._sample_key(inds, slicer),
+                self._linear_key(param, c))
+        dm = self._linear.pop(ckey, None)
+        if dm is not None:
+            self._linear[ckey] = dm
+            return dm
+
+        basis = c.linear_basis(param)
+        if basis is None:
+            return None
+
+        self.set_tile_full()
+        if isinstance(basis, np.ndarray):
+            basis = basis[c.tile.slicer]
+        dm = self.mdl.evaluate(self.comps, 'get', diffmap={c.category: basis})
+        dm = (np.zeros(self._model.shape) + dm)[self.inner]
+        dm = sample(dm, inds=inds, slicer=slicer).copy()
+
+        if dm.nbytes <= self.linear_cache_max_mem:
+            while self._linear_mem + dm.nbytes > self.linear_cache_max_mem:
+                self._linear_mem -= self._linear.popitem(last=False)[1].nbytes
+            self._linear[ckey] = dm
+            self._linear_mem += dm.nbytes
+        return dm
+
+    def _analytic_particle(self, param):
+        """
+        The particle index and coordinate of `param` if the model gradient
+        wrt `param` can be calculated analytically, otherwise None.
+        """
+        obj = self.get('obj')
+        if (not getattr(obj, 'analytic_grad', False) or
+                obj not in self.pmap.get(param, ()) or
+                not self.mdl.get_difference_model(obj.category)):
+            return None
+        typ, ind = obj._p2i(param)
+        if typ not in ['z', 'y', 'x', 'a']:
+            return None
+        return ind, 'zyxa'.index(typ)
+
+    def gradmodel_analytic(self, params, inds=None, slicer=None, flat=True,
+            include_cost=False, check=False, out=None, **kwargs):
+        """
+        Gradient of the model wrt `params`, as :func:`gradmodel`. The
+        columns of particle positions and radii are
+        calculated from the analytic derivative of the particle field, see
+        :func:`peri.comp.objs.PlatonicSpheresCollection.particle_grad`,
+        pushed through the difference model of the objects (e.g. the
+        ``ConfocalImageModel`` gives dM = H((C-I) dP)). If the linear basis
+        cache is on (`linear_cache_max_mem` > 0), the columns of parameters
+        which the model is linear in (ILM and background coefficients, the
+        offset) are the exact blurred basis images, see
+        :func:`~peri.comp.comp.Component.linear_basis`. All other parameters
+        use finite differences, with `rts` as given in `kwargs`.
+
+        Parameters
+        -----------
+        params : string or list of strings
+            Paramter(s) to take the derivative wrt
+
+        include_cost : boolean, optional
+            If True, also return the gradient of the error, as
+            :func:`gradmodel_e`. Default is False
+
+        check : boolean, optional
+            If True, also calculate the analytic columns with finite
+            differences and log their largest relative difference. Default
+            is False
+
+        out : ndarray, list of ndarrays or None, optional
+            If set, the return array(s) for the output, see _graddoc.
+
+        **kwargs :
+            Passed to the finite-difference gradient, including `dl` and
+            `rts`.
+        """
+        ps = util.listify(params)
+        f0 = sample(self.model, inds=inds, slicer=slicer, flat=flat)
+        skw = {'inds': inds, 'slicer': slicer, 'flat': flat}
+
+        if out is None:
+            grad = np.zeros((len(ps),) + f0.shape)
+            gerr = np.zeros(len(ps))
+        elif include_cost:
+            grad, gerr = out
+        else:
+            grad, gerr = out, np.zeros(len(ps))
+
+        particles, numeric = {}, []
+        for i, p in enumerate(ps):
+            ind = self._analytic_particle(p)
+            if ind is not None:
+                particles.setdefault(ind[0], []).append((i, ind[1]))
+                continue
+
+            dm = None
+            if self.linear_cache_max_mem > 0:
+                dm = self._linear_column(p, inds=inds, slicer=slicer)
+            if dm is None:
+                numeric.append(i)
+                continue
+            grad[i] = dm.reshape(f0.shape)
+            if include_cost:
+                dm = self._linear_column(p)
+                gerr[i] = -2*np.dot(self.residuals.ravel(), dm)
+
+        # everything which is not a particle gets finite differences, with
+        # the caller's `rts`: returning to start costs a full recompute for
+        # components without snapshots, such as the psf
+        if len(numeric) > 0:
+            nps = [ps[i] for i in numeric]
+            if include_cost:
+                ng, ne = self.gradmodel_e(params=nps, **dict(skw, **kwargs))
+                gerr[numeric] = ne
+            else:
+                ng = self.gradmodel(params=nps, **dict(skw, **kwargs))
+            grad[numeric] = ng
+
+        obj = self.get('obj')
+        coords = self._sample_coords(**skw)
+        for ind, cols in particles.iteritems():
+            dtile, dP = obj.particle_grad(ind)
+            otile, itile, iotile = self.get_io_tiles(dtile)
+            self.set_tile(otile)
+
+            # samples and residuals within the changed region of the model
+            tile = itile.translate(-self.ishape.l)
+            mask = np.ones(f0.size, dtype='bool')
+            for c, l, r in zip(coords, tile.l, tile.r):
+                mask &= (c >= l) & (c < r)
+            sinds = tuple(c[mask] - l for c, l in zip(coords, tile.l))
+
+            etile = util.Tile.intersection(itile, self.ishape)
+            res = self._residuals[etile.slicer]
+
+            # all columns of this particle go through the psf as one stack
+            fields = np.zeros((len(cols),) + tuple(otile.shape))
+            for k, (i, j) in enumerate(cols):
+                fields[k][dtile.translate(-otile.l).slicer] = dP[j]
+            dms = self.mdl.evaluate(
+                self.comps, 'get', diffmap={obj.category: fields}
+            )
+
+            for (i, j), dm in zip(cols, dms):
+                dm = dm[iotile.slicer]
+                g = np.zeros(f0.size)
+                g[mask] = dm[sinds]
+                grad[i] = g.reshape(f0.shape)
+
+                dme = dm[etile.translate(-itile.l).slicer]
+                gerr[i] = -2*np.dot(res.ravel(), dme.ravel())
+
+        if check and len(numeric) < len(ps):
+            ainds = [i for i in xrange(len(ps)) if i not in numeric]
+            fd = self.gradmodel(params=[ps[i] for i in ainds], **dict(skw,
+                    **dict(kwargs, rts=True)))
+            an = grad[ainds]
+            err = np.abs(fd - an).max() / max(np.abs(fd).max(), 1e-300)
+            log.info('analytic gradient max relative difference %e' % err)
+
+        if include_cost:
+            return [grad, gerr]
+        return grad
+
+    def model_tile(self, tile):
+        """
+        The model evaluated over `tile` of the inner image alone (in the
+        coordinates of `model`), leaving the state's model untouched.
+        """
+        tile = tile.translate(self.ishape.l)
+        otile = self.get_io_tiles(tile)[0]
+        self.set_tile(otile)
+        return self.mdl.evaluate(self.comps, 'get')[
+                tile.translate(-otile.l).slicer]
+
+    def gradmodel_tiles(self, param, tiles, dl=2e-5, models=None):
+        """
+        Finite-difference gradient of the model wrt `param` within each of
+        `tiles` of the inner image, as a generator. The parameter is changed
+        once for all the tiles and restored afterwards, and the model is
+        evaluated over each tile alone, so a gradient costs two component
+        updates plus one convolution the size of each tile.
+
+        Parameters
+        ----------
+        param : string
+            The parameter to differentiate by.
+        tiles : list of :class:`peri.util.Tile`
+            Regions of the inner image, in the coordinates of `model`.
+        dl : float, optional
+            The finite-difference step. Default is 2e-5.
+        models : list of ndarrays, optional
+            The unperturbed models on `tiles`, from
+            :func:`~peri.states.ImageState.model_tile`, to reuse them over
+            several parameters. Computed if not given.
+
+        Yields
+        ------
+        grad : ndarray
+            [tile.volume] gradient of the model within each tile in turn
+        """
+        if models is None:
+            models = [self.model_tile(t) for t in tiles]
+        v0 = self.get_values(param)
+        comp.ComponentCollection.update(self, param, v0 + dl)
+        try:
+            for tile, m0 in zip(tiles, models):
+                yield ((self.model_tile(tile) - m0) / dl).ravel()
+        finally:
+            comp.ComponentCollection.update(self, param, v0)
+
     def get_update_io_tiles(self, params, values):
         """
         Get the tiles corresponding to a particular section of image needed to
@@ -640,6 +1076,14 @@ class ImageState(State, comp.ComponentCollection):
         otile = self.get_update_tile(params, values)
         if otile is None:
             return [None]*3
+        return self.get_io_tiles(otile)
+
+    def get_io_tiles(self, otile):
+        """
+        Get the padded tile, inner tile and slicer between them needed to
+        calculate the model over the changed region `otile`, as in
+        :func:`~peri.states.ImageState.get_update_io_tiles`.
+        """
         ptile = self.get_padding_size(otile) or util.Tile(0, dim=otile.dim)
 
         otile = util.Tile.intersection(otile, self.oshape)
@@ -659,8 +1103,46 @@ class ImageState(State, comp.ComponentCollection):
 
         outer = util.Tile.intersection(outer, self.oshape)
         inner = util.Tile.intersection(inner, self.oshape)
+        if self.fft_tiles:
+            outer = self._fft_tile(outer)
+            iotile = inner.translate(-outer.l)
         return outer, inner, iotile
 
+    def _fft_tile(self, tile):
+        """
+        Grow `tile` evenly on both sides to the next FFT friendly shape,
+        shifting it back inside the image where it would hang over an edge.
+        Dimensions which would grow past the image are set to its full size.
+
+        Dimensions in which `tile` already touches an edge of the image are
+        left alone: there the inner tile reaches the edge as well, and the
+        periodic wrap of the PSF transform at the far side of the tile would
+        move if the tile grew.
+        """
+        edge = (tile.l <= self.oshape.l) | (tile.r >= self.oshape.r)
+        size = np.array([util.fft_size(i) for i in tile.shape])
+        size = np.where(edge, tile.shape, np.minimum(size, self.oshape.shape))
+
+        l = tile.l - (size - tile.shape) // 2
+        l = np.clip(l, self.oshape.l, self.oshape.r - size)
+        return util.Tile(l, l + size)
+
+    def reset_tile_stats(self):
+        """Reset the counts of update tile shapes, see `tile_stats`"""
+        self._tile_shapes = defaultdict(int)
+
+    def tile_stats(self):
+        """
+        The number of padded tiles updated by
+        :func:`~peri.states.ImageState.update` since the last
+        :func:`~peri.states.ImageState.reset_tile_stats` and the number of
+        distinct shapes among them, with the count of each shape. Every
+        distinct shape needs its own FFT plans and PSF kernels.
+        """
+        return {'tiles': sum(self._tile_shapes.values()),
+                'distinct_shapes': len(self._tile_shapes),
+                'shapes': dict(self._tile_shapes)}
+
     def update(self, params, values):
         """
         Actually perform an image (etc) update based on a set of params and
@@ -681,6 +1163,8 @@ class ImageState(State, comp.ComponentCollection):
             return False
 
         # have all components update their tiles
+        self._update_count += 1
+        self._tile_shapes[tuple(otile.shape)] += 1
         self.set_tile(otile)
 
         oldmodel = self._model[itile.slicer].copy()
@@ -709,6 +1193,7 @@ class ImageState(State, comp.ComponentCollection):
             # allow the model to be evaluated using our components
             diff = self.mdl.evaluate(self.comps, 'get')
             self._model[itile.slicer] = diff[iotile.slicer]
+        self._bump_versions(comps)
 
         newmodel = self._model[itile.slicer].copy()
 
@@ -717,6 +1202,113 @@ class ImageState(State, comp.ComponentCollection):
         self.update_from_model_change(oldmodel, newmodel, itile)
         return True
 
+    def reset_undo_cache(self):
+        """
+        Forget all stored undo information and reset the undo statistics
+        `undo_stats`, a dictionary with the number of `hits` (pops reverted
+        from the cache), `misses` (pops reverted by recomputing the model)
+        and `bytes` (the total size of the cached sections restored).
+        """
+        self._undo = [None]*len(self.stack)
+        self._undo_mem = 0
+        self._update_count = 0
+        self.undo_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+    def _undo_snapshot(self, params, values):
+        """
+        Copy the parts of the model, residuals and component fields which are
+        modified by the update (params, values). Returns None if the update
+        cannot be reverted from a copy or if it does not fit in memory.
+        """
+        comps = self.affected_components(params)
+        if len(comps) == 0 or self.undo_max_mem <= 0:
+            return None
+
+        otile, itile, iotile = self.get_update_io_tiles(params, values)
+        if otile is None:
+            return None
+
+        nbytes = 2 * itile.volume * self._model.itemsize
+        if self._undo_mem + nbytes > self.undo_max_mem:
+            return None
+
+        csnaps = []
+        for c in comps:
+            snap = c.snapshot(params, otile)
+            if snap is None:
+                return None
+            nbytes += sum([a.nbytes for _, _, a in snap])
+            csnaps.append((c, snap))
+
+        if self._undo_mem + nbytes > self.undo_max_mem:
+            return None
+
+        return {
+            'tile': itile, 'comps': csnaps, 'nbytes': nbytes,
+            'model': self._model[itile.slicer].copy(),
+            'residuals': self._residuals[itile.slicer].copy(),
+            'loglikelihood': self._loglikelihood, 'count': self._update_count,
+            'versions': dict(self._versions),
+            'error': (self._error, self._error_comp, self._error_nupdates),
+        }
+
+    def push_update(self, params, values):
+        """
+        Perform a parameter update and keep track of the change on the state,
+        as :func:`peri.states.State.push_update`. The sections of the model,
+        residuals and component fields changed by the update are stored (up
+        to `undo_max_mem` bytes) so that the matching
+        :func:`~peri.states.ImageState.pop_update` is only a copy.
+        """
+        snap = self._undo_snapshot(params, values)
+        super(ImageState, self).push_update(params, values)
+
+        if snap is not None:
+            snap['count'] = (snap['count'], self._update_count)
+            self._undo_mem += snap['nbytes']
+        self._undo.append(snap)
+
+    def pop_update(self):
+        """
+        Undo the last update pushed by
+        :func:`~peri.states.ImageState.push_update`. If the state has not
+        changed otherwise since the push, the stored sections are copied back
+        in place, otherwise the update is reverted by recomputing the model.
+        """
+        snap = self._undo.pop()
+        if snap is not None:
+            self._undo_mem -= snap['nbytes']
+
+        if snap is None or snap['count'][1] != self._update_count:
+            self.undo_stats['misses'] += 1
+            return super(ImageState, self).pop_update()
+
+        params, values = self.stack.pop()
+        comp.ComponentCollection.set_values(self, params, values)
+        for c, csnap in snap['comps']:
+            c.restore(csnap)
+
+        tile = snap['tile']
+        self._model[tile.slicer] = snap['model']
+        self._residuals[tile.slicer] = snap['residuals']
+        self._loglikelihood = snap['loglikelihood']
+        self._error, self._error_comp, self._error_nupdates = snap['error']
+        self._update_count = snap['count'][0]
+        self._versions = snap['versions']
+
+        self.undo_stats['hits'] += 1
+        self.undo_stats['bytes'] += snap['nbytes']
+
+    def commit_update(self):
+        """
+        Accept the last update pushed by
+        :func:`~peri.states.ImageState.push_update`, freeing its undo cache.
+        """
+        snap = self._undo.pop()
+        if snap is not None:
+            self._undo_mem -= snap['nbytes']
+        super(ImageState, self).commit_update()
+
     def get(self, name):
         """ Return component by category name """
         for c in self.comps:
@@ -727,6 +1319,7 @@ class ImageState(State, comp.ComponentCollection):
     def set(self, name, obj):
         comp.ComponentCollection.set(self, name, obj)
         obj.set_shape(self.oshape, self.ishape)
+        self.reset_linear_cache()
         self.calculate_model()
 
     def _calc_model(self):
@@ -753,6 +1346,7 @@ class ImageState(State, comp.ComponentCollection):
 
     def update_sigma(self, sigma):
         # FIXME hyperparameters....
+        self._update_count += 1
         self.sigma = sigma
         self._loglikelihood = self._calc_loglikelihood()
 
@@ -763,8 +1357,40 @@ class ImageState(State, comp.ComponentCollection):
         """
         self._loglikelihood -= self._calc_loglikelihood(oldmodel, tile=tile)
         self._loglikelihood += self._calc_loglikelihood(newmodel, tile=tile)
+
+        # the error only counts the residuals in the inner region of the image
+        etile = util.Tile.intersection(tile, self.ishape)
+        res = self._residuals[etile.slicer].ravel()
+        olderr = np.dot(res, res)
+
         self._residuals[tile.slicer] = self._data[tile.slicer] - newmodel
 
+        res = self._residuals[etile.slicer].ravel()
+        self._update_error(np.dot(res, res) - olderr)
+
+    def _update_error(self, delta):
+        """
+        Add `delta` to the running error with Kahan compensated summation,
+        resyncing with the exact sum every `error_resync_interval` updates.
+        """
+        self._error_nupdates += 1
+        if (self.error_resync_interval > 0 and
+                self._error_nupdates >= self.error_resync_interval):
+            self.resync_error()
+            return
+
+        y = delta - self._error_comp
+        t = self._error + y
+        self._error_comp = (t - self._error) - y
+        self._error = t
+
+    def resync_error(self):
+        """ Recalculate the running sum of squared residuals exactly """
+        r = self.residuals.ravel()
+        self._error = np.dot(r, r)
+        self._error_comp = 0.0
+        self._error_nupdates = 0
+
     def exports(self):
         raise NotImplementedError('inherited but not relevant')
 
@@ -787,7 +1413,11 @@ class ImageState(State, comp.ComponentCollection):
     def __getstate__(self):
         return {'image': self.image, 'comps': self.comps, 'mdl': self.mdl,
                 'sigma': self.sigma, 'priors': self.priors, 'pad': self.pad,
-                'model_as_data': self.model_as_data}
+                'model_as_data': self.model_as_data,
+                'undo_max_mem': self.undo_max_mem,
+                'error_resync_interval': self.error_resync_interval,
+                'linear_cache_max_mem': self.linear_cache_max_mem,
+                'fft_tiles': self.fft_tiles}
 
     def __setstate__(self, idct):
         self.__init__(**idct)
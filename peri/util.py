@@ -5,8 +5,11 @@ import sys
 import time
 import inspect
 import itertools
+import threading
 import numpy as np
 from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from peri import initializers
 from peri.logger import log
@@ -29,6 +32,29 @@ def oddify(num):
     """
     return num + (num % 2 == 0)
 
+def fft_size(num, primes=(2, 3, 5, 7)):
+    """
+    Return the smallest integer ``>= num`` with no prime factors other than
+    `primes`, i.e. a size which FFTs transform quickly.
+
+    Examples
+    --------
+    >>> fft_size(11)
+    12
+
+    >>> fft_size(97)
+    98
+    """
+    num = max(int(num), 1)
+    while True:
+        n = num
+        for p in primes:
+            while n % p == 0:
+                n //= p
+        if n == 1:
+            return num
+        num += 1
+
 def listify(a):
     """
     Convert a scalar ``a`` to a list and all iterables to list as well.
@@ -1147,3 +1173,31 @@ def indir(path):
         raise
     finally:
         os.chdir(cwd)
+
+# marks the threads running parallel_map, so that nested calls run serially
+_parallel = threading.local()
+
+def parallel_map(func, items, workers=1):
+    """
+    Returns ``[func(i) for i in items]``, computed by a pool of `workers`
+    threads (all cpus if `workers` <= 0). The results are in the order of
+    `items` and so are the same as the serial version whenever the calls
+    are independent. Calls from inside another parallel_map run serially
+    rather than starting a pool per thread.
+    """
+    items = list(items)
+    workers = int(workers)
+    workers = min(workers if workers > 0 else cpu_count(), len(items))
+    if workers <= 1 or getattr(_parallel, 'active', False):
+        return [func(i) for i in items]
+
+    def run(item):
+        _parallel.active = True
+        return func(item)
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(run, items)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,69 @@
+"""
+Time drawing every particle of a PlatonicSpheresCollection with the batched
+renderer against drawing them one at a time with _draw_particle, and check
+that both give the same field.
+
+The per-particle path is only timed on (up to) the first 10k particles and
+scaled up for larger collections, which otherwise takes many minutes.
+"""
+import sys
+import time
+import numpy as np
+
+from peri import util
+from peri.comp import objs
+
+SIZES = [1000, 10000, 100000]
+MAX_SERIAL = 10000
+
+def make_spheres(N, seed=10):
+    # constant number density: 1k particles in a 64^3 box
+    np.random.seed(seed)
+    side = int(64 * (N / 1e3)**(1./3))
+    pos = np.random.rand(N, 3) * side
+    rad = 3 + 2*np.random.rand(N)
+    return objs.PlatonicSpheresCollection(pos, rad, shape=util.Tile(side))
+
+def draw_serial(P, inds):
+    P.particles = np.zeros(P.shape.shape, dtype=P.float_precision)
+    objs.PlatonicParticlesCollection._draw_particles(P, inds)
+    return P.particles
+
+def draw_batch(P, inds, workers=1):
+    P.batch_draw = True
+    P.draw_workers = workers
+    P.particles = np.zeros(P.shape.shape, dtype=P.float_precision)
+    P._draw_particles(inds)
+    return P.particles
+
+def timeit(func, *args, **kwargs):
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    return time.time() - t0, out
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or SIZES
+
+    print '%8s %12s %12s %12s %9s %12s' % ('N', 'serial (s)', 'batch (s)',
+            'batch x4 (s)', 'speedup', 'max |diff|')
+    for N in sizes:
+        P = make_spheres(N)
+
+        ns = min(N, MAX_SERIAL)
+        # untimed: fill the caches (e.g. a volume table), so neither timed
+        # run pays for them
+        draw_serial(P, np.arange(ns))
+        t_serial, f_serial = timeit(draw_serial, P, np.arange(ns))
+        t_serial *= float(N) / ns
+
+        _, f_sub = timeit(draw_batch, P, np.arange(ns))
+        diff = np.abs(f_serial - f_sub).max()
+
+        t_batch, f_batch = timeit(draw_batch, P, np.arange(N))
+        t_thread, f_thread = timeit(draw_batch, P, np.arange(N), workers=4)
+        diff = max(diff, np.abs(f_thread - f_batch).max())
+
+        print '%8i %11.2f%s %12.2f %12.2f %9.1f %12.2e' % (N, t_serial,
+                '*' if ns < N else ' ', t_batch, t_thread,
+                t_serial / t_batch, diff)
+    print '* estimated from the first %i particles' % MAX_SERIAL
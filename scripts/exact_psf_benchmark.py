@@ -0,0 +1,81 @@
+"""
+Time ExactPSF.execute, which transforms every z-plane of the field once and
+applies all the psf slices in batched 2d transforms, against the original
+per-plane version (reproduced here as `execute_per_plane`) that rolls the
+field and does a 3d transform for every plane, on the line-scan PSF of a
+many-particle state. Also checks that both give the same output.
+"""
+import sys
+import time
+import numpy as np
+
+from peri.comp import exactpsf
+from peri.fft import fft, fftkwargs
+from peri.test import init
+
+conf_linescan = {
+    'model': 'confocal-dyedfluid',
+    'comps': {
+        'psf': 'linescan',
+        'ilm': 'barnesleg2p1d',
+        'bkg': 'const',
+        'offset': 'const',
+    },
+    'args': {
+        'ilm': {'npts': (20,10,5), 'zorder': 5},
+        'bkg': {'name': 'bkg', 'value': 0},
+        'offset': {'name': 'offset', 'value': 0},
+    }
+}
+
+def execute_per_plane(psf, field):
+    outfield = np.zeros_like(field, dtype='float')
+    zc,yc,xc = psf.tile.coords(form='flat')
+
+    for i,z in enumerate(zc):
+        fs = np.array(psf.tile.shape)
+        fs[0] = psf.support[0]
+
+        if z < psf.zrange[0] or z > psf.zrange[1]:
+            continue
+
+        zslice = int(np.clip(z, *psf.zrange) - psf.zrange[0])
+        middle = field.shape[0]/2
+
+        subpsf = psf._kpad(psf.slices[zslice], fs, norm=True)
+        subfield = np.roll(field, middle - i, axis=0)
+        subfield = subfield[middle-fs[0]/2:middle+fs[0]/2+1]
+
+        kshape = subfield.shape
+        kfield = fft.rfftn(subfield, **fftkwargs)
+        outfield[i] = np.real(fft.irfftn(kfield * subpsf, s=kshape,
+                **fftkwargs))[psf.support[0]/2]
+    return outfield
+
+def timeit(func, *args, **kwargs):
+    repeat = kwargs.pop('repeat', 3)
+    func(*args)
+    t0 = time.time()
+    for i in xrange(repeat):
+        out = func(*args)
+    return (time.time() - t0) / repeat, out
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [32, 64]
+
+    print '%8s %16s %16s %10s %12s' % ('image', 'tile', 'per-plane (s)',
+            'batched (s)', 'max |diff|')
+    for size in sizes:
+        s = init.create_many_particle_state(imsize=size, radius=5.0,
+                phi=0.3, seed=10, conf=conf_linescan)
+        psf = s.get('psf')
+        assert isinstance(psf, exactpsf.ExactPSF)
+
+        field = s.get('obj').get().copy()
+        tile = psf.tile
+        t_old, h_old = timeit(execute_per_plane, psf, field)
+        t_new, h_new = timeit(psf.execute, field)
+
+        print '%8i %16s %16.3f %10.3f %12.2e' % (size,
+                'x'.join(str(i) for i in tile.shape), t_old, t_new,
+                np.abs(h_old - h_new).max())
@@ -0,0 +1,54 @@
+"""
+Time particle updates on a many-particle state with the update tiles at
+their natural size and rounded up to FFT friendly (2,3,5,7-smooth) sizes
+with ImageState(fft_tiles=True). For each it reports the updates per second,
+the number of distinct tile shapes used and the PSF kernel cache hits, and
+the largest difference between the final models of the two runs.
+"""
+import sys
+import time
+import numpy as np
+
+from peri.test import init
+
+UPDATES = 500
+
+def run_updates(s, fft_tiles, seed=10):
+    s.fft_tiles = fft_tiles
+    s.reset()
+    s.reset_tile_stats()
+
+    obj = s.get('obj')
+    np.random.seed(seed)
+    inds = np.random.randint(0, obj.N, size=UPDATES)
+    steps = 0.1*np.random.randn(UPDATES, 4)
+
+    t0 = time.time()
+    for i, dx in zip(inds, steps):
+        params = obj.param_particle(i)
+        vals = np.array(s.get_values(params))
+        s.update(params, vals + dx)
+        s.update(params, vals)
+    return time.time() - t0, s.model.copy()
+
+if __name__ == '__main__':
+    imsize = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    s = init.create_many_particle_state(imsize=imsize, radius=5.0,
+            phi=0.4, seed=10)
+
+    print '%10s %12s %10s %10s %16s' % ('fft_tiles', 'updates/s', 'tiles',
+            'shapes', 'kernel hit rate')
+    models = []
+    for fft_tiles in [False, True]:
+        psf = s.get('psf')
+        psf.get_kernel_cache().invalidate()
+        k0 = psf.kernel_stats()
+        t, model = run_updates(s, fft_tiles)
+        k1 = psf.kernel_stats()
+        tiles = s.tile_stats()
+        hits, misses = [k1[k] - k0[k] for k in ['hits', 'misses']]
+        print '%10s %12.1f %10i %10i %16.2f' % (fft_tiles, 2*UPDATES / t,
+                tiles['tiles'], tiles['distinct_shapes'],
+                hits / float(max(hits + misses, 1)))
+        models.append(model)
+    print 'max |model difference| %.2e' % np.abs(models[0] - models[1]).max()
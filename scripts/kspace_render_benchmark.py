@@ -0,0 +1,92 @@
+"""
+Time the blurred particle field H(P) computed two ways: rasterizing every
+sphere with PlatonicSpheresCollection.initialize and then applying
+psf.execute, against summing the analytic transforms of the spheres with
+get_kspace and applying the PSF in k-space directly. Also times the
+'fourier' render mode of initialize, and reports the largest difference of
+each from the rasterized result.
+
+The particles fill the image at a volume fraction of PHI with a 5%
+polydispersity, as in a real sample (overlaps do not matter for timing).
+On the smaller images the k-space sum is also compared with the direct
+sum over particles of their phase factors (`kspace_sum_direct`), which
+costs O(N x voxels) per radius node.
+"""
+import time
+import numpy as np
+
+from peri import util
+from peri.comp import objs, psfs
+
+SIDES = [32, 64, 128]
+DIRECT_MAX_SIDE = 64
+PHI = 0.4
+RADIUS = 5.0
+
+def kspace_sum_direct(P, shape, pos, rad, real=True):
+    kz, ky = [2*np.pi*np.fft.fftfreq(n) for n in shape[:2]]
+    kx = 2*np.pi*(np.fft.rfftfreq(shape[2]) if real else
+            np.fft.fftfreq(shape[2]))
+    q = np.sqrt((kz[:,None,None]/P.zscale)**2 + ky[None,:,None]**2 +
+            kx[None,None,:]**2)
+
+    lo, hi = rad.min(), rad.max()
+    n = 1 if hi - lo < 1e-10 else min(objs.KSPACE_MAX_NODES,
+            6 + int(np.ceil(q.max()*(hi - lo)/2)))
+    nodes, L = objs._lagrange_weights(rad, lo, hi, n)
+
+    out = np.zeros(q.shape, dtype='complex')
+    for m in xrange(n):
+        a = L[:,m,None] * np.exp(-1j*pos[:,0,None]*kz[None,:])
+        bc = (np.exp(-1j*pos[:,1,None]*ky[None,:])[:,:,None] *
+                np.exp(-1j*pos[:,2,None]*kx[None,:])[:,None,:])
+        sm = np.dot(a.T, bc.reshape(pos.shape[0], -1)).reshape(q.shape)
+        out += objs.sphere_kspace(q, nodes[m], P.alpha[0]) / P.zscale * sm
+    return out
+
+def timeit(func, *args):
+    t0 = time.time()
+    out = func(*args)
+    return time.time() - t0, out
+
+def real_space(P, H):
+    P.initialize()
+    return H.execute(P.get())
+
+def kspace(P, H):
+    return H.execute(P.get_kspace())
+
+if __name__ == '__main__':
+    print '%6s %6s %10s %10s %10s %10s %10s %10s %10s' % ('N', 'side',
+            'real (s)', 'kspace (s)', 'max |diff|', 'fourier (s)',
+            'max |diff|', 'direct (s)', 'max |diff|')
+    np.random.seed(10)
+    for side in SIDES:
+        tile = util.Tile(side)
+        N = int(PHI * side**3 / (4./3*np.pi*RADIUS**3))
+        pos = side*np.random.rand(N, 3)
+        rad = RADIUS*(1 + 0.05*np.random.randn(N))
+
+        P = objs.PlatonicSpheresCollection(pos, rad, shape=tile,
+                method='exact-gaussian')
+        H = psfs.AnisotropicGaussian(sigmas=(2.0, 1.0), shape=tile)
+
+        t_real, h_real = timeit(real_space, P, H)
+        p_real = P.get().copy()
+        t_k, h_k = timeit(kspace, P, H)
+
+        P.render = 'fourier'
+        t_f, _ = timeit(P.initialize)
+        p_fourier = P.get().copy()
+
+        direct = ('%10s %10s' % ('-', '-'))
+        if side <= DIRECT_MAX_SIDE:
+            args = (tuple(tile.shape), P._trans(P.pos) - tile.l, P.rad, False)
+            t_d, k_d = timeit(kspace_sum_direct, P, *args)
+            k_n = P._kspace_sum(*args)
+            direct = '%10.2f %10.2e' % (t_d, np.abs(k_d - k_n).max() /
+                    np.abs(k_d).max())
+
+        print '%6i %6i %10.2f %10.2f %10.2e %10.2f %10.2e %s' % (N, side,
+                t_real, t_k, np.abs(h_real - h_k).max(), t_f,
+                np.abs(p_real - p_fourier).max(), direct)
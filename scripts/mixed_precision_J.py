@@ -0,0 +1,35 @@
+"""
+Accuracy of storing J at single precision, compared to the float64 path,
+for the globals and for a group of particles.
+"""
+import numpy as np
+
+from peri import states, util
+from peri.comp import psfs, objs, ilms, GlobalScalar
+from peri.opt import optimize as opt
+from peri.test import nbody
+
+im = util.NullImage(np.zeros((32,)*3))
+pos, rad, tile = nbody.create_configuration(30, im.tile)
+
+P = objs.PlatonicSpheresCollection(pos, rad)
+H = psfs.AnisotropicGaussian()
+I = ilms.LegendrePoly3D(order=(5,3,3), constval=1.0)
+B = ilms.Polynomial3D(order=(3,1,1), category='bkg', constval=0.01)
+C = GlobalScalar('offset', 0.0)
+s = states.ImageState(im, [B, I, H, P, C], pad=16, model_as_data=True)
+s.update('psf-sig-z', s.get_values('psf-sig-z') * 1.05)
+
+def report(name, J, r):
+    res = opt.check_J_precision(np.ascontiguousarray(J), r)
+    print '%-10s J: %7.2f MB -> %7.2f MB' % (name, J.nbytes/1e6, J.nbytes/2e6)
+    for k in ['jtj', 'grad', 'step']:
+        print '    %-5s max rel. difference %e' % (k, res[k])
+
+gnames = opt.name_globals(s)
+J, inds = opt.get_rand_Japprox(s, gnames, num_inds=20000)
+report('globals', J, s.residuals.ravel()[inds])
+
+lp = opt.LMParticles(s, np.arange(5))
+lp.calc_J()
+report('particles', lp.J, lp.calc_residuals())
@@ -0,0 +1,55 @@
+"""
+Accuracy and speed of the table driven sphere profile
+(objs.sphere_analytical_gaussian_fast) against the erf forms it replaces.
+
+The accuracy report compares the profile and its derivatives to the trimmed
+erf form evaluated exactly, and to the full (untrimmed) analytical gaussian,
+over dr in [-3, 3] and a range of radii. The benchmark times both on the
+distances of a real drawing tile.
+"""
+import time
+import numpy as np
+
+from peri.comp import objs
+from peri.util import Tile
+
+ALPHA = 0.2765
+
+def report_accuracy():
+    dr = np.linspace(-3, 3, 200001)
+    print 'table tolerance %.1e' % objs.PROFILE_TABLE_TOLERANCE
+    print '%6s %14s %14s %14s %14s' % ('a', 'vs trim', 'vs exact',
+            'd/ddr vs trim', 'd/da vs trim')
+    for a in [1.0, 2.0, 3.0, 5.0, 10.0, 20.0]:
+        fast = objs.sphere_analytical_gaussian_fast(dr, a, ALPHA)
+        trim = objs.sphere_analytical_gaussian_trim(dr, a, ALPHA)
+        exact = objs.sphere_analytical_gaussian(dr, a, ALPHA)
+        gf = objs.sphere_analytical_gaussian_fast_grad(dr, a, ALPHA)
+        gt = objs.sphere_analytical_gaussian_trim_grad(dr, a, ALPHA)
+        print '%6.1f %14.3e %14.3e %14.3e %14.3e' % (a,
+                np.abs(fast - trim).max(), np.abs(fast - exact).max(),
+                np.abs(gf[0] - gt[0]).max(), np.abs(gf[1] - gt[1]).max())
+
+def timeit(func, args, repeat=20):
+    func(*args)
+    t0 = time.time()
+    for i in xrange(repeat):
+        func(*args)
+    return (time.time() - t0) / repeat
+
+def report_speed():
+    print '\n%8s %12s %12s %9s' % ('tile', 'trim (ms)', 'table (ms)',
+            'speedup')
+    for a in [3.0, 5.0, 10.0]:
+        tile = Tile(0, size=2*int(a+4)).translate(-int(a+4))
+        rvec = tile.coords(form='vector').astype('float')
+        dr = objs.inner(rvec, np.array([0.3, 0.1, -0.2]), a)
+        args = (dr, a, ALPHA)
+        t_trim = timeit(objs.sphere_analytical_gaussian_trim, args)
+        t_fast = timeit(objs.sphere_analytical_gaussian_fast, args)
+        print '%8s %12.3f %12.3f %9.1f' % ('%i^3' % tile.shape[0],
+                1e3*t_trim, 1e3*t_fast, t_trim / t_fast)
+
+if __name__ == '__main__':
+    report_accuracy()
+    report_speed()
@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+
+from peri.test import init
+
+class TestRegistryValues(unittest.TestCase):
+    def setUp(self):
+        self.s = init.create_many_particle_state(imsize=32, N=10,
+                radius=4.0, seed=1)
+
+    def check_values(self):
+        # the registry's value array matches the values in the components
+        s = self.s
+        params = s.params
+        self.assertEqual(len(params), len(s.get_values_at()))
+        for c in s.comps:
+            vals = s.get_values_at(s.param_slots(c.params))
+            self.assertTrue(np.array_equal(vals, c.get_values_at()))
+
+    def test_initial(self):
+        self.check_values()
+
+    def test_update(self):
+        s = self.s
+        params = s.param_particle(2) + ['psf-sigz', 'ilm-b0-1']
+        s.update(params, np.array(s.get_values(params)) + 0.05)
+        self.check_values()
+
+    def test_set_values_at(self):
+        s = self.s
+        slots = s.param_slots(s.param_particle_pos([1, 3]))
+        s.set_values_at(slots, np.arange(slots.size) + 1.0)
+        self.assertTrue(np.array_equal(s.get_values_at(slots),
+                np.arange(slots.size) + 1.0))
+        self.check_values()
+
+    def test_component_set(self):
+        # values set on a component directly reach the state's registry
+        self.s.get('ilm').randomize_parameters()
+        self.check_values()
+
+    def test_add_remove(self):
+        s = self.s
+        s.obj_add_particle([[16., 16., 16.], [8., 8., 8.]], [3., 3.])
+        self.check_values()
+        s.obj_remove_particle([0, 4])
+        self.check_values()
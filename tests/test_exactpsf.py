@@ -0,0 +1,114 @@
+import copy
+import unittest
+import numpy as np
+
+from peri import util
+from peri.comp import exactpsf, psfcalc
+from peri.fft import fft, fftkwargs
+from peri.test import init
+
+conf_linescan = {
+    'model': 'confocal-dyedfluid',
+    'comps': {
+        'psf': 'linescan',
+        'ilm': 'barnesleg2p1d',
+        'bkg': 'const',
+        'offset': 'const',
+    },
+    'args': {
+        'ilm': {'npts': (20,10,5), 'zorder': 5},
+        'bkg': {'name': 'bkg', 'value': 0},
+        'offset': {'name': 'offset', 'value': 0},
+    }
+}
+
+def execute_per_plane(psf, field):
+    """ExactPSF.execute as one 3d transform per z-plane of the output"""
+    outfield = np.zeros_like(field, dtype='float')
+    zc,yc,xc = psf.tile.coords(form='flat')
+
+    for i,z in enumerate(zc):
+        fs = np.array(psf.tile.shape)
+        fs[0] = psf.support[0]
+
+        if z < psf.zrange[0] or z > psf.zrange[1]:
+            continue
+
+        zslice = int(np.clip(z, *psf.zrange) - psf.zrange[0])
+        middle = field.shape[0]/2
+
+        subpsf = psf._kpad(psf.slices[zslice], fs, norm=True)
+        subfield = np.roll(field, middle - i, axis=0)
+        subfield = subfield[middle-fs[0]/2:middle+fs[0]/2+1]
+
+        kshape = subfield.shape
+        kfield = fft.rfftn(subfield, **fftkwargs)
+        outfield[i] = np.real(fft.irfftn(kfield * subpsf, s=kshape,
+                **fftkwargs))[psf.support[0]/2]
+    return outfield
+
+class TestExactPSF(unittest.TestCase):
+    def test_batched_matches_per_plane(self):
+        s = init.create_many_particle_state(imsize=32, radius=5.0, phi=0.3,
+                seed=10, conf=conf_linescan)
+        psf = s.get('psf')
+        self.assertTrue(isinstance(psf, exactpsf.ExactPSF))
+
+        field = s.get('obj').get().copy()
+        out0 = execute_per_plane(psf, field)
+        out1 = psf.execute(field)
+        self.assertTrue(np.allclose(out0, out1, rtol=0,
+                atol=1e-10*np.abs(out0).max()))
+
+class TestRhoTables(unittest.TestCase):
+    def setUp(self):
+        # a psf slice: many distinct rho in each of a few z-planes
+        z, y, x = np.meshgrid(np.linspace(-6, 6, 4), 0.37*np.arange(-20, 21),
+                0.41*np.arange(-20, 21), indexing='ij')
+        self.rho, self.z = np.sqrt(x**2 + y**2), z
+
+    def check(self, **kwargs):
+        exact = psfcalc.get_hsym_asym(self.rho, self.z, **kwargs)
+        table = psfcalc.get_hsym_asym_radial(self.rho, self.z, **kwargs)
+        scale = np.abs(exact[0]).max(axis=(1, 2))[:,None,None]
+        for e, t in zip(exact, table):
+            self.assertTrue((np.abs(e - t) <=
+                    psfcalc.RHO_TABLE_TOLERANCE*scale).all())
+
+    def test_illumination(self):
+        self.check(alpha=1.0, n2n1=0.95)
+
+    def test_detection(self):
+        self.check(get_hdet=True, alpha=1.1, n2n1=0.9)
+
+class TestParallelPSF(unittest.TestCase):
+    def test_parallel_map(self):
+        inner = lambda i: util.parallel_map(lambda j: 10*i + j, xrange(3),
+                workers=2)
+        self.assertEqual(util.parallel_map(inner, xrange(4), workers=3),
+                [[10*i + j for j in xrange(3)] for i in xrange(4)])
+
+    def check_psf(self, name):
+        conf = copy.deepcopy(conf_linescan)
+        conf['comps']['psf'] = name
+        s = init.create_many_particle_state(imsize=32, radius=5.0, phi=0.3,
+                seed=10, conf=conf)
+        psf = s.get('psf')
+        # the Chebyshev psfs keep the coefficients fit to their nodes
+        tables = lambda: (psf.cheb.coefficients if hasattr(psf, 'cheb')
+                else psf.slices)
+        serial = copy.deepcopy(tables())
+        workers = psfcalc.PSF_WORKERS
+        try:
+            psfcalc.PSF_WORKERS = 3
+            psf.update(psf.params, psf.values)
+        finally:
+            psfcalc.PSF_WORKERS = workers
+        self.assertTrue(np.array_equal(serial, tables()), name)
+
+    def test_psfs(self):
+        for name in ['linescan', 'cheb-linescan-fixedss']:
+            self.check_psf(name)
+
+if __name__ == '__main__':
+    unittest.main()
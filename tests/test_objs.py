@@ -0,0 +1,306 @@
+import unittest
+import numpy as np
+
+from peri import util
+from peri.comp import objs
+from peri.test import init
+
+class TestBatchedDraw(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(10)
+        self.pos = 32*np.random.rand(40, 3)
+        self.rad = 3.0 + np.random.rand(40)
+
+    def draw(self, **kwargs):
+        return objs.PlatonicSpheresCollection(self.pos, self.rad,
+                shape=util.Tile(32), batch_draw=True, **kwargs)
+
+    def draw_one_by_one(self, P):
+        P.particles[:] = 0
+        for i in xrange(P.N):
+            P._draw_particle(P.pos[i], P.rad[i])
+        return P.particles.copy()
+
+    def test_batched_matches_loop(self):
+        P = self.draw()
+        self.assertTrue(np.allclose(P.particles, self.draw_one_by_one(P),
+                rtol=0, atol=1e-12))
+
+    def test_threaded_matches_loop(self):
+        P = self.draw(draw_workers=3)
+        self.assertTrue(np.allclose(P.particles, self.draw_one_by_one(P),
+                rtol=0, atol=1e-12))
+
+    def test_methods_match_loop(self):
+        for method in ['exact-gaussian', 'exact-gaussian-trim', 'lerp',
+                'logistic', 'constrained-cubic']:
+            P = self.draw(method=method)
+            self.assertTrue(np.allclose(P.particles, self.draw_one_by_one(P),
+                    rtol=0, atol=1e-12), method)
+
+    def test_undraw(self):
+        P = self.draw()
+        P._draw_particles(np.arange(P.N), sign=-1)
+        self.assertTrue(np.abs(P.particles).max() < 1e-12)
+
+class TestProfileTable(unittest.TestCase):
+    def setUp(self):
+        self.dr = np.linspace(-2.5, 2.5, 20001)
+
+    def test_matches_erf_forms(self):
+        for a in [2.0, 3.5, 10.0]:
+            a = a*np.ones_like(self.dr)
+            fast = objs.sphere_analytical_gaussian_fast(self.dr, a)
+            trim = objs.sphere_analytical_gaussian_trim(self.dr, a)
+            self.assertTrue(np.abs(fast - trim).max() <
+                    2*objs.PROFILE_TABLE_TOLERANCE)
+            # the terms trimmed away are negligible once dr + 2a > ~2
+            if a[0] > 2:
+                full = objs.sphere_analytical_gaussian(self.dr, a)
+                self.assertTrue(np.abs(fast - full).max() < 1e-7)
+
+    def test_grad_matches_trim(self):
+        # including a small sphere, whose centre is inside the cut
+        for a in [1.0, 3.0]:
+            a = a*np.ones_like(self.dr)
+            fast = objs.sphere_analytical_gaussian_fast_grad(self.dr, a)
+            trim = objs.sphere_analytical_gaussian_trim_grad(self.dr, a)
+            for f, t in zip(fast, trim):
+                self.assertTrue(np.abs(f - t).max() < 1e-6)
+
+    def test_draw_matches_trim(self):
+        np.random.seed(10)
+        pos, rad = 32*np.random.rand(20, 3), 3.0 + np.random.rand(20)
+        fields = [objs.PlatonicSpheresCollection(pos, rad, shape=util.Tile(32),
+                method=m).particles for m in ['exact-gaussian-fast',
+                'exact-gaussian-trim']]
+        self.assertTrue(np.abs(fields[0] - fields[1]).max() < 1e-6)
+
+class TestVolumeTable(unittest.TestCase):
+    def setUp(self):
+        # particles away from the edges, whose tiles are not clipped
+        np.random.seed(10)
+        self.pos = 12 + 16*np.random.rand(6, 3)
+        self.rad = 3.0 + 2*np.random.rand(6)
+
+    def test_volume_error(self):
+        for zscale in [1.0, 0.9]:
+            for p, a in zip(self.pos, self.rad):
+                P = objs.PlatonicSpheresCollection(p[None], np.array([a]),
+                        shape=util.Tile(40), zscale=zscale)
+                goal = 4./3*np.pi*a**3 / zscale
+                self.assertTrue(np.abs(P.particles.sum() - goal) / goal <
+                        P.volume_error)
+
+    def test_matches_iteration(self):
+        # started from the table or not, every particle meets volume_error
+        for v in [True, False]:
+            for p, a in zip(self.pos, self.rad):
+                P = objs.PlatonicSpheresCollection(p[None], np.array([a]),
+                        shape=util.Tile(40), zscale=0.9, volume_table=v)
+                goal = 4./3*np.pi*a**3 / 0.9
+                self.assertTrue(np.abs(P.particles.sum() - goal) / goal <
+                        P.volume_error)
+
+class TestStampCache(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(12)
+        self.pos = np.round(12 + 16*np.random.rand(10, 3), 1)
+        self.rad = 4.0 + 0.05*np.random.randint(-2, 3, 10)
+
+    def draw(self, pos, rad, **kwargs):
+        return objs.PlatonicSpheresCollection(pos, rad, shape=util.Tile(40),
+                **kwargs)
+
+    def test_near_nodes(self):
+        # within the tolerance of the nodes: blended from the stamps
+        pos = self.pos + 0.008*(2*np.random.rand(10, 3) - 1)
+        rad = self.rad + 0.008*(2*np.random.rand(10) - 1)
+        P = self.draw(pos, rad, stamp_cache=2**28)
+        exact = self.draw(pos, rad).particles
+        self.assertTrue(np.abs(P.particles - exact).max() < 3e-3)
+
+        stats = P.stamp_stats()
+        self.assertEqual(stats['fallbacks'], 0)
+        self.assertEqual(stats['hits'] + stats['misses'], 10)
+        P.initialize()
+        self.assertEqual(P.stamp_stats()['hits'], stats['hits'] + 10)
+
+    def test_far_from_nodes(self):
+        # midway between offset nodes: drawn exactly
+        pos = self.pos + 0.05
+        P = self.draw(pos, self.rad, stamp_cache=2**28)
+        exact = self.draw(pos, self.rad).particles
+        self.assertTrue(np.allclose(P.particles, exact, rtol=0, atol=1e-12))
+        self.assertEqual(P.stamp_stats()['fallbacks'], 10)
+
+class TestDistanceCache(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(13)
+        self.pos = 12 + 16*np.random.rand(10, 3)
+        self.rad = 3.5 + np.random.rand(10)
+        self.P = self.draw(distance_cache=2**28)
+
+    def draw(self, **kwargs):
+        return objs.PlatonicSpheresCollection(self.pos, self.rad,
+                shape=util.Tile(40), **kwargs)
+
+    def assertMatchesUncached(self):
+        P = self.P
+        exact = objs.PlatonicSpheresCollection(P.pos, P.rad,
+                shape=util.Tile(40), zscale=P.zscale).particles
+        self.assertTrue(np.allclose(P.particles, exact, rtol=0, atol=1e-10))
+
+    def test_radius_update(self):
+        P = self.P
+        misses = P.distance_stats()['misses']
+        params = P.param_particle_rad([1, 5])
+        P.update(params, np.array(P.get_values(params)) + 0.3)
+        self.assertEqual(P.distance_stats()['misses'], misses)
+        self.assertMatchesUncached()
+
+    def test_zscale_update(self):
+        P = self.P
+        P.update('zscale', 0.9)
+        # the particles whose drawing tiles keep their size are rescaled
+        self.assertTrue(P.distance_stats()['rescales'] > 0)
+        self.assertMatchesUncached()
+
+    def test_position_update(self):
+        P = self.P
+        params = P.param_particle_pos(2)
+        P.update(params, np.array(P.get_values(params)) + 0.4)
+        self.assertMatchesUncached()
+
+class TestKSpace(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(14)
+        self.shape = (16, 18, 20)
+        self.pos = np.array(self.shape)*np.random.rand(6, 3)
+        self.rad = 2.5 + np.random.rand(6)
+        self.P = objs.PlatonicSpheresCollection(self.pos, self.rad,
+                shape=util.Tile(40), zscale=0.9)
+
+    def direct_sum(self, real):
+        # sum over particles of their transforms times the phase factors
+        P, shape = self.P, self.shape
+        kz, ky = [2*np.pi*np.fft.fftfreq(n) for n in shape[:2]]
+        kx = 2*np.pi*(np.fft.rfftfreq(shape[2]) if real else
+                np.fft.fftfreq(shape[2]))
+        k = np.meshgrid(kz, ky, kx, indexing='ij')
+        q = np.sqrt((k[0]/P.zscale)**2 + k[1]**2 + k[2]**2)
+        out = 0
+        for p, a in zip(self.pos, self.rad):
+            phase = np.exp(-1j*(k[0]*p[0] + k[1]*p[1] + k[2]*p[2]))
+            out = out + objs.sphere_kspace(q, a, P.alpha[0])/P.zscale*phase
+        return out
+
+    def test_nufft_matches_direct_sum(self):
+        for real in [True, False]:
+            direct = self.direct_sum(real)
+            fast = self.P._kspace_sum(self.shape, self.pos, self.rad,
+                    real=real)
+            self.assertTrue(np.abs(fast - direct).max() <
+                    1e-7*np.abs(direct).max())
+
+    def test_render_volume(self):
+        pos = 10 + 20*np.random.rand(8, 3)
+        rad = 3 + np.random.rand(8)
+        P = objs.PlatonicSpheresCollection(pos, rad, shape=util.Tile(40),
+                render='fourier')
+        goal = (4./3*np.pi*rad**3).sum()
+        self.assertTrue(np.abs(P.particles.sum() - goal) < 1e-5*goal)
+
+        params = P.param_particle_rad(0)
+        self.assertRaises(ValueError, P.update, params, [3.5])
+
+class TestAddRemove(unittest.TestCase):
+    def setUp(self):
+        self.s = init.create_many_particle_state(imsize=32, N=10,
+                radius=4.0, seed=1)
+        self.obj = self.s.get('obj')
+
+    def assertRedrawMatches(self):
+        # the incrementally updated field is the one drawn from scratch
+        P = self.obj
+        particles = P.particles.copy()
+        P.initialize()
+        self.assertTrue(np.allclose(particles, P.particles, rtol=0,
+                atol=1e-10))
+
+    def test_bulk_add_single_update(self):
+        s, P = self.s, self.obj
+        count, N = s._update_count, P.N
+        inds = s.obj_add_particle([[16., 16., 16.], [8., 20., 8.],
+                [20., 8., 24.]], [3., 3.5, 4.])
+        self.assertEqual(s._update_count - count, 1)
+        self.assertTrue(np.array_equal(inds, np.arange(N, N+3)))
+        self.assertEqual(len(s.params), len(set(s.params)))
+        self.assertRedrawMatches()
+
+    def test_remove_keeps_ids(self):
+        s, P = self.s, self.obj
+        ids, pos, rad = P.get_ids(), P.pos.copy(), P.rad.copy()
+        s.obj_remove_particle([0, 4])
+        self.assertEqual(P.N, ids.size - 2)
+        self.assertTrue(np.all(P.ids_to_inds(ids[[0, 4]]) == -1))
+
+        keep = np.setdiff1d(np.arange(ids.size), [0, 4])
+        inds = P.ids_to_inds(ids[keep])
+        self.assertTrue(np.array_equal(P.pos[inds], pos[keep]))
+        self.assertTrue(np.array_equal(P.rad[inds], rad[keep]))
+        self.assertEqual(P.params[:-1], P.param_particle(np.arange(P.N)))
+        self.assertTrue(set(P.params) <= set(s.params))
+        self.assertRedrawMatches()
+
+class TestCellList(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(11)
+        self.pos = 40*np.random.rand(200, 3) - 4
+
+    def check(self, index, pos):
+        for l, r in [([0, 0, 0], [10, 10, 10]), ([-3, 5, 2.5], [7, 33, 9]),
+                ([30, -10, 0], [50, 50, 12])]:
+            tile = util.Tile(l, r)
+            self.assertTrue(np.array_equal(index.query_tile(tile.l, tile.r,
+                    pos), np.nonzero(tile.contains(pos))[0]))
+        for x in [[5., 5., 5.], [-10., 20., 50.], pos[7]]:
+            d2 = ((pos - x)**2).sum(axis=-1)
+            self.assertTrue(np.array_equal(index.query_nearest(x, pos, k=5),
+                    np.lexsort((np.arange(d2.size), d2))[:5]))
+
+    def test_queries(self):
+        self.check(objs.CellList(self.pos), self.pos)
+
+    def test_incremental(self):
+        pos = self.pos.copy()
+        index = objs.CellList(pos[:150])
+        index.append(pos[150:])
+        moved = np.arange(0, 200, 7)
+        pos[moved] += 6*np.random.randn(moved.size, 3)
+        index.move(moved, pos[moved])
+        self.check(index, pos)
+
+        # swap-remove as in PlatonicSpheresCollection.remove_particle
+        gone = np.array([3, 50, 198])
+        keep = pos.shape[0] - gone.size
+        holes = gone[gone < keep]
+        tail = np.setdiff1d(np.arange(keep, pos.shape[0]), gone)
+        pos[holes] = pos[tail]
+        pos = pos[:keep]
+        index.compact(gone, holes, tail)
+        self.check(index, pos)
+
+    def test_follows_state(self):
+        s = init.create_many_particle_state(imsize=32, N=10, radius=4.0,
+                seed=1)
+        P = s.get('obj')
+        P.index  # build it before the changes
+        params = s.param_particle_pos([1, 2])
+        s.update(params, np.array(s.get_values(params)) + 3.0)
+        s.obj_add_particle([[16., 16., 16.]], [3.])
+        s.obj_remove_particle([0])
+        self.check(P.index, P.pos)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+import unittest
+import numpy as np
+
+from peri.test import init
+from peri.opt import optimize as opt
+
+class TestParticleJ(unittest.TestCase):
+    def test_stacked_matches_columns(self):
+        s = init.create_many_particle_state(imsize=32, N=10, radius=4.0,
+                seed=1)
+        params = s.param_particle([1, 4, 7])
+        np.random.seed(2)
+        inds = np.random.choice(s.model.size, 500, replace=False)
+
+        J0 = s.gradmodel_analytic(params, inds=inds)
+        J1 = opt.calc_particle_J(s, params, inds=inds, max_mem=1e5)
+        self.assertTrue(np.allclose(J0, J1, rtol=0,
+                atol=1e-10*np.abs(J0).max()))
+
+class TestStreamGlobals(unittest.TestCase):
+    def setUp(self):
+        self.s = init.create_many_particle_state(imsize=32, N=10,
+                radius=4.0, seed=1)
+        self.params = ['psf-sigz', 'psf-sigx', 'ilm-b0-1', 'ilm-b1-0',
+                'offset']
+
+    def dense(self):
+        s = self.s
+        J = -s.gradmodel(params=self.params, rts=True, dl=2e-5)
+        return np.dot(J, J.T), np.dot(J, s.residuals.ravel())
+
+    def assertClose(self, a, b):
+        self.assertTrue(np.allclose(a, b, rtol=0, atol=1e-6*np.abs(b).max()))
+
+    def test_matches_dense(self):
+        # several chunks of z-slices and several blocks of parameters
+        lm = opt.LMStreamGlobals(self.s, self.params,
+                max_mem=3*8*self.s.residuals.size)
+        lm.update_J()
+        JTJ, JTr = self.dense()
+        self.assertClose(lm.JTJ, JTJ)
+        self.assertClose(lm._JTr, JTr)
+
+    def test_row_blocks(self):
+        # blocks smaller than a z-slice
+        s = self.s
+        lm = opt.LMStreamGlobals(s, self.params,
+                max_mem=8*len(self.params)*s.residuals.shape[-1]*5)
+        self.assertTrue(all([t.shape[0] == 1 for t in lm._chunk_tiles(
+                len(self.params))]))
+        lm.update_J()
+        JTJ, JTr = self.dense()
+        self.assertClose(lm.JTJ, JTJ)
+        self.assertClose(lm._JTr, JTr)
+
+    def test_select_J(self):
+        s = self.s
+        lm = opt.LMStreamGlobals(s, self.params, max_mem=3*8*s.residuals.size)
+        lm.update_J()
+        lm.update_function(lm.param_vals + [0.05, -0.05, 0, 0, 0])
+        lm.update_param_vals(lm.param_vals + [0.05, -0.05, 0, 0, 0])
+        lm.update_select_J(np.array([1, 1, 0, 0, 0], dtype='bool'))
+        JTJ, JTr = self.dense()
+        self.assertClose(lm.JTJ[:2], JTJ[:2])
+        self.assertClose(lm.JTJ[:,:2], JTJ[:,:2])
+        self.assertClose(lm._JTr[:2], JTr[:2])
+
+    def test_matches_unstreamed(self):
+        s = self.s
+        params = ['psf-sigz', 'psf-sigx', 'ilm-b0-1', 'offset']
+        start = np.array(s.get_values(params)) + [0.1, -0.1, 0.02, 0.01]
+        result, error = [], []
+        for stream in [False, True]:
+            s.update(params, start)
+            opt.do_levmarq(s, params, max_iter=10, stream=stream,
+                    max_mem=1e9)
+            result.append(np.array(s.get_values(params)))
+            error.append(s.error)
+        self.assertTrue(np.allclose(result[0], result[1], rtol=0,
+                atol=1e-3))
+        self.assertTrue(np.allclose(error[0], error[1], rtol=1e-6, atol=0))
+
+class TestMixedPrecision(unittest.TestCase):
+    def setUp(self):
+        self.s = init.create_many_particle_state(imsize=32, N=10,
+                radius=4.0, seed=1)
+        self.params = ['psf-sigz', 'psf-sigx', 'zscale', 'ilm-b0-1',
+                'offset']
+
+    def check_engine(self, lm64, lm32):
+        self.assertEqual(lm32.num_pix, 2*lm64.num_pix)
+        lm32.num_pix = lm64.num_pix
+        vals = self.s.get_values(self.params)
+        for lm in [lm64, lm32]:
+            # finite differences without rts leave the parameters shifted
+            self.s.update(self.params, vals)
+            np.random.seed(2)
+            lm._inds = None
+            lm.update_J()
+        self.assertEqual(lm32.J.dtype, np.float32)
+        self.assertEqual(lm32.JTJ.dtype, np.float64)
+
+        d = np.sqrt(np.outer(np.diag(lm64.JTJ), np.diag(lm64.JTJ)))
+        self.assertTrue((np.abs(lm32.JTJ - lm64.JTJ) / d).max() < 1e-5)
+
+        blk = np.array([1, 0, 1, 0, 0], dtype='bool')
+        lm32.update_select_J(blk)
+        self.assertEqual(lm32.JTJ.dtype, np.float64)
+        self.assertTrue(np.allclose(lm32.JTJ, opt.low_mem_sq(lm32.J),
+                rtol=1e-12, atol=0))
+
+    def test_globals(self):
+        kw = {'max_mem': 4e5, 'opt_kwargs': {'min_redundant': 1}}
+        self.check_engine(opt.LMGlobals(self.s, self.params, **kw),
+                opt.LMGlobals(self.s, self.params, J_dtype='float32', **kw))
+
+    def test_varpro(self):
+        kw = {'max_mem': 4e5, 'linear_names': ['ilm-b0-0', 'bkg'],
+                'opt_kwargs': {'min_redundant': 1}}
+        lm64 = opt.LMVarPro(self.s, self.params, **kw)
+        lm32 = opt.LMVarPro(self.s, self.params, J_dtype='float32', **kw)
+        self.assertTrue(lm32.num_pix > lm64.num_pix)
+        lm32.num_pix = 2*lm64.num_pix
+        self.check_engine(lm64, lm32)
+
+class TestVarPro(unittest.TestCase):
+    def setUp(self):
+        self.s = init.create_many_particle_state(imsize=32, N=10,
+                radius=4.0, seed=1)
+        self.linear = ['ilm-b0-0', 'ilm-b0-1', 'ilm-b1-0', 'offset']
+
+    def test_rejected_step_restored(self):
+        s = self.s
+        lm = opt.LMVarPro(s, ['psf-sigz', 'psf-sigx'],
+                linear_names=self.linear)
+        self.assertEqual(s.linear_cache_max_mem, 0)
+        model, vals = s.model.copy(), s.get_values(s.params)
+
+        def trial():
+            # the cache is raised for the run only
+            self.assertTrue(s.linear_cache_max_mem > 0)
+            lm.update_function(lm.param_vals + 0.05)
+            self.assertFalse(np.allclose(vals, s.get_values(s.params)))
+            nbasis = len(s._linear)
+            lm.update_function(lm.param_vals)
+            self.assertEqual(len(s._linear), nbasis)
+        lm._run_with_cache(trial)
+
+        self.assertEqual(s.linear_cache_max_mem, 0)
+        self.assertEqual(len(s._linear), 0)
+        self.assertEqual(len(s.stack), 0)
+        self.assertTrue(np.allclose(model, s.model, rtol=0, atol=1e-12))
+        self.assertTrue(np.allclose(vals, s.get_values(s.params), rtol=0,
+                atol=1e-12))
+
+    def test_fit_and_set_params(self):
+        s = self.s
+        s.update(['psf-sigz', 'ilm-b0-1'], np.array(s.get_values(
+                ['psf-sigz', 'ilm-b0-1'])) + [0.3, 0.05])
+        err0 = s.error
+
+        lm = opt.LMVarPro(s, ['psf-sigz'], linear_names=self.linear,
+                max_iter=3)
+        lm.do_run_2()
+        self.assertTrue(s.error < err0)
+        self.assertEqual(len(s.stack), 0)
+        self.assertEqual(s.linear_cache_max_mem, 0)
+
+        err1 = s.error
+        lm.set_params(['psf-sigz', 'psf-sigy'] + self.linear)
+        self.assertEqual(lm.param_names, ['psf-sigz', 'psf-sigy'])
+        self.assertEqual(lm.linear_names, self.linear)
+        lm.do_run_2()
+        self.assertTrue(s.error <= err1)
+
+class TestParticleGroupCollection(unittest.TestCase):
+    def run_groups(self, n_workers):
+        s = init.create_many_particle_state(imsize=48, N=20, radius=3.0,
+                seed=2)
+        obj = s.get('obj')
+        params = s.param_particle_pos(range(obj.N))
+        np.random.seed(3)
+        s.update(params, obj.pos.ravel() + 0.3*np.random.randn(obj.pos.size))
+
+        np.random.seed(4)
+        lm = opt.LMParticleGroupCollection(s, region_size=12,
+                do_calc_size=False, n_workers=n_workers, max_iter=2)
+        colors = opt.color_particle_groups(s, lm.particle_groups)
+        lm.do_run_1()
+        return colors, np.array(s.get_values(s.params))
+
+    def test_parallel_matches_serial(self):
+        colors, serial = self.run_groups(1)
+        self.assertTrue(np.bincount(colors).max() > 1)
+
+        _, parallel = self.run_groups(2)
+        self.assertTrue(np.allclose(serial, parallel, rtol=1e-8, atol=1e-8))
+
+    def test_overlapping_groups_rerun(self):
+        _, serial = self.run_groups(1)
+
+        # one color for every group, so that overlapping groups must be
+        # caught after they run and run again
+        color = opt.color_particle_groups
+        opt.color_particle_groups = lambda s, groups: np.zeros(len(groups),
+                dtype='int')
+        try:
+            _, parallel = self.run_groups(2)
+        finally:
+            opt.color_particle_groups = color
+        self.assertTrue(np.allclose(serial, parallel, rtol=1e-8, atol=1e-8))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import copy
+import unittest
+import numpy as np
+
+from peri.comp import psfs
+from peri.test import init
+
+def create_state(psf, **kwargs):
+    conf = copy.deepcopy(init.conf_simple)
+    conf['comps']['psf'] = psf
+    return init.create_many_particle_state(imsize=32, N=10, radius=4.0,
+            seed=1, conf=conf, **kwargs)
+
+class TestExecuteMany(unittest.TestCase):
+    def check_psf(self, name):
+        s = create_state(name)
+        psf = s.get('psf')
+        s.set_tile_full()
+
+        np.random.seed(2)
+        fields = np.random.rand(3, *psf.tile.shape)
+        out0 = np.array([psf.execute(f) for f in fields])
+        out1 = psf(fields)
+        self.assertTrue(np.allclose(out0, out1, rtol=0,
+                atol=1e-12*np.abs(out0).max()), name)
+
+    def test_psfs(self):
+        for name in ['gauss3d', 'gauss4d', 'linescan', 'cheb-linescan-fixedss']:
+            self.check_psf(name)
+
+class TestKernelCache(unittest.TestCase):
+    def test_lru(self):
+        cache = psfs.KernelCache(max_bytes=3*800)
+        for key in [1, 2, 3, 1, 4]:
+            cache.get((key,), lambda: np.zeros(100))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 4))
+        self.assertEqual(stats['evictions'], 1)
+        # 2 was the least recently used when 4 came in
+        self.assertEqual(sorted(k[1] for k in cache.kernels), [1, 3, 4])
+
+        cache.invalidate()
+        cache.get((1,), lambda: np.zeros(100))
+        self.assertEqual(cache.stats()['misses'], 5)
+
+    def check_psf(self, name, param):
+        s = create_state(name)
+        psf = s.get('psf')
+        s.set_tile_full()
+        np.random.seed(2)
+        field = np.random.rand(*psf.tile.shape)
+
+        out0 = psf.execute(field)
+        hits = psf.kernel_stats()['hits']
+        s.set_tile_full()
+        self.assertTrue(np.array_equal(out0, psf.execute(field)), name)
+        self.assertTrue(psf.kernel_stats()['hits'] > hits, name)
+
+        # the kernels follow the parameters, as if computed afresh
+        s.update(param, 1.1*s.get_values(param))
+        s.set_tile_full()
+        out1 = psf.execute(field)
+        self.assertFalse(np.allclose(out0, out1), name)
+        psf._kernels = psfs.KernelCache(max_bytes=0)
+        self.assertTrue(np.allclose(out1, psf.execute(field), rtol=0,
+                atol=1e-12*np.abs(out1).max()), name)
+
+    def test_psfs(self):
+        self.check_psf('gauss3d', 'psf-sigx')
+        self.check_psf('cheb-linescan-fixedss', 'psf-alpha')
+
+class TestZOperator(unittest.TestCase):
+    def per_plane(self, psf, field):
+        # the z-convolution as a loop over the planes of the tile
+        cov2d = np.real(np.fft.ifft2(np.fft.fft2(field) * psf.kpsf))
+        cov2dT = np.rollaxis(cov2d, 0, 3)
+        out = np.zeros_like(cov2d)
+        z = psf._zpos(psf.tile)
+        for i in xrange(len(z)):
+            size = psf.get_padding_size(tile=None, z=z[i]).shape
+            m = (z >= z[i]-size[0]) & (z <= z[i]+size[0])
+            out[i] = cov2dT[...,m].dot(psf.rpsf_z(z[m], z[i]))
+        return out
+
+    def check_psf(self, name):
+        s = create_state(name)
+        psf = s.get('psf')
+        np.random.seed(2)
+        for param in [None, 'psf-z-0']:
+            if param is not None:
+                s.update(param, 1.1*s.get_values(param))
+            s.set_tile_full()
+            field = np.random.rand(*psf.tile.shape)
+            out0, out1 = self.per_plane(psf, field), psf.execute(field)
+            self.assertTrue(np.allclose(out0, out1, rtol=0,
+                    atol=1e-12*np.abs(out0).max()), name)
+
+    def test_psfs(self):
+        for name in ['gauss4d', 'gauss4d-leg', 'gauss4d-mom']:
+            self.check_psf(name)
+
+if __name__ == '__main__':
+    unittest.main()
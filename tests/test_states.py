@@ -0,0 +1,177 @@
+import unittest
+import numpy as np
+
+from peri.test import init
+
+class TestUndo(unittest.TestCase):
+    def setUp(self):
+        self.s = init.create_many_particle_state(imsize=32, N=10,
+                radius=4.0, seed=1)
+
+    def check_undo(self, params):
+        s = self.s
+        model, residuals = s.model.copy(), s.residuals.copy()
+        error = s.error
+
+        vals = np.array(s.get_values(params))
+        s.push_update(params, vals + 0.1)
+        self.assertFalse(np.array_equal(model, s.model))
+        s.pop_update()
+
+        self.assertTrue(np.array_equal(model, s.model))
+        self.assertTrue(np.array_equal(residuals, s.residuals))
+        self.assertEqual(error, s.error)
+        self.assertTrue(np.array_equal(vals, s.get_values(params)))
+
+    def test_undo_particle(self):
+        self.check_undo(self.s.param_particle(3))
+        self.assertEqual(self.s.undo_stats['hits'], 1)
+
+    def test_undo_global(self):
+        self.check_undo(['psf-sigz'])
+
+    def test_undo_nested(self):
+        s = self.s
+        model = s.model.copy()
+        for i in xrange(4):
+            params = s.param_particle_pos(i)
+            s.push_update(params, np.array(s.get_values(params)) + 0.2)
+        for i in xrange(4):
+            s.pop_update()
+        self.assertTrue(np.array_equal(model, s.model))
+
+class TestColoredJ(unittest.TestCase):
+    def test_colored_matches_sequential(self):
+        s = init.create_many_particle_state(imsize=32, N=10, radius=4.0,
+                seed=1)
+        params = s.param_particle(range(s.get('obj').N))
+        self.assertTrue(len(list(s.color_params(params))) < len(params))
+
+        J0 = s.gradmodel(params=params, rts=True)
+        J1 = s.gradmodel(params=params, rts=True, colored=True)
+        self.assertTrue(np.allclose(J0, J1, rtol=0, atol=1e-9))
+
+class TestAnalyticJ(unittest.TestCase):
+    def check_method(self, method, exact_volume):
+        s = init.create_many_particle_state(imsize=32, N=10, radius=4.0,
+                seed=1)
+        obj = s.get('obj')
+        obj.exact_volume = exact_volume
+        obj.set_draw_method(method)
+        s.reset()
+
+        params = s.param_particle([2, 5])
+        an = s.gradmodel_analytic(params)
+        fd = s.gradmodel(params=params, rts=True, dl=1e-6)
+        err = np.abs(an - fd).max(axis=1) / np.abs(fd).max(axis=1)
+        self.assertTrue(err.max() < 1e-3, '%s %r: %r' % (method,
+                exact_volume, err))
+
+    def test_methods(self):
+        for method in ['exact-gaussian', 'exact-gaussian-trim',
+                'exact-gaussian-fast', 'lerp', 'logistic',
+                'constrained-cubic']:
+            for exact_volume in [True, False]:
+                self.check_method(method, exact_volume)
+
+class TestLinearCache(unittest.TestCase):
+    def setUp(self):
+        self.s = init.create_many_particle_state(imsize=32, N=10,
+                radius=4.0, seed=1)
+        self.s.linear_cache_max_mem = 1e8
+        self.params = self.s.get('ilm').params[:4] + ['offset']
+        np.random.seed(2)
+        self.inds = np.random.choice(self.s.model.size, 500, replace=False)
+
+    def check_columns(self, inds):
+        s = self.s
+        J0 = s.gradmodel(params=self.params, rts=True, inds=inds)
+        J1 = s.gradmodel_analytic(self.params, inds=inds)
+        self.assertTrue(np.allclose(J0, J1, rtol=0,
+                atol=1e-6*np.abs(J0).max()))
+        return J1
+
+    def test_exact_columns(self):
+        self.check_columns(self.inds)
+        self.check_columns(None)
+
+    def test_reused_until_change(self):
+        s, p = self.s, self.params[0]
+        col = s._linear_column(p, inds=self.inds)
+        self.assertTrue(s._linear_column(p, inds=self.inds) is col)
+        self.assertFalse(s._linear_column(p, inds=self.inds[::-1]) is col)
+
+        params = s.param_particle_pos(3)
+        s.update(params, np.array(s.get_values(params)) + 0.5)
+        self.assertFalse(s._linear_column(p, inds=self.inds) is col)
+        self.check_columns(self.inds)
+
+class TestError(unittest.TestCase):
+    def run_updates(self, interval):
+        s = init.create_many_particle_state(imsize=32, N=10, radius=4.0,
+                seed=1)
+        s.error_resync_interval = interval
+        np.random.seed(2)
+        for i in xrange(30):
+            params = s.param_particle_pos(i % 10)
+            s.update(params, np.array(s.get_values(params)) +
+                    0.1*np.random.randn(3))
+        p = s.get('ilm').params[0]
+        s.update(p, s.get_values(p) + 0.01)
+        return s
+
+    def exact_error(self, s):
+        return np.dot(s.residuals.ravel(), s.residuals.ravel())
+
+    def test_running_error(self):
+        s = self.run_updates(0)
+        self.assertTrue(np.allclose(s.error, self.exact_error(s),
+                rtol=1e-12, atol=0))
+
+    def test_resync(self):
+        s = self.run_updates(7)
+        self.assertTrue(s._error_nupdates < 7)
+        s.resync_error()
+        self.assertEqual(s.error, self.exact_error(s))
+
+class TestFFTTiles(unittest.TestCase):
+    def setUp(self):
+        self.states = [init.create_many_particle_state(imsize=32, N=10,
+                radius=4.0, seed=1) for i in xrange(2)]
+        self.states[1].fft_tiles = True
+
+    def smooth(self, n):
+        for p in [2, 3, 5, 7]:
+            while n % p == 0:
+                n //= p
+        return n == 1
+
+    def test_model_unchanged(self):
+        np.random.seed(3)
+        for s in self.states:
+            s.reset_tile_stats()
+        for i in xrange(10):
+            params = self.states[0].param_particle(i)
+            dv = 0.3*np.random.randn(len(params))
+            for s in self.states:
+                s.update(params, np.array(s.get_values(params)) + dv)
+        m0, m1 = [s.model for s in self.states]
+        self.assertTrue(np.allclose(m0, m1, rtol=0, atol=1e-10))
+        stats = [s.tile_stats() for s in self.states]
+        self.assertEqual(stats[0]['tiles'], stats[1]['tiles'])
+        self.assertTrue(stats[1]['distinct_shapes'] <=
+                stats[0]['distinct_shapes'])
+
+    def test_interior_shape(self):
+        s = self.states[1]
+        i = s.obj_closest_particle(np.array(s.oshape.shape) / 2.0)
+        params = s.param_particle_pos(i)
+        outer, _, _ = s.get_update_io_tiles(params,
+                np.array(s.get_values(params)) + 0.1)
+        interior = (outer.l > s.oshape.l) & (outer.r < s.oshape.r)
+        self.assertTrue(interior.any())
+        for n in outer.shape[interior]:
+            self.assertTrue(self.smooth(n))
+
+if __name__ == '__main__':
+    unittest.main()